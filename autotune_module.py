@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Automatic choice of the worker count and buffer size of video_selection. A short calibration
+decodes the first frames of the video and analyses a few of them, measuring how long decoding,
+sending a frame to a worker and analysing it take. The worker count is then picked so the
+analysis of a frame, spread over the workers, takes about as long as decoding and sending it,
+within the cpu cores and memory of the machine, and the buffer is sized to keep every worker
+busy with a few frames per batch.
+
+Video_selection sends each buffer to the workers as one batch, so the buffer size is also the
+chunking of the work. Results are cached per machine, frame format and keypoint count.
+"""
+
+# standard library
+from typing import Optional
+import os
+import json
+import pickle
+import timeit
+import platform
+
+# installed library
+import numpy as np
+
+# local library
+from using_skimage.io_module import read_video
+from using_skimage.analysis_module import image_descriptors, laplace_sharpness_estimate
+from selection_module import WORKER_FRAME_COPIES
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'sfm-preprocessor',
+                                  'autotune.json')
+# smallest relative drop of the seconds per frame worth starting one more worker process for
+MIN_WORKER_GAIN = 0.05
+
+
+def available_cpus() -> int:
+    """
+    Number of cpu cores this process may run on.
+
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def physical_memory() -> Optional[int]:
+    """
+    Bytes of physical memory of the machine, or None if it can't be read.
+
+    """
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def calibrate(fpath: str, max_keypoints: int = 1000, start_index: int = 0,
+              calibration_frames: int = 120, sample_frames: int = 4) -> dict:
+    """
+    Measures the per-frame cost of the stages of video_selection on the first frames of a
+    video, in this process.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+    start_index : int, optional
+        Calibrate on the frames from this index.
+        The default is 0
+    calibration_frames : int, optional
+        Number of frames decoded to measure the decode rate.
+        The default is 120
+    sample_frames : int, optional
+        Number of those frames, spread evenly, analysed to measure the analysis cost.
+        The default is 4
+
+    Raises
+    ------
+    Exception
+        No frames could be decoded.
+
+    Returns
+    -------
+    dict
+        Frame 'shape' and 'dtype', and seconds per frame to 'decode', 'transfer' (pickle it
+        to a worker and back) and 'analyse' (descriptors and sharpness).
+
+    """
+
+    frames = []
+    start = timeit.default_timer()
+    for frame in read_video(fpath, as_gray=True, start_index=start_index):
+        frames.append(frame)
+        if len(frames) >= calibration_frames:
+            break
+    decode = (timeit.default_timer() - start) / max(len(frames), 1)
+    if not frames:
+        raise Exception(f'Could not decode any frames of "{fpath}" to calibrate on')
+
+    samples = [frames[int(i)] for i in np.linspace(0, len(frames) - 1,
+                                                   min(sample_frames, len(frames)))]
+    shape, dtype = samples[0].shape, samples[0].dtype
+    del frames
+
+    start = timeit.default_timer()
+    for frame in samples:
+        pickle.loads(pickle.dumps([frame, max_keypoints, False], pickle.HIGHEST_PROTOCOL))
+        pickle.loads(pickle.dumps([frame,], pickle.HIGHEST_PROTOCOL))
+    transfer = (timeit.default_timer() - start) / len(samples)
+
+    image_descriptors(samples[0], max_keypoints, False) # warm up (numba compilation)
+    start = timeit.default_timer()
+    for frame in samples:
+        image_descriptors(frame, max_keypoints, False)
+        laplace_sharpness_estimate(frame)
+    analyse = (timeit.default_timer() - start) / len(samples)
+
+    return {'shape': list(shape), 'dtype': str(dtype), 'decode': decode, 'transfer': transfer,
+            'analyse': analyse}
+
+
+def choose_parameters(calibration: dict, min_distance: int = 5, max_distance: int = 60,
+                      max_workers: Optional[int] = None) -> dict:
+    """
+    Picks the worker count and buffer size from a calibration. video_selection decodes a buffer,
+    then analyses it on the workers, one after the other, so a frame costs
+    decode + transfer + analyse / n_workers seconds. Every worker makes that smaller, workers are
+    added as long as one more cuts it by at least MIN_WORKER_GAIN, limited by the cpu cores and
+    by half the physical memory (see WORKER_FRAME_COPIES).
+
+    Parameters
+    ----------
+    calibration : dict
+        Result of calibrate.
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+    max_workers : Optional[int], optional
+        Never use more workers than this.
+        The default is None (cpu cores)
+
+    Returns
+    -------
+    dict
+        'n_workers' and 'buffer_size', with the 'expected_fps' of that setting.
+
+    """
+
+    cpus = available_cpus() if max_workers is None else min(max_workers, available_cpus())
+    serial = calibration['decode'] + calibration['transfer']
+    analyse = calibration['analyse']
+
+    memory = physical_memory()
+    if memory is not None:
+        worker_bytes = WORKER_FRAME_COPIES * int(np.prod(calibration['shape'][:2])) * 8
+        cpus = min(cpus, memory // 2 // worker_bytes)
+    cpus = int(max(cpus, 1))
+
+    # worker n + 1 saves analyse / n - analyse / (n + 1) of the seconds per frame
+    n_workers = 1
+    while (n_workers < cpus and analyse / (n_workers * (n_workers + 1)) >=
+           MIN_WORKER_GAIN * (serial + analyse / n_workers)):
+        n_workers += 1
+
+    # a few frames per worker each batch (at least the GUI minimum of 10), within the window
+    window = max_distance - min_distance
+    buffer_size = int(max(min(max(4 * n_workers, 10), window), 1))
+
+    expected_fps = 1 / (serial + calibration['analyse'] / n_workers)
+    return {'n_workers': n_workers, 'buffer_size': buffer_size, 'expected_fps': expected_fps}
+
+
+def _cache_key(calibration: dict, max_keypoints: int, min_distance: int, max_distance: int,
+               max_workers: Optional[int]) -> str:
+    return json.dumps([platform.node(), platform.processor(), available_cpus(),
+                       calibration['shape'], calibration['dtype'], max_keypoints,
+                       min_distance, max_distance, max_workers])
+
+
+def auto_tune(fpath: str, max_keypoints: int = 1000, min_distance: int = 5,
+              max_distance: int = 60, start_index: int = 0, max_workers: Optional[int] = None,
+              calibration_frames: int = 120, sample_frames: int = 4,
+              cache_path: Optional[str] = DEFAULT_CACHE_PATH, debug_msg: bool = True) -> dict:
+    """
+    Picks n_workers and buffer_size for running video_selection on a video, reusing the cached
+    choice of an earlier calibration on this machine with the same frame format.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+    start_index : int, optional
+        Calibrate on the frames from this index.
+        The default is 0
+    max_workers : Optional[int], optional
+        Never use more workers than this.
+        The default is None (cpu cores)
+    calibration_frames : int, optional
+        See calibrate.
+        The default is 120
+    sample_frames : int, optional
+        See calibrate.
+        The default is 4
+    cache_path : Optional[str], optional
+        Json file caching the choices, created if it doesn't exist.
+        The default is DEFAULT_CACHE_PATH (None to always calibrate)
+    debug_msg : bool, optional
+        Print out the measurements and the choice.
+        The default is True
+
+    Returns
+    -------
+    dict
+        'n_workers' and 'buffer_size' to pass to video_selection, with the calibration and the
+        'expected_fps'.
+
+    """
+
+    # the frame format only needs one frame, the cache is checked before calibrating
+    first_frame = next(read_video(fpath, as_gray=True, start_index=start_index), None)
+    if first_frame is None:
+        raise Exception(f'Could not decode any frames of "{fpath}" to calibrate on')
+    key = _cache_key({'shape': list(first_frame.shape), 'dtype': str(first_frame.dtype)},
+                     max_keypoints, min_distance, max_distance, max_workers)
+    del first_frame
+
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'r') as file:
+                cache = json.load(file)
+        except ValueError: # a broken cache is only a missed shortcut
+            cache = {}
+    if key in cache:
+        if debug_msg:
+            print(f'Auto-tune: using cached [{cache[key]["n_workers"]}] workers and buffer size '
+                  f'[{cache[key]["buffer_size"]}] for this machine and frame format')
+        return cache[key]
+
+    if debug_msg:
+        print(f'Auto-tune: calibrating on the first [{calibration_frames}] frames...')
+    calibration = calibrate(fpath, max_keypoints, start_index, calibration_frames, sample_frames)
+    tuned = choose_parameters(calibration, min_distance, max_distance, max_workers)
+    tuned['calibration'] = calibration
+    if debug_msg:
+        print(f'Auto-tune: decode ({round(calibration["decode"] * 1000, 2)} ms), transfer '
+              f'({round(calibration["transfer"] * 1000, 2)} ms) and analysis '
+              f'({round(calibration["analyse"] * 1000, 2)} ms) per frame, using '
+              f'[{tuned["n_workers"]}] workers and buffer size [{tuned["buffer_size"]}] for about '
+              f'({round(tuned["expected_fps"], 2)} fps)')
+
+    if cache_path is not None:
+        cache[key] = tuned
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(cache, file, indent=2)
+        os.replace(temp_path, cache_path)
+    return tuned
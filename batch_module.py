@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+A scheduler to select frames from many videos at once. Several videos are decoded concurrently,
+each in its own pipeline_selection, all feeding one shared pool of analysis worker processes.
+Videos are started largest first, so the longest ones don't end up running alone at the end.
+"""
+
+# standard library
+from typing import List, Optional, Dict, Union, Callable
+import os
+import timeit
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# installed library
+
+# local library
+from using_skimage.io_module import estimate_video_length
+from pipeline_module import pipeline_selection
+
+
+def schedule_largest_first(videos: List[str]) -> List[str]:
+    """
+    Orders videos by their estimated frame count, largest first. Videos whose length can't be
+    read are put last, they will report their error when they are run.
+
+    Parameters
+    ----------
+    videos : List[str]
+        Video paths.
+
+    Returns
+    -------
+    List[str]
+        Video paths in the order to run them.
+
+    """
+
+    lengths = {}
+    for video in videos:
+        try:
+            lengths[video] = estimate_video_length(video)
+        except Exception:
+            lengths[video] = -1
+    return sorted(videos, key=lambda video: lengths[video], reverse=True)
+
+
+def batch_selection(videos: List[str], n_workers: Optional[int] = None, decoders: int = 2,
+                    on_result: Optional[Callable[[str, Union[List[int], Exception]], None]] = None,
+                    debug_msg: bool = True,
+                    **kwargs) -> Dict[str, Union[List[int], Exception]]:
+    """
+    Selects frames from every video, running [decoders] videos at a time on one shared pool of
+    analysis worker processes. A failing video doesn't affect the others, its exception is
+    returned in place of its selection.
+
+    Parameters
+    ----------
+    videos : List[str]
+        Absolute paths to the video files.
+    n_workers : Optional[int], optional
+        Number of shared analysis worker processes.
+        The default is None (cpu count)
+    decoders : int, optional
+        Number of videos decoded and selected from concurrently.
+        The default is 2
+    on_result : Optional[Callable[[str, Union[List[int], Exception]], None]], optional
+        Called with the video path and its selected indexes (or exception) as each video
+        finishes, for example to write the results out right away. Should it raise, that
+        exception is returned as the video's result.
+        The default is None
+    debug_msg : bool, optional
+        Print out a message as each video finishes.
+        The default is True
+    **kwargs
+        Selection parameters passed on to pipeline_selection, like max_keypoints, min_distance,
+        max_distance, similarity_percentile or sharpness_percentile.
+
+    Returns
+    -------
+    Dict[str, Union[List[int], Exception]]
+        Selected frame indexes, or the exception raised, of each video.
+
+    """
+
+    if debug_msg:
+        start_time = timeit.default_timer()
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    order = schedule_largest_first(videos)
+    results = {}
+    with mp.Pool(n_workers) as pool, ThreadPoolExecutor(max_workers=decoders) as executor:
+        futures = {executor.submit(lambda video: list(pipeline_selection(video, pool=pool,
+                                                                         n_workers=n_workers,
+                                                                         debug_msg=False,
+                                                                         **kwargs)),
+                                   video): video for video in order}
+        for future in as_completed(futures):
+            video = futures[future]
+            error = future.exception()
+            results[video] = error if error is not None else future.result()
+            if on_result is not None:
+                try:
+                    on_result(video, results[video])
+                except Exception as result_error: # fails this video only
+                    if error is None:
+                        error = results[video] = result_error
+            if debug_msg:
+                if error is not None:
+                    print(f'!!!! Failed "{video}": {error!r}')
+                else:
+                    print(f'<<<< Selected [{len(results[video])}] images from "{video}", '
+                          f'[{len(results)}/{len(videos)}] videos done')
+
+    if debug_msg:
+        print(f'!!!! Finished [{len(videos)}] videos in '
+              f'({round(timeit.default_timer() - start_time, 3)} s)')
+    # keep the order the videos were given in
+    return {video: results[video] for video in videos}
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Benchmarks on synthetic data, so they run fully offline and give the same input on every
+machine. Results can be saved as a baseline and later runs compared against it to catch
+regressions.
+
+Kernel benchmarks time every analysis kernel on 720p, 1080p and 4K frames, grayscale and RGB,
+reporting frames per second and the peak memory a call allocates.
+
+    python cli.py benchmark --save-baseline kernels.json
+    python cli.py benchmark --baseline kernels.json
+
+The end-to-end benchmark synthesises a test video (a panning textured scene with blurred frames
+and static segments, encoded with the ffmpeg bundled with imageio) and runs video_selection and
+save_video_frames on it with fixed parameters, recording throughput, per-stage timing and the
+selected frames. Against a baseline it fails on a throughput drop or a changed selection.
+
+    python cli.py throughput --work-dir bench/ --save-baseline throughput.json
+    python cli.py throughput --work-dir bench/ --baseline throughput.json
+"""
+
+# standard library
+from typing import Callable, Dict, List, Tuple, Iterable
+import os
+import json
+import shutil
+import platform
+import statistics
+import timeit
+import tracemalloc
+
+# installed library
+from numpy import ndarray # for typing only
+import numpy as np
+import imageio
+
+# local library
+from using_skimage.analysis_module import (gray, image_descriptors, match_descriptors,
+                                           laplace_sharpness_estimate, canny_sharpness_estimate,
+                                           ssim_images, blur_image)
+from using_skimage.io_module import save_video_frames
+from using_skimage.timing_module import TimingMetrics
+from using_skimage.profiling_module import reset_peak
+from selection_module import video_selection
+
+
+RESOLUTIONS = {'720p': (720, 1280), '1080p': (1080, 1920), '4k': (2160, 3840)}
+COLOR_MODES = ('gray', 'rgb')
+
+
+def synthetic_frame(resolution: Tuple[int, int], color: bool = True, seed: int = 0,
+                    shift: int = 0) -> ndarray:
+    """
+    Generates a textured test frame: random blocks of several sizes, which give plenty of
+    corners for keypoint detection, over a gradient with some pixel noise.
+
+    Parameters
+    ----------
+    resolution : Tuple[int, int]
+        Height and width of the frame.
+    color : bool, optional
+        RGB frame if True, grayscale if False.
+        The default is True
+    seed : int, optional
+        Random seed, the same seed gives the same frame.
+        The default is 0
+    shift : int, optional
+        Shift the scene right and down by this many pixels, for a similar second frame.
+        The default is 0
+
+    Returns
+    -------
+    ndarray
+        uint8 frame.
+
+    """
+
+    height, width = resolution
+    rng = np.random.default_rng(seed)
+    channels = 3 if color else 1
+    scene = np.zeros((height + shift, width + shift, channels), dtype=np.float32)
+    for block in (64, 16, 4):
+        cells = rng.random(((height + shift) // block + 1, (width + shift) // block + 1, channels),
+                           dtype=np.float32)
+        scene += np.repeat(np.repeat(cells, block, axis=0), block, axis=1)[:height + shift,
+                                                                           :width + shift]
+    scene += np.linspace(0, 1, width + shift, dtype=np.float32)[None, :, None]
+    frame = scene[:height, :width] if shift == 0 else scene[shift:, shift:]
+    frame = frame / 4 * 255 + rng.normal(0, 4, frame.shape).astype(np.float32)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    return frame if color else frame[:, :, 0]
+
+
+def _kernel_arguments(first: ndarray, second: ndarray) -> Dict[str, Tuple[Callable, tuple]]:
+    """
+    The benchmarked kernels with their arguments for a pair of frames.
+
+    """
+
+    descriptors = (image_descriptors(gray(first), 500, False),
+                   image_descriptors(gray(second), 500, False))
+    return {'gray': (gray, (first,)),
+            'image_descriptors': (image_descriptors, (first, 500, False)),
+            'match_descriptors': (match_descriptors, descriptors),
+            'laplace_sharpness_estimate': (laplace_sharpness_estimate, (first,)),
+            'canny_sharpness_estimate': (canny_sharpness_estimate, (first,)),
+            'ssim_images': (ssim_images, (first, second)),
+            'blur_image': (blur_image, (first,))}
+
+
+KERNELS = ('gray', 'image_descriptors', 'match_descriptors', 'laplace_sharpness_estimate',
+           'canny_sharpness_estimate', 'ssim_images', 'blur_image')
+
+
+def benchmark_kernel(function: Callable, args: tuple, repeats: int = 5) -> Dict[str, float]:
+    """
+    Times a kernel, after one warm up call (numba compilation, caches), and measures the peak
+    memory traced during one more call.
+
+    Parameters
+    ----------
+    function : Callable
+        Kernel to benchmark.
+    args : tuple
+        Arguments of the kernel.
+    repeats : int, optional
+        Number of timed calls.
+        The default is 5
+
+    Returns
+    -------
+    Dict[str, float]
+        Median seconds per call, frames (calls) per second and peak allocated bytes of a call.
+
+    """
+
+    function(*args)
+    times = []
+    for _ in range(repeats):
+        start = timeit.default_timer()
+        function(*args)
+        times.append(timeit.default_timer() - start)
+    seconds = statistics.median(times)
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1] - current
+    if started:
+        tracemalloc.stop()
+
+    return {'seconds': seconds, 'fps': 1 / seconds if seconds > 0 else float('inf'),
+            'peak_bytes': peak}
+
+
+def run_benchmarks(resolutions: Iterable[str] = tuple(RESOLUTIONS),
+                   color_modes: Iterable[str] = COLOR_MODES, kernels: Iterable[str] = KERNELS,
+                   repeats: int = 5, debug_msg: bool = True) -> dict:
+    """
+    Benchmarks the kernels on synthetic frames of every resolution and color mode. A kernel
+    failing on some input is recorded with its error instead of stopping the run.
+
+    Parameters
+    ----------
+    resolutions : Iterable[str], optional
+        Keys of RESOLUTIONS.
+        The default is all of them
+    color_modes : Iterable[str], optional
+        'gray' and/or 'rgb'.
+        The default is both
+    kernels : Iterable[str], optional
+        Names of the kernels, see KERNELS.
+        The default is all of them
+    repeats : int, optional
+        Number of timed calls of each kernel on each input.
+        The default is 5
+    debug_msg : bool, optional
+        Print out each result as it is measured.
+        The default is True
+
+    Returns
+    -------
+    dict
+        Machine info and a result for each "kernel/resolution/color mode".
+
+    """
+
+    results = {}
+    for resolution in resolutions:
+        for mode in color_modes:
+            first = synthetic_frame(RESOLUTIONS[resolution], color=mode == 'rgb', seed=1)
+            second = synthetic_frame(RESOLUTIONS[resolution], color=mode == 'rgb', seed=1,
+                                     shift=8)
+            arguments = _kernel_arguments(first, second)
+            for kernel in kernels:
+                name = f'{kernel}/{resolution}/{mode}'
+                function, args = arguments[kernel]
+                try:
+                    results[name] = benchmark_kernel(function, args, repeats)
+                except Exception as error:
+                    results[name] = {'error': repr(error)}
+                if debug_msg:
+                    result = results[name]
+                    if 'error' in result:
+                        print(f'{name:<45} ERROR {result["error"]}')
+                    else:
+                        print(f'{name:<45} {result["fps"]:>10.2f} fps '
+                              f'{result["peak_bytes"] / 2**20:>9.1f} MiB peak')
+            del first, second, arguments
+
+    return {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                        'python': platform.python_version(), 'numpy': np.__version__},
+            'repeats': repeats, 'results': results}
+
+
+def save_baseline(results: dict, fpath: str) -> None:
+    """
+    Saves benchmark results as a baseline json file.
+
+    """
+
+    with open(fpath, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def load_baseline(fpath: str) -> dict:
+    """
+    Loads a baseline saved by save_baseline.
+
+    """
+
+    with open(fpath, 'r') as file:
+        return json.load(file)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Compares benchmark results to a baseline, listing the regressions: kernels that got slower
+    or use more memory than the tolerance allows, and kernels that fail, also those that failed
+    in the baseline allready, as a kernel that can't be timed can't be checked either.
+    Results missing from either side are ignored.
+
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmarks.
+    baseline : dict
+        Baseline results of run_benchmarks.
+    tolerance : float, optional
+        Allowed relative slowdown (and memory increase), 0.2 is 20%.
+        The default is 0.2
+
+    Returns
+    -------
+    List[str]
+        Description of every regression, empty if there are none.
+
+    """
+
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        if 'error' in result:
+            regressions.append(f'{name} {"still fails" if "error" in base else "fails"}: '
+                               f'{result["error"]}')
+            continue
+        if 'error' in base:
+            continue
+        if result['fps'] < base['fps'] * (1 - tolerance):
+            regressions.append(f'{name} is slower: {result["fps"]:.2f} fps, was '
+                               f'{base["fps"]:.2f} fps')
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance) + 2**20:
+            regressions.append(f'{name} uses more memory: '
+                               f'{result["peak_bytes"] / 2**20:.1f} MiB, was '
+                               f'{base["peak_bytes"] / 2**20:.1f} MiB')
+    return regressions
+
+
+def synthesize_video(fpath: str, n_frames: int = 300, resolution: Tuple[int, int] = (360, 640),
+                     fps: int = 30, seed: int = 0, pan_speed: int = 4,
+                     static_segments: Iterable[Tuple[int, int]] = ((60, 90), (200, 230)),
+                     blur_period: int = 11, blur_length: int = 2) -> dict:
+    """
+    Synthesises a test video of a camera panning over a textured scene, with runs of motion
+    blurred frames and segments where the camera stands still, and encodes it as H.264 with the
+    ffmpeg bundled with imageio. The same arguments always give the same frames.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the video file to write (.mp4).
+    n_frames : int, optional
+        Number of frames.
+        The default is 300
+    resolution : Tuple[int, int], optional
+        Height and width of the frames, multiples of 8.
+        The default is (360, 640)
+    fps : int, optional
+        Frame rate.
+        The default is 30
+    seed : int, optional
+        Random seed of the scene.
+        The default is 0
+    pan_speed : int, optional
+        Pixels the camera moves right each frame.
+        The default is 4
+    static_segments : Iterable[Tuple[int, int]], optional
+        (first, last) frame index ranges where the camera doesn't move.
+        The default is ((60, 90), (200, 230))
+    blur_period : int, optional
+        Every [blur_period] frames starts a run of motion blurred frames.
+        The default is 11
+    blur_length : int, optional
+        Number of motion blurred frames in each run.
+        The default is 2
+
+    Returns
+    -------
+    dict
+        Frame indexes that are 'blurred' and 'static' (not the first frame of a static segment).
+
+    """
+
+    height, width = resolution
+    static = {i for first, last in static_segments for i in range(first + 1, last + 1)}
+    # camera position of every frame, holding still in the static segments
+    positions = np.cumsum([0] + [0 if i in static else pan_speed for i in range(1, n_frames)])
+    blurred = [i for i in range(n_frames) if i % blur_period < blur_length and i not in static]
+    scene = synthetic_frame((height + 16, width + int(positions[-1]) + 16), color=True,
+                            seed=seed)
+
+    with imageio.get_writer(fpath, format='FFMPEG', fps=fps, codec='libx264', quality=8,
+                            macro_block_size=8, ffmpeg_log_level='error',
+                            ffmpeg_params=['-threads', '1']) as writer:
+        for i in range(n_frames):
+            x = int(positions[i])
+            y = int(round(4 + 4 * np.sin(x / 97)))
+            if i in blurred:
+                # motion blur, average of the crops along the pan direction
+                frame = np.mean([scene[y:y + height, x + dx:x + dx + width]
+                                 for dx in range(0, 16, 2)], axis=0).astype(np.uint8)
+            else:
+                frame = scene[y:y + height, x:x + width]
+            writer.append_data(frame)
+
+    return {'blurred': blurred, 'static': sorted(static)}
+
+
+# fixed parameters of the end-to-end benchmark, changing them invalidates the baselines
+END_TO_END_VIDEO = {'n_frames': 300, 'resolution': (360, 640), 'fps': 30, 'seed': 0}
+END_TO_END_SELECTION = {'max_keypoints': 500, 'buffer_size': 25, 'min_distance': 5,
+                        'max_distance': 40, 'similarity_percentile': 0.2,
+                        'sharpness_percentile': 0.15, 'static_threshold': 0.01}
+
+
+def run_end_to_end(work_dir: str, n_workers: int = 2, debug_msg: bool = True) -> dict:
+    """
+    Runs the end-to-end benchmark: synthesises the test video into work_dir (once, it is reused
+    afterwards), selects frames from it and writes them out, with the fixed parameters of
+    END_TO_END_VIDEO and END_TO_END_SELECTION.
+
+    Parameters
+    ----------
+    work_dir : str
+        Folder for the test video and the written frames, created if it doesn't exist.
+    n_workers : int, optional
+        Number of worker processes.
+        The default is 2
+    debug_msg : bool, optional
+        Print out the results.
+        The default is True
+
+    Returns
+    -------
+    dict
+        Parameters, selected indexes, throughput and per-stage timing of selection and writeout.
+
+    """
+
+    os.makedirs(work_dir, exist_ok=True)
+    video = os.path.join(work_dir, 'synthetic.mp4')
+    video_info_path = os.path.join(work_dir, 'synthetic.json')
+    video_info = None
+    if os.path.isfile(video) and os.path.isfile(video_info_path):
+        with open(video_info_path, 'r') as file:
+            video_info = json.load(file)
+    if video_info is None or video_info['parameters'] != json.loads(json.dumps(
+            END_TO_END_VIDEO)):
+        if debug_msg:
+            print(f'Synthesising test video "{video}"')
+        video_info = {'parameters': END_TO_END_VIDEO,
+                      **synthesize_video(video, **END_TO_END_VIDEO)}
+        with open(video_info_path, 'w') as file:
+            json.dump(video_info, file)
+
+    selection_metrics = TimingMetrics()
+    start = timeit.default_timer()
+    selected = list(video_selection(video, n_workers=n_workers, image_count=END_TO_END_VIDEO[
+                                        'n_frames'], metrics=selection_metrics, debug_msg=False,
+                                    as_generator=True, **END_TO_END_SELECTION))
+    selection_seconds = timeit.default_timer() - start
+
+    output_folder = os.path.join(work_dir, 'frames')
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    writeout_metrics = TimingMetrics()
+    start = timeit.default_timer()
+    for _ in save_video_frames(video, output_folder, selected, debug_msg=False, overwrite=True,
+                               as_generator=True, metrics=writeout_metrics):
+        pass
+    writeout_seconds = timeit.default_timer() - start
+
+    n_frames = END_TO_END_VIDEO['n_frames']
+    result = {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                          'python': platform.python_version(), 'numpy': np.__version__},
+              'parameters': {'video': END_TO_END_VIDEO, 'selection': END_TO_END_SELECTION,
+                             'n_workers': n_workers},
+              'selected': selected,
+              'blurred_selected': sorted(set(selected) & set(video_info['blurred'])),
+              'selection': {'seconds': selection_seconds, 'fps': n_frames / selection_seconds,
+                            'timing': selection_metrics.to_dict()},
+              'writeout': {'seconds': writeout_seconds,
+                           'fps': writeout_metrics.counters.get('frames decoded', 0) /
+                           writeout_seconds,
+                           'timing': writeout_metrics.to_dict()}}
+    result = json.loads(json.dumps(result)) # same types as a loaded baseline
+
+    if debug_msg:
+        print(f'Selected [{len(selected)}] of [{n_frames}] frames at '
+              f'({result["selection"]["fps"]:.2f} fps), [{len(result["blurred_selected"])}] of '
+              f'them blurred')
+        print(f'Wrote [{len(selected)}] frames out at ({result["writeout"]["fps"]:.2f} fps '
+              f'decoded)')
+        for name, part in (('selection', result['selection']), ('writeout', result['writeout'])):
+            for stage, histogram in part['timing']['stages'].items():
+                print(f'    {name:<10} {stage:<12} {histogram["total"]:>8.3f} s total '
+                      f'{histogram["p50"] * 1000:>9.2f} ms p50 over [{histogram["count"]}]')
+    return result
+
+
+def compare_end_to_end(result: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Compares an end-to-end result to a baseline, listing the regressions: selection or writeout
+    throughput dropping more than the tolerance allows, and a changed selection.
+
+    Parameters
+    ----------
+    result : dict
+        Result of run_end_to_end.
+    baseline : dict
+        Baseline result of run_end_to_end.
+    tolerance : float, optional
+        Allowed relative throughput drop, 0.2 is 20%.
+        The default is 0.2
+
+    Returns
+    -------
+    List[str]
+        Description of every regression, empty if there are none.
+
+    """
+
+    if result['parameters'] != baseline['parameters']:
+        return [f'parameters differ from the baseline, {result["parameters"]} instead of '
+                f'{baseline["parameters"]}']
+
+    regressions = []
+    if result['selected'] != baseline['selected']:
+        added = sorted(set(result['selected']) - set(baseline['selected']))
+        removed = sorted(set(baseline['selected']) - set(result['selected']))
+        regressions.append(f'selection changed, selected {added} instead of {removed}')
+    for part in ('selection', 'writeout'):
+        if result[part]['fps'] < baseline[part]['fps'] * (1 - tolerance):
+            regressions.append(f'{part} is slower: {result[part]["fps"]:.2f} fps, was '
+                               f'{baseline[part]["fps"]:.2f} fps')
+    return regressions
@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Command line entry point for running the preprocessor headless, for example on render nodes or
+from cluster jobs. Videos are given as arguments and/or through a manifest file.
+
+    python cli.py count VIDEO...
+    python cli.py select VIDEO... --output-dir selections/
+    python cli.py writeout VIDEO... --csv-dir selections/ --output-dir frames/
+    python cli.py analyse VIDEO... --store-dir metrics/
+    python cli.py worker WORK_DIR
+    python cli.py benchmark
+    python cli.py throughput --work-dir bench/
+
+The image processing libraries are only imported by the subcommands that need them, so the help
+and the (estimated) frame counts come up fast.
+"""
+
+# standard library
+from typing import List, Optional
+import os
+import sys
+import json
+import argparse
+import traceback
+
+
+def read_manifest(fpath: str) -> List[str]:
+    """
+    Reads the video paths listed in a manifest file. The manifest is either a json list of paths,
+    or a text file with a path on every line, where empty lines and lines starting with '#' are
+    ignored. Relative paths are relative to the manifest's folder.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the manifest file.
+
+    Returns
+    -------
+    List[str]
+        Video paths.
+
+    """
+
+    with open(fpath, 'r') as file:
+        text = file.read()
+    if fpath.endswith('.json'):
+        paths = json.loads(text)
+    else:
+        paths = [line.strip() for line in text.splitlines()
+                 if line.strip() and not line.strip().startswith('#')]
+    folder = os.path.dirname(os.path.abspath(fpath))
+    return [os.path.join(folder, path) for path in paths]
+
+
+def write_csv(fpath: str, indexes: List[int]) -> None:
+    """
+    Writes selected frame indexes into a CSV file, in the same ';' separated format as the GUI.
+
+    """
+
+    with open(fpath, 'w') as file:
+        file.write(''.join(f'{index};' for index in indexes))
+
+
+def read_csv(fpath: str) -> List[int]:
+    """
+    Reads selected frame indexes from a CSV file written by write_csv or the GUI.
+
+    """
+
+    with open(fpath, 'r') as file:
+        return [int(n) for n in file.read().strip().split(';') if n.strip().isdigit()]
+
+
+def _output_name(video: str) -> str:
+    return os.path.splitext(os.path.basename(video))[0]
+
+
+def _timing_metrics(args: argparse.Namespace):
+    from using_skimage.timing_module import TimingMetrics
+
+    return None if args.timing_dir is None else TimingMetrics()
+
+
+def _profiler(args: argparse.Namespace, video: str):
+    from contextlib import nullcontext
+    from using_skimage.profiling_module import StageProfiler
+
+    if args.profile_dir is None:
+        return nullcontext()
+    return StageProfiler(os.path.join(args.profile_dir, f'{_output_name(video)}.{args.command}'),
+                         memory=not args.no_memory_profile)
+
+
+def _export_timing(args: argparse.Namespace, video: str, metrics) -> None:
+    if metrics is not None:
+        os.makedirs(args.timing_dir, exist_ok=True)
+        metrics.export_json(os.path.join(args.timing_dir,
+                                         f'{_output_name(video)}.{args.command}.timing.json'))
+
+
+def count_command(args: argparse.Namespace, video: str) -> None:
+    from using_skimage.io_module import estimate_video_length, test_video_length
+
+    if args.accurate:
+        count = test_video_length(video, debug=not args.quiet)
+    else:
+        count = estimate_video_length(video)
+    print(f'{video}\t{count}')
+
+
+def _tuned_options(args: argparse.Namespace, video: str) -> argparse.Namespace:
+    """
+    Fills in the --workers and --buffer-size options not given with auto-tuned values, or with
+    the cpu count and 25 if auto-tuning is off. The buffer size isn't tuned under a
+    --memory-budget, which sizes the buffer itself.
+
+    """
+
+    budgeted = getattr(args, 'memory_budget', None) is not None
+    if args.workers is not None and (args.buffer_size is not None or budgeted):
+        return args
+    options = argparse.Namespace(**vars(args))
+    if getattr(args, 'no_auto_tune', True):
+        options.workers = args.workers or os.cpu_count() or 1
+        options.buffer_size = args.buffer_size or 25
+        return options
+
+    from autotune_module import auto_tune, DEFAULT_CACHE_PATH
+
+    tuned = auto_tune(video, max_keypoints=args.max_keypoints, min_distance=args.min_distance,
+                      max_distance=args.max_distance, start_index=args.start_index,
+                      max_workers=args.workers,
+                      cache_path=None if args.no_tune_cache else DEFAULT_CACHE_PATH,
+                      debug_msg=not args.quiet)
+    options.workers = tuned['n_workers'] if args.workers is None else args.workers
+    options.buffer_size = (tuned['buffer_size'] if args.buffer_size is None and not budgeted else
+                           args.buffer_size or 25)
+    return options
+
+
+def select_command(args: argparse.Namespace, video: str) -> None:
+    from selection_module import video_selection
+    from using_skimage.executor_module import get_executor
+    from using_skimage.profiling_module import worker_initializer
+
+    args = _tuned_options(args, video)
+
+    checkpoint_path = None
+    if args.checkpoint_dir is not None:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        checkpoint_path = os.path.join(args.checkpoint_dir, _output_name(video) + '.checkpoint')
+
+    metrics = _timing_metrics(args)
+
+    # the pool shuts down first, its workers write their profiles as they exit (dask workers
+    # take no initializer, profiled_call sets them up on their first call)
+    with _profiler(args, video) as profiler, \
+            get_executor(args.executor, args.workers, args.dask_address,
+                         None if profiler is None or args.executor == 'dask' else
+                         worker_initializer) as executor:
+        selected = list(video_selection(video, n_workers=args.workers,
+                                        buffer_size=args.buffer_size,
+                                        max_keypoints=args.max_keypoints,
+                                        min_distance=args.min_distance,
+                                        max_distance=args.max_distance,
+                                        start_index=args.start_index, end_index=args.end_index,
+                                        similarity_percentile=args.similarity_percentile,
+                                        sharpness_percentile=args.sharpness_percentile,
+                                        static_threshold=args.static_threshold,
+                                        coarse_step=args.coarse_step,
+                                        checkpoint_path=checkpoint_path, resume=args.resume,
+                                        executor=executor, metrics=metrics,
+                                        profiler=profiler,
+                                        memory_budget=None if args.memory_budget is None else
+                                        int(args.memory_budget * 2**20),
+                                        debug_msg=not args.quiet, as_generator=True))
+    _export_timing(args, video, metrics)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, _output_name(video) + '.csv')
+    write_csv(output_path, selected)
+    print(f'{video}\t{len(selected)} frames selected\t{output_path}')
+
+
+def batch_select(args: argparse.Namespace, videos: List[str]) -> List[str]:
+    """
+    Runs select on every video through the batch scheduler, returning the failed videos.
+
+    """
+
+    from batch_module import batch_selection
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if not args.no_auto_tune and (args.workers is None or args.buffer_size is None):
+        # one pool and buffer size are shared by videos of any frame size, there is nothing to
+        # calibrate them on
+        print('WARNING: --decoders doesn\'t auto-tune, using the cpu count for --workers and 25 '
+              'for --buffer-size unless they are given', file=sys.stderr)
+
+    def on_result(video, result):
+        if isinstance(result, Exception):
+            print(f'ERROR: {video}\n{result!r}', file=sys.stderr)
+            return
+        output_path = os.path.join(args.output_dir, _output_name(video) + '.csv')
+        write_csv(output_path, result)
+        print(f'{video}\t{len(result)} frames selected\t{output_path}')
+
+    results = batch_selection(videos, n_workers=args.workers, decoders=args.decoders,
+                              on_result=on_result, debug_msg=not args.quiet,
+                              buffer_size=args.buffer_size or 25,
+                              max_keypoints=args.max_keypoints,
+                              min_distance=args.min_distance, max_distance=args.max_distance,
+                              start_index=args.start_index, end_index=args.end_index,
+                              similarity_percentile=args.similarity_percentile,
+                              sharpness_percentile=args.sharpness_percentile,
+                              static_threshold=args.static_threshold)
+    return [video for video, result in results.items() if isinstance(result, Exception)]
+
+
+def writeout_command(args: argparse.Namespace, video: str) -> None:
+    from using_skimage.io_module import save_video_frames
+
+    indexes = read_csv(os.path.join(args.csv_dir, _output_name(video) + '.csv'))
+    output_folder = os.path.join(args.output_dir, _output_name(video))
+    os.makedirs(output_folder, exist_ok=True)
+    metrics = _timing_metrics(args)
+    # save_video_frames is always a generator, consume it
+    with _profiler(args, video) as profiler:
+        for _ in save_video_frames(video, output_folder, indexes, debug_msg=not args.quiet,
+                                   overwrite=args.overwrite, as_generator=True, metrics=metrics,
+                                   profiler=profiler):
+            pass
+    _export_timing(args, video, metrics)
+    print(f'{video}\t{len(indexes)} frames written\t{output_folder}')
+
+
+def analyse_command(args: argparse.Namespace, video: str) -> None:
+    from metrics_module import analyse_video_metrics
+
+    args = _tuned_options(args, video)
+
+    store_path = analyse_video_metrics(video, args.store_dir, n_workers=args.workers,
+                                       max_keypoints=args.max_keypoints,
+                                       buffer_size=args.buffer_size, debug_msg=not args.quiet)
+    print(f'{video}\t{store_path}')
+
+
+def worker_command(args: argparse.Namespace) -> None:
+    from segment_module import create_work_queue, segment_worker
+
+    create_work_queue(args.work_dir)
+    finished = segment_worker(args.work_dir, n_workers=args.workers, buffer_size=args.buffer_size,
+                              poll_interval=args.poll_interval,
+                              exit_when_empty=args.exit_when_empty,
+                              heartbeat_interval=args.heartbeat_interval)
+    print(f'{args.work_dir}\t{finished} segments finished')
+
+
+def benchmark_command(args: argparse.Namespace) -> int:
+    from benchmark_module import (RESOLUTIONS, COLOR_MODES, KERNELS, run_benchmarks,
+                                  save_baseline, load_baseline, compare_to_baseline)
+
+    # validated here against benchmark_module, which isn't imported for the help
+    selection = {}
+    for option, given, known in (('resolutions', args.resolutions, list(RESOLUTIONS)),
+                                 ('modes', args.modes, list(COLOR_MODES)),
+                                 ('kernels', args.kernels, list(KERNELS))):
+        unknown = [name for name in given or [] if name not in known]
+        if unknown:
+            print(f'cli.py benchmark: error: unknown --{option} {", ".join(unknown)} '
+                  f'(choose from {", ".join(known)})', file=sys.stderr)
+            return 2
+        selection[option] = given or known
+
+    results = run_benchmarks(selection['resolutions'], selection['modes'], selection['kernels'],
+                             repeats=args.repeats, debug_msg=not args.quiet)
+    if args.output is not None:
+        save_baseline(results, args.output)
+    if args.save_baseline is not None:
+        save_baseline(results, args.save_baseline)
+        print(f'Saved baseline "{args.save_baseline}"')
+    if args.baseline is not None:
+        regressions = compare_to_baseline(results, load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+        print(f'No regressions against baseline "{args.baseline}"')
+    # a kernel that can't be timed is a failure, with or without a baseline
+    failures = {name: result['error'] for name, result in results['results'].items()
+                if 'error' in result}
+    for name, error in failures.items():
+        print(f'FAILED: {name} {error}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+def throughput_command(args: argparse.Namespace) -> int:
+    from benchmark_module import run_end_to_end, save_baseline, load_baseline, compare_end_to_end
+
+    result = run_end_to_end(args.work_dir, n_workers=args.workers, debug_msg=not args.quiet)
+    if args.output is not None:
+        save_baseline(result, args.output)
+    if args.save_baseline is not None:
+        save_baseline(result, args.save_baseline)
+        print(f'Saved baseline "{args.save_baseline}"')
+    if args.baseline is not None:
+        regressions = compare_end_to_end(result, load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+        print(f'No regressions against baseline "{args.baseline}"')
+    # a kernel that can't be timed is a failure, with or without a baseline
+    failures = {name: result['error'] for name, result in results['results'].items()
+                if 'error' in result}
+    for name, error in failures.items():
+        print(f'FAILED: {name} {error}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Command line argument parser, with a subparser for each command.
+
+    """
+
+    parser = argparse.ArgumentParser(description='Pre-process Structure-from-Motion datasets '
+                                                 'from video, without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, function, help_text):
+        command = commands.add_parser(name, help=help_text, description=help_text)
+        command.set_defaults(function=function)
+        command.add_argument('videos', nargs='*', help='video files to process')
+        command.add_argument('--manifest', help='file listing videos, one per line or a json list')
+        command.add_argument('--quiet', action='store_true', help='no debug messages')
+        return command
+
+    def add_timing_options(command):
+        command.add_argument('--timing-dir', default=None,
+                             help='write per-stage timing metrics of each video into '
+                                  '<video name>.<command>.timing.json files here')
+        command.add_argument('--profile-dir', default=None,
+                             help='profile each stage with cProfile and tracemalloc, writing the '
+                                  'profiles of each video into a <video name>.<command> folder '
+                                  'here')
+        command.add_argument('--no-memory-profile', action='store_true',
+                             help='only profile cpu time with --profile-dir, tracing memory '
+                                  'slows the run down')
+
+    def add_analysis_options(command):
+        command.add_argument('--workers', type=int, default=None,
+                             help='worker processes (default: auto-tuned for select without '
+                                  '--decoders, cpu count otherwise)')
+        command.add_argument('--buffer-size', type=int, default=None,
+                             help='frames loaded into memory at once (default: auto-tuned for '
+                                  'select without --decoders or --memory-budget, 25 otherwise)')
+        command.add_argument('--max-keypoints', type=int, default=1000,
+                             help='keypoint descriptors per frame (default: 1000)')
+
+    command = add_command('count', count_command, 'Print the frame count of videos.')
+    command.add_argument('--accurate', action='store_true',
+                         help='decode and count every frame instead of estimating it from '
+                              'the container metadata')
+
+    command = add_command('select', select_command, 'Select frames from videos into CSV files.')
+    add_analysis_options(command)
+    command.add_argument('--output-dir', required=True,
+                         help='folder to write a <video name>.csv file into for each video')
+    command.add_argument('--min-distance', type=int, default=5)
+    command.add_argument('--max-distance', type=int, default=60)
+    command.add_argument('--start-index', type=int, default=0)
+    command.add_argument('--end-index', type=int, default=None)
+    command.add_argument('--similarity-percentile', type=float, default=0.2)
+    command.add_argument('--sharpness-percentile', type=float, default=0.15)
+    command.add_argument('--static-threshold', type=float, default=None,
+                         help='skip frames with less motion than this (around 0.01)')
+    command.add_argument('--coarse-step', type=int, default=None,
+                         help='coarse-to-fine sampling step (3-5 for high framerate footage)')
+    command.add_argument('--checkpoint-dir', default=None,
+                         help='periodically save the selection state of each video here')
+    command.add_argument('--resume', action='store_true',
+                         help='continue from the checkpoints in --checkpoint-dir')
+    command.add_argument('--decoders', type=int, default=1,
+                         help='videos processed concurrently on one shared worker pool, largest '
+                              'first (default: 1, one video after the other)')
+    command.add_argument('--no-auto-tune', action='store_true',
+                         help='use the cpu count and a buffer of 25 frames for the --workers and '
+                              '--buffer-size not given, instead of calibrating on each video '
+                              '(always the case with --decoders)')
+    command.add_argument('--no-tune-cache', action='store_true',
+                         help='always calibrate, instead of reusing the auto-tuned settings of '
+                              'earlier runs on this machine with the same frame size')
+    command.add_argument('--memory-budget', type=float, default=None,
+                         help='MiB of memory the buffers of each video may use, replacing '
+                              '--buffer-size with what fits')
+    command.add_argument('--executor', default='multiprocessing',
+                         choices=('multiprocessing', 'process', 'thread', 'dask'),
+                         help='backend the workers run on (default: multiprocessing)')
+    command.add_argument('--dask-address', default=None,
+                         help='dask scheduler to run on with --executor dask, instead of a local '
+                              'cluster')
+    add_timing_options(command)
+
+    command = add_command('writeout', writeout_command,
+                          'Write the frames selected in CSV files out as images.')
+    command.add_argument('--csv-dir', required=True,
+                         help='folder with the <video name>.csv file of each video')
+    command.add_argument('--output-dir', required=True,
+                         help='folder to write a <video name> folder of images into for each video')
+    command.add_argument('--overwrite', action='store_true', help='overwrite existing images')
+    add_timing_options(command)
+
+    command = add_command('analyse', analyse_command,
+                          'Store per-frame metrics of videos for offline selection replay.')
+    add_analysis_options(command)
+    command.add_argument('--store-dir', required=True, help='folder holding the metrics stores')
+
+    command = commands.add_parser('worker', help='Run segment jobs from a shared work queue '
+                                                 'directory, see segment_module.')
+    command.set_defaults(function=worker_command)
+    command.add_argument('work_dir', help='work queue directory, shared with the coordinator')
+    command.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                         help='worker processes of each job (default: cpu count)')
+    command.add_argument('--buffer-size', type=int, default=25,
+                         help='frames loaded into memory at once (default: 25)')
+    command.add_argument('--poll-interval', type=float, default=1,
+                         help='seconds between checks for new jobs (default: 1)')
+    command.add_argument('--heartbeat-interval', type=float, default=10,
+                         help='seconds between heartbeats while running a job (default: 10)')
+    command.add_argument('--exit-when-empty', action='store_true',
+                         help='exit when there are no pending jobs instead of waiting')
+
+    command = commands.add_parser('benchmark', help='Benchmark the analysis kernels on synthetic '
+                                                    'frames, optionally against a baseline.')
+    command.set_defaults(function=benchmark_command)
+    command.add_argument('--resolutions', nargs='+', default=None,
+                         help='frame sizes, like 720p, 1080p or 4k (default: all)')
+    command.add_argument('--modes', nargs='+', default=None,
+                         help='gray and/or rgb frames (default: both)')
+    command.add_argument('--kernels', nargs='+', default=None,
+                         help='analysis_module functions to time, like image_descriptors or '
+                              'match_descriptors (default: all)')
+    command.add_argument('--repeats', type=int, default=5,
+                         help='timed calls of each kernel on each input (default: 5)')
+    command.add_argument('--output', default=None, help='write the results into this json file')
+    command.add_argument('--save-baseline', default=None,
+                         help='save the results as a baseline json file')
+    command.add_argument('--baseline', default=None,
+                         help='compare to this baseline, exiting with 1 on regressions')
+    command.add_argument('--tolerance', type=float, default=0.2,
+                         help='allowed slowdown and memory increase against the baseline '
+                              '(default: 0.2, 20%%)')
+    command.add_argument('--quiet', action='store_true', help='no per kernel messages')
+
+    command = commands.add_parser('throughput', help='Benchmark selection and writeout end to end '
+                                                     'on a synthetic video, optionally against a '
+                                                     'baseline.')
+    command.set_defaults(function=throughput_command)
+    command.add_argument('--work-dir', required=True,
+                         help='folder for the synthetic video (made once) and written frames')
+    command.add_argument('--workers', type=int, default=2,
+                         help='worker processes, keep it the same as the baseline (default: 2)')
+    command.add_argument('--output', default=None, help='write the result into this json file')
+    command.add_argument('--save-baseline', default=None,
+                         help='save the result as a baseline json file')
+    command.add_argument('--baseline', default=None,
+                         help='compare to this baseline, exiting with 1 if throughput dropped or '
+                              'the selection changed')
+    command.add_argument('--tolerance', type=float, default=0.2,
+                         help='allowed throughput drop against the baseline (default: 0.2, 20%%)')
+    command.add_argument('--quiet', action='store_true', help='no result messages')
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Runs a command on every video, a failing video doesn't stop the others.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]], optional
+        Command line arguments.
+        The default is None (sys.argv)
+
+    Returns
+    -------
+    int
+        Exit code, 0 if every video succeeded, 1 if any failed and 2 on bad arguments.
+
+    """
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command in ('worker', 'benchmark', 'throughput'):
+        return args.function(args) or 0
+
+    videos = list(args.videos)
+    if args.manifest is not None:
+        videos.extend(read_manifest(args.manifest))
+    if not videos:
+        parser.error('no videos given, pass them as arguments or with --manifest')
+    # outputs are named after the video file name, two videos must not share one
+    by_name = {}
+    for video in videos:
+        by_name.setdefault(_output_name(video), []).append(video)
+    clashes = [paths for paths in by_name.values() if len(paths) > 1]
+    if clashes:
+        parser.error('videos with the same file name would overwrite each others outputs: ' +
+                     '; '.join(', '.join(paths) for paths in clashes))
+
+    failed = []
+    if args.command == 'select' and args.decoders > 1:
+        if args.checkpoint_dir is not None or args.coarse_step is not None:
+            parser.error('--checkpoint-dir and --coarse-step are not supported with --decoders')
+        if (args.executor != 'multiprocessing' or args.timing_dir is not None or
+                args.profile_dir is not None or args.memory_budget is not None):
+            parser.error('--executor, --timing-dir, --profile-dir and --memory-budget are not '
+                         'supported with --decoders')
+        failed = batch_select(args, videos)
+    else:
+        for video in videos:
+            try:
+                args.function(args, video)
+            except Exception:
+                failed.append(video)
+                print(f'ERROR: {video}\n{traceback.format_exc()}', file=sys.stderr)
+
+    if failed:
+        print(f'ERROR: [{len(failed)}/{len(videos)}] videos failed: {", ".join(failed)}',
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,10 +3,13 @@
 import os
 import time
 import multiprocessing as mp
+from contextlib import nullcontext
 
 import PySimpleGUI as sg
 
-from using_skimage.io_module import test_video_length, save_video_frames
+from using_skimage.io_module import test_video_length, estimate_video_length, save_video_frames
+from using_skimage.profiling_module import StageProfiler
+from autotune_module import auto_tune
 from selection_module import video_selection
 
 
@@ -102,6 +105,7 @@ def toggle_buttons_disabling_during_selection(window_object, disabled : bool):
     window_object["__csv_frames_input_browse__"](disabled=disabled)
     window_object["__csv_frames_output_browse__"](disabled=disabled)
     window_object["__start_writeout__"](disabled=disabled)
+    window_object["__profile_browse__"](disabled=disabled)
 
 
 def toggle_buttons_disabling_during_writeout(window_object, disabled : bool):
@@ -114,6 +118,7 @@ def toggle_buttons_disabling_during_writeout(window_object, disabled : bool):
     window_object["__csv_browse__"](disabled=disabled)
     window_object["__csv_frames_input_browse__"](disabled=disabled)
     window_object["__csv_frames_output_browse__"](disabled=disabled)
+    window_object["__profile_browse__"](disabled=disabled)
 
 
 def toggle_input_enable(window_object, disabled: bool = False):
@@ -123,15 +128,17 @@ def toggle_input_enable(window_object, disabled: bool = False):
     window_object["__worker_processes__"](disabled=disabled)
     window_object["__max_distance__"](disabled=disabled)
     window_object["__buffer_size__"](disabled=disabled)
+    window_object["__memory_budget__"](disabled=disabled)
+    window_object["__auto_tune__"](disabled=disabled)
     window_object["__start_index__"](disabled=disabled)
     if not disabled and window_object["__count_frames_info__"].Get().startswith("COUNT"):
         window_object["__end_index__"](disabled=False)
-        window_object["__max_features__"](disabled=False)
     else:
         window_object["__end_index__"](disabled=True)
-        window_object["__max_features__"](disabled=True)
+    window_object["__max_features__"](disabled=disabled)
     window_object["__similarity_percentile__"](disabled=disabled)
     window_object["__sharpness_percentile__"](disabled=disabled)
+    window_object["__profile_dir__"](disabled=disabled)
     # writeout tab
     # window_object["__frames_type__"](disabled=disabled) # NOTE: functionality not implemented
 
@@ -176,39 +183,67 @@ def count_frames(video_path):
     return length
 
 
-def select_frames(values_object, output_q):
+def stage_profiler(values_object, name):
+    # profile into a subfolder of the profile folder, if one was given
+    if not values_object["__profile_dir__"]:
+        return nullcontext()
+    return StageProfiler(os.path.join(values_object["__profile_dir__"], name))
+
+
+def select_frames(values_object, output_q, image_count=None):
 
     end_index = int(values_object["__end_index__"])
+    memory_budget = int(values_object["__memory_budget__"]) * 2**20
+    n_workers = int(values_object["__worker_processes__"])
+    buffer_size = int(values_object["__buffer_size__"])
 
     import signal
 
     try:
-        for frame_idx in video_selection(values_object["__input_source__"],
-                                         n_workers=int(values_object["__worker_processes__"]),
-                                         max_distance=int(values_object["__max_distance__"]),
-                                         buffer_size=int(values_object["__buffer_size__"]),
-                                         start_index=int(values_object["__start_index__"]),
-                                         end_index=end_index if end_index > 0 else None,
-                                         max_keypoints=int(values_object["__max_features__"]),
-                                         similarity_percentile=float(values_object["__sharpness_percentile__"]),
-                                         sharpness_percentile=float(values_object["__similarity_percentile__"]),
-                                         as_generator=True):
-            # break out of loop if termination occours
-            if signal == signal.SIGTERM:
-                break
-            output_q.put(frame_idx)
+        # report an estimated frame count for the progressbar, if frames weren't counted
+        if image_count is None:
+            output_q.put(("ESTIMATE", estimate_video_length(values_object["__input_source__"])))
+
+        # replace the worker count and buffer size with calibrated ones
+        if values_object["__auto_tune__"]:
+            tuned = auto_tune(values_object["__input_source__"],
+                              max_keypoints=int(values_object["__max_features__"]),
+                              max_distance=int(values_object["__max_distance__"]),
+                              start_index=int(values_object["__start_index__"]))
+            n_workers, buffer_size = tuned["n_workers"], tuned["buffer_size"]
+
+        with stage_profiler(values_object, "selection") as profiler:
+            for frame_idx in video_selection(values_object["__input_source__"],
+                                             n_workers=n_workers,
+                                             max_distance=int(values_object["__max_distance__"]),
+                                             buffer_size=buffer_size,
+                                             start_index=int(values_object["__start_index__"]),
+                                             end_index=end_index if end_index > 0 else None,
+                                             max_keypoints=int(values_object["__max_features__"]),
+                                             similarity_percentile=float(values_object["__sharpness_percentile__"]),
+                                             sharpness_percentile=float(values_object["__similarity_percentile__"]),
+                                             image_count=image_count,
+                                             profiler=profiler,
+                                             memory_budget=memory_budget if memory_budget > 0 else None,
+                                             as_generator=True):
+                # break out of loop if termination occours
+                if signal == signal.SIGTERM:
+                    break
+                output_q.put(frame_idx)
     finally:
         output_q.put(None)
 
 
 def csv_video_writeout(values_object, output_q):
 
-    for res in save_video_frames(values_object["__csv_frames_input__"],
-                                 values_object["__csv_frames_output__"],
-                                 read_results_from_csv_file(values_object["__csv_input__"]),
-                                 as_generator=True
-                                 ):
-        output_q.put(res)
+    with stage_profiler(values_object, "writeout") as profiler:
+        for res in save_video_frames(values_object["__csv_frames_input__"],
+                                     values_object["__csv_frames_output__"],
+                                     read_results_from_csv_file(values_object["__csv_input__"]),
+                                     as_generator=True,
+                                     profiler=profiler
+                                     ):
+            output_q.put(res)
     output_q.put(None)
 
 
@@ -283,6 +318,17 @@ if __name__ == "__main__":
                                 enable_events=True),
                        sg.Text("", key="__chunk_size_warning__", size=(71,1))
                        ],
+                      [sg.Text("Memory Budget (MiB)", size=(21,1)),
+                       sg.Input(key="__memory_budget__", size=(8,1), default_text="0",
+                                enable_events=True),
+                       sg.Text("INFO: 0 uses the Buffer Size, otherwise the buffer is sized to fit",
+                               key="__memory_budget_warning__", size=(67,1))
+                       ],
+                      [sg.Checkbox("Auto-tune Worker Processes and Buffer Size", key="__auto_tune__",
+                                   default=False, size=(40,1)),
+                       sg.Text("INFO: Calibrates on the first frames, cached for this machine",
+                               size=(52,1))
+                       ],
                       [sg.Text("Start Index", size=(21,1)),
                        sg.Input(key="__start_index__", size=(8,1), default_text="0",
                                 enable_events=True, disabled=True),
@@ -309,6 +355,12 @@ if __name__ == "__main__":
                                 sg.Input(key="__sharpness_percentile__", size=(4,1),
                                          default_text="0.15", enable_events=True),
                                 sg.Text("", key="__sharpness_percentile_warning__", size=(71,1))
+                                ],
+                               [sg.Text("Profile Folder", size=(21,1)),
+                                sg.Input(key="__profile_dir__", size=(64,1), default_text=""),
+                                sg.FolderBrowse(button_text="Browse", key="__profile_browse__",
+                                                target="__profile_dir__"),
+                                sg.Text("(optional, profiles selection and writeout)", size=(36,1))
                                 ]
                                ]
 
@@ -423,15 +475,28 @@ if __name__ == "__main__":
                         while not process_results["__frame_selection__"].empty():
                             res.append(process_results["__frame_selection__"].get())
 
-                        if res[-1] is None: # check if selection finished
+                        # frame count estimate reported by the selection process
+                        for r in res:
+                            if isinstance(r, tuple) and r[0] == "ESTIMATE":
+                                process_infos["__frame_selection__"]["frame count"] = r[1]
+                                window["__selection_progress__"].update_bar(0, max=r[1])
+                        res = [r for r in res if not isinstance(r, tuple)]
+                        # refine the estimate when selection goes past it
+                        frame_count = process_infos["__frame_selection__"]["frame count"]
+                        if frame_count is not None and res and res[-1] is not None and res[-1] >= frame_count:
+                            frame_count = res[-1] + 1
+                            process_infos["__frame_selection__"]["frame count"] = frame_count
+                            window["__selection_progress__"].update_bar(res[-1], max=frame_count)
+
+                        if res and res[-1] is None: # check if selection finished
                             # end slection co-process
                             terminate_coprocess(process_references["__frame_selection__"])
                             del process_references["__frame_selection__"]
                             del process_results["__frame_selection__"]
                             time_total = time.time() - process_infos["__frame_selection__"]["start time"]
                             # display finishing
-                            maximum = int(window["__count_frames_info__"].Get().split()[1])
-                            window["__selection_progress__"].update_bar(maximum)
+                            maximum = frame_count if frame_count is not None else 1
+                            window["__selection_progress__"].update_bar(maximum, max=maximum)
                             window["__selection_info__"](f'DONE: Frame selection successful! Selected '
                                                          f'{process_infos["__frame_selection__"]["selected count"]}'
                                                          f' in {round(time_total)}s')
@@ -439,13 +504,14 @@ if __name__ == "__main__":
                             toggle_input_enable(window, disabled=False)
                             del maximum, time_total
 
-                        else: # update the progress bar and estimates
+                        elif res: # update the progress bar and estimates
                             window["__selection_progress__"].update_bar(res[-1])
                             process_infos["__frame_selection__"]["selected count"] += 1
                             elapsed = time.time() - process_infos["__frame_selection__"]["start time"]
-                            eta = (elapsed / (res[-1])) * (int(window["__count_frames_info__"].Get().split()[1]) - res[-1])
+                            eta = (elapsed / max(res[-1], 1)) * (frame_count - res[-1])
                             window["__selection_info__"](f'PROC: {res[-1]} / '
-                                                         f'{window["__count_frames_info__"].Get().split()[1]} '
+                                                         f'{"~" if process_infos["__frame_selection__"]["estimated"] else ""}'
+                                                         f'{frame_count} '
                                                          f'frames analyzed | selected '
                                                          f'{process_infos["__frame_selection__"]["selected count"]} '
                                                          f' | estimated time left '
@@ -661,6 +727,18 @@ if __name__ == "__main__":
                 window["__chunk_size_warning__"](error_message)
 
 
+            elif event == "__memory_budget__": # Memory budget changed (int, MiB) ##########################
+                sanitized_input = integer_input_sanitizer(values["__memory_budget__"], 0, 1048576)
+                if sanitized_input != values["__memory_budget__"]:
+                    window["__memory_budget__"](sanitized_input)
+
+                error_message = "INFO: 0 uses the Buffer Size, otherwise the buffer is sized to fit"
+                if 0 < int(sanitized_input) < 512:
+                    error_message = "WARN: Might be too small for the workers on HD or larger video"
+
+                window["__memory_budget_warning__"](error_message)
+
+
             elif event == "__start_index__": # start selection from index ################################
                 _tmp = window["__count_frames_info__"].Get()
                 sanitized_input = integer_input_sanitizer(values["__start_index__"], 0,
@@ -797,11 +875,11 @@ if __name__ == "__main__":
                     # check for running frame count subprocess
                     elif window["__count_frames_info__"].Get().startswith("PROC"):
                         window["__selection_info__"]("ERROR: Wait for the frame counting to finish")
-                    # require frame count, only because progressbar and estimates
-                    elif not window["__count_frames_info__"].Get().startswith("COUNT"):
-                        window["__selection_info__"]("ERROR: Counting frames required due to bad coding")
-                    # start selection subprocess
+                    # start selection subprocess, the frame count is estimated if it wasn't counted
                     else:
+                        frame_count = None
+                        if window["__count_frames_info__"].Get().startswith("COUNT"):
+                            frame_count = int(window["__count_frames_info__"].Get().split()[1])
                         # update button statuses
                         toggle_buttons_disabling_during_selection(window, True)
                         toggle_input_enable(window, disabled=True)
@@ -812,10 +890,14 @@ if __name__ == "__main__":
                         process_results["__frame_selection__"] = mp.Queue()
                         process_references["__frame_selection__"] = mp.Process(target=select_frames,
                                                                                args=(values,
-                                                                                     process_results["__frame_selection__"]))
+                                                                                     process_results["__frame_selection__"],
+                                                                                     frame_count))
                         process_references["__frame_selection__"].start()
                         process_infos["__frame_selection__"] = {"start time" : time.time(),
-                                                                "last done time" : time.time()}
+                                                                "last done time" : time.time(),
+                                                                "frame count" : frame_count,
+                                                                "estimated" : frame_count is None}
+                        del frame_count
                         process_infos["__frame_selection__"]["selected count"] = 0
 
 
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+A collection of functions to store the per-frame analysis results (sharpness, keypoint
+descriptors) of a video on disk, and to replay frame selection over them offline. Selection
+parameters can then be tuned without decoding the video or extracting descriptors again.
+
+A metrics store is a folder named after the video fingerprint and the analysis parameters,
+holding one raw column file per metric, memory mapped when read:
+    meta.json        video path, fingerprint, analysis parameters and the frame count stored
+    sharpness.bin    float64, laplacian sharpness estimate of each frame
+    offsets.bin      int64, first descriptor row of each frame (and one past the last row)
+    descriptors.bin  uint8, bit packed keypoint descriptors of every frame, 32 bytes a row
+"""
+
+# standard library
+from typing import List, Optional, Callable, Dict, Tuple
+import os
+import json
+import timeit
+import hashlib
+import multiprocessing as mp
+
+# installed library
+from numpy import ndarray # for typing only
+import numpy as np
+
+# local library
+from using_skimage.io_module import read_video
+from using_skimage.analysis_module import (image_descriptors, laplace_sharpness_estimate,
+                                           match_descriptors)
+from selection_module import normalized_mse_select
+
+
+DESCRIPTOR_BITS = 256 # ORB descriptors
+METRICS_VERSION = 1
+
+
+def video_fingerprint(fpath: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """
+    Fingerprints a video file by hashing its size with its first and last bytes, which is fast
+    on any file size and does not change when the file is copied or moved.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    chunk_size : int, optional
+        Number of bytes hashed from both the beginning and the end of the file.
+        The default is 4 MiB
+
+    Returns
+    -------
+    str
+        Hexadecimal fingerprint.
+
+    """
+
+    size = os.path.getsize(fpath)
+    sha = hashlib.sha1(str(size).encode())
+    with open(fpath, 'rb') as file:
+        sha.update(file.read(chunk_size))
+        if size > chunk_size:
+            file.seek(max(size - chunk_size, chunk_size))
+            sha.update(file.read(chunk_size))
+    return sha.hexdigest()
+
+
+def metrics_store_path(fpath: str, store_dir: str, max_keypoints: int = 1000) -> str:
+    """
+    Path of the metrics store of a video analysed with the given parameters.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    store_dir : str
+        Folder holding the metrics stores.
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+
+    Returns
+    -------
+    str
+        Path of the metrics store folder, it may not exist yet.
+
+    """
+
+    parameters = json.dumps({'version': METRICS_VERSION, 'max_keypoints': max_keypoints},
+                            sort_keys=True)
+    parameter_hash = hashlib.sha1(parameters.encode()).hexdigest()[:12]
+    return os.path.join(store_dir, f'{video_fingerprint(fpath)}-{parameter_hash}')
+
+
+def _write_meta(store_path: str, meta: dict) -> None:
+    """
+    Atomically writes the meta file of a metrics store.
+
+    """
+
+    temp_path = os.path.join(store_path, 'meta.json.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(meta, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, os.path.join(store_path, 'meta.json'))
+
+
+def analyse_video_metrics(fpath: str, store_dir: str, n_workers: int = 2,
+                          max_keypoints: int = 1000, buffer_size: int = 25,
+                          debug_msg: bool = True) -> str:
+    """
+    Analyses every frame of a video and saves the sharpness estimates and keypoint descriptors
+    into a metrics store. An interrupted analysis continues where it left off, and a complete
+    store is returned immediately.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    store_dir : str
+        Folder holding the metrics stores, created if it doesn't exist.
+    n_workers : int, optional
+        Number of worker processes.
+        The default is 2
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+    buffer_size : int, optional
+        Number of video frames (images) to load into memory at once before they are analyzed.
+        The default is 25
+    debug_msg : bool, optional
+        Print out debug messages.
+        The default is True
+
+    Returns
+    -------
+    str
+        Path of the metrics store.
+
+    """
+
+    if debug_msg:
+        start_time = timeit.default_timer()
+
+    store_path = metrics_store_path(fpath, store_dir, max_keypoints)
+    os.makedirs(store_path, exist_ok=True)
+    meta = {'version': METRICS_VERSION, 'fpath': fpath,
+            'fingerprint': os.path.basename(store_path).split('-')[0],
+            'max_keypoints': max_keypoints, 'frames': 0, 'descriptor_rows': 0,
+            'complete': False}
+    if os.path.isfile(os.path.join(store_path, 'meta.json')):
+        with open(os.path.join(store_path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        if meta['complete']:
+            if debug_msg:
+                print(f'Metrics of [{meta["frames"]}] frames allready stored at "{store_path}"')
+            return store_path
+
+    # drop anything written after the last meta update (run killed mid chunk)
+    columns = {'sharpness': 8, 'offsets': 8, 'descriptors': DESCRIPTOR_BITS // 8}
+    lengths = {'sharpness': meta['frames'], 'offsets': meta['frames'],
+               'descriptors': meta['descriptor_rows']}
+    files = {}
+    for name, row_bytes in columns.items():
+        column_path = os.path.join(store_path, name + '.bin')
+        files[name] = open(column_path, 'ab')
+        files[name].truncate(lengths[name] * row_bytes)
+
+    if debug_msg:
+        print(f'Analysing video from frame [{meta["frames"]}] into "{store_path}"')
+
+    try:
+        reader = read_video(fpath, as_gray=True, start_index=meta['frames'])
+        reader_end = False
+        with mp.Pool(n_workers) as pool:
+            while not reader_end:
+                img_buffer = []
+                while len(img_buffer) < buffer_size:
+                    try:
+                        img_buffer.append(next(reader))
+                    except StopIteration:
+                        reader_end = True
+                        break
+
+                desc = pool.starmap(image_descriptors, [[img, max_keypoints, False]
+                                                        for img in img_buffer])
+                sharp = pool.starmap(laplace_sharpness_estimate, [[img,] for img in img_buffer])
+                del img_buffer
+
+                offsets = meta['descriptor_rows'] + np.cumsum([0] + [len(d) for d in desc])[:-1]
+                files['sharpness'].write(np.asarray(sharp, dtype=np.float64).tobytes())
+                files['offsets'].write(np.asarray(offsets, dtype=np.int64).tobytes())
+                for d in desc:
+                    files['descriptors'].write(np.packbits(d, axis=1).tobytes())
+                for file in files.values():
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                meta['frames'] += len(desc)
+                meta['descriptor_rows'] += sum(len(d) for d in desc)
+                meta['complete'] = reader_end
+                _write_meta(store_path, meta)
+                if debug_msg:
+                    print(f'<<<< Stored metrics of [{meta["frames"]}] frames')
+    finally:
+        for file in files.values():
+            file.close()
+
+    if debug_msg:
+        print(f'!!!! Stored metrics of [{meta["frames"]}] frames in '
+              f'({round(timeit.default_timer() - start_time, 3)} s)')
+    return store_path
+
+
+class FrameMetrics:
+    """
+    Read only, memory mapped view of a metrics store.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the metrics store, see analyse_video_metrics.
+
+    """
+
+    def __init__(self, store_path: str):
+        with open(os.path.join(store_path, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+        self.store_path = store_path
+
+        frames, rows = self.meta['frames'], self.meta['descriptor_rows']
+        self.sharpness = self._column('sharpness', np.float64, (frames,))
+        self.offsets = np.append(self._column('offsets', np.int64, (frames,)), rows)
+        self._descriptors = self._column('descriptors', np.uint8, (rows, DESCRIPTOR_BITS // 8))
+
+    def _column(self, name: str, dtype: type, shape: Tuple[int, ...]) -> ndarray:
+        if shape[0] == 0: # empty files can't be memory mapped
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.store_path, name + '.bin'), dtype=dtype, mode='r',
+                         shape=shape)
+
+    def __len__(self) -> int:
+        return self.meta['frames']
+
+    @property
+    def complete(self) -> bool:
+        """
+        True if every frame of the video is stored.
+
+        """
+        return self.meta['complete']
+
+    @property
+    def keypoints(self) -> ndarray:
+        """
+        Number of keypoint descriptors of each frame.
+
+        """
+        return np.diff(self.offsets)
+
+    def descriptors(self, index: int) -> ndarray:
+        """
+        Keypoint descriptors of a frame, unpacked into the boolean form image_descriptors gives.
+
+        Parameters
+        ----------
+        index : int
+            Frame index.
+
+        Returns
+        -------
+        ndarray
+            Keypoint descriptors.
+
+        """
+
+        packed = self._descriptors[self.offsets[index]:self.offsets[index + 1]]
+        return np.unpackbits(packed, axis=1).astype(bool)
+
+
+def replay_selection(metrics: FrameMetrics, min_distance: int = 5, max_distance: int = 60,
+                     start_index: int = 0, end_index: Optional[int] = None,
+                     selection_function: Callable[..., int] = normalized_mse_select,
+                     match_cache: Optional[Dict[Tuple[int, int], int]] = None,
+                     **selection_kwargs) -> List[int]:
+    """
+    Replays the windowed frame selection of video_selection over stored metrics, selecting the
+    same frames for the same parameters without touching the video.
+
+    Parameters
+    ----------
+    metrics : FrameMetrics
+        Stored metrics of the video.
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+    start_index : int, optional
+        Begin at this frame index.
+        The default is 0
+    end_index : Optional[int], optional
+        Stop at this frame index.
+        The default is None
+    selection_function : Callable[..., int], optional
+        Picks the best fit of a window, called with the list of keypoint matches to the base,
+        the list of sharpness estimates and selection_kwargs, returning the window position.
+        The default is normalized_mse_select
+    match_cache : Optional[Dict[Tuple[int, int], int]], optional
+        Keypoint matches by (base index, frame index), filled in and reused between replays, so
+        parameter sweeps only match each pair of frames once.
+        The default is None
+    **selection_kwargs
+        Passed on to selection_function, like similarity_avg_percent or sharpness_avg_percent.
+
+    Raises
+    ------
+    Exception
+        The store doesn't hold the base frame before the start index, or the store of an
+        unfinished analysis doesn't reach the end index (or the end of the video).
+
+    Returns
+    -------
+    List[int]
+        Selected frame indexes.
+
+    """
+
+    if end_index is not None:
+        assert start_index < end_index, "start index is greater then the end index"
+    assert min_distance < max_distance, "min distance greater then max distance"
+
+    base_index = max(start_index - 1, 0)
+    if base_index >= len(metrics):
+        raise Exception(f'Metrics store has [{len(metrics)}] frames, the start index '
+                        f'[{start_index}] is out of range')
+    if not metrics.complete and (end_index is None or end_index > len(metrics)):
+        raise Exception(f'Metrics store is incomplete with [{len(metrics)}] frames, finish the '
+                        f'analysis or replay with an end index of at most [{len(metrics)}], not '
+                        f'[{end_index}]')
+    if match_cache is None:
+        match_cache = {}
+
+    # the video_selection reader stops after the frame before end_index, or at the end of video
+    if end_index is not None and end_index <= len(metrics):
+        last_index = end_index - 1
+        window_end = lambda base: base + max_distance >= last_index
+    else:
+        last_index = len(metrics) - 1
+        window_end = lambda base: base + max_distance > last_index
+
+    base_descriptor = metrics.descriptors(base_index)
+    selected_indexes = []
+    while True:
+        reader_end = window_end(base_index)
+        window = range(base_index + min_distance + 1, min(base_index + max_distance,
+                                                          last_index) + 1)
+        if len(window) == 0:
+            break
+
+        matches = []
+        for index in window:
+            if (base_index, index) not in match_cache:
+                match_cache[(base_index, index)] = match_descriptors(base_descriptor,
+                                                                     metrics.descriptors(index))
+            matches.append(match_cache[(base_index, index)])
+        selected_idx = window[selection_function(matches, metrics.sharpness[window.start:
+                                                                            window.stop],
+                                                 **selection_kwargs)]
+        selected_indexes.append(selected_idx)
+        base_index = selected_idx
+        base_descriptor = metrics.descriptors(base_index)
+
+        if reader_end:
+            break
+
+    return selected_indexes
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+A pipelined variant of video selection, where decoding, analysis, matching, selection and
+(optionally) writing run concurrently as stages connected by bounded queues:
+
+    decoder thread  --frames-->  analysis dispatcher thread  --results-->  selector
+        (video reader)              (pool: descriptors, sharpness)           |  (pool: matching)
+                                                                             v
+                                                                   writer thread (optional)
+
+A full queue blocks the stage feeding it (backpressure), so memory use stays bounded while the
+worker pool keeps busy during decoding and selection.
+"""
+
+# standard library
+from typing import Optional, Callable, Tuple
+import timeit
+import queue
+import threading
+
+# installed library
+from numpy import ndarray # for typing only
+
+# local library
+from using_skimage.io_module import read_video
+from using_skimage.analysis_module import (image_descriptors, laplace_sharpness_estimate,
+                                           gray_thumbnail, motion_estimate, match_descriptors)
+from using_skimage.executor_module import Executor, executor_context
+from selection_module import normalized_mse_select
+
+
+_END = None # end of stream marker passed through the queues
+_POLL_INTERVAL = 0.1 # seconds between checks of the stop event while blocked on a queue
+
+
+def _put(target: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Puts an item into a bounded queue, blocking while it is full until the stop event is set.
+
+    Returns
+    -------
+    bool
+        False if the pipeline was stopped before the item could be put.
+
+    """
+
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _analyse_frame(frame: ndarray, max_keypoints: int) -> Tuple[ndarray, float]:
+    """
+    Extracts the keypoint descriptors and estimates the sharpness of a video frame.
+
+    Parameters
+    ----------
+    frame : ndarray
+        Video frame (image) loaded into memory.
+    max_keypoints : int
+        Maximum number of keypoint descriptors.
+
+    Returns
+    -------
+    Tuple[ndarray, float]
+        Keypoint descriptors and laplacian sharpness estimate.
+
+    """
+
+    return image_descriptors(frame, max_keypoints, False), laplace_sharpness_estimate(frame)
+
+
+def _decoder_stage(fpath: str, start_index: int, end_index: Optional[int],
+                   static_threshold: Optional[float], motion_downscale: int,
+                   frame_queue: queue.Queue, last_decoded: list,
+                   stop: threading.Event) -> None:
+    """
+    Decoder stage, reads video frames into the frame queue as (index, frame) tuples, skipping
+    static frames, then puts the end marker. The index of the last decoded frame (static or not)
+    is kept in last_decoded[0]. Errors are passed on in place of the end marker.
+
+    """
+
+    try:
+        last_thumbnail = None
+        for frame_index, frame in enumerate(read_video(fpath, as_gray=True,
+                                                       start_index=start_index),
+                                            start=start_index):
+            if stop.is_set() or (end_index is not None and frame_index >= end_index):
+                break
+            last_decoded[0] = frame_index
+            if static_threshold is not None:
+                thumbnail = gray_thumbnail(frame, motion_downscale)
+                if (last_thumbnail is not None and
+                        motion_estimate(last_thumbnail, thumbnail) < static_threshold):
+                    continue
+                last_thumbnail = thumbnail
+            if not _put(frame_queue, (frame_index, frame), stop):
+                return
+        _put(frame_queue, _END, stop)
+    except Exception as error:
+        _put(frame_queue, error, stop)
+
+
+def _analysis_stage(pool: Executor, max_keypoints: int, min_distance: int,
+                    frame_queue: queue.Queue, result_queue: queue.Queue, base: list,
+                    stop: threading.Event) -> None:
+    """
+    Analysis dispatcher stage, submits the frames to the worker pool and puts the pending
+    results into the result queue in frame order. Frames allready too close to the current base
+    (base[0]) are never needed, so they are dropped without analysis, except the first frame
+    which will be the initial base.
+
+    """
+
+    first = True
+    while not stop.is_set():
+        try:
+            item = frame_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if item is _END or isinstance(item, Exception):
+            _put(result_queue, item, stop)
+            return
+        frame_index, frame = item
+        if first or frame_index > base[0] + min_distance:
+            if not _put(result_queue, (frame_index, pool.apply_async(_analyse_frame,
+                                                                     (frame, max_keypoints))),
+                        stop):
+                return
+            first = False
+        del frame
+
+
+def _writer_stage(writer: Callable[[int], None], write_queue: queue.Queue,
+                  errors: list) -> None:
+    """
+    Writer stage, calls writer on every selected index until the end marker. An error of the
+    writer is appended to errors and ends the stage, the selecting thread raises it.
+
+    """
+
+    try:
+        while True:
+            selected_idx = write_queue.get()
+            if selected_idx is _END:
+                return
+            writer(selected_idx)
+    except Exception as error:
+        errors.append(error)
+
+
+def pipeline_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000,
+                       buffer_size: int = 25, min_distance: int = 5, max_distance: int = 60,
+                       start_index: int = 0, end_index: Optional[int] = None,
+                       similarity_percentile: float = 0.2, sharpness_percentile: float = 0.15,
+                       static_threshold: Optional[float] = None, motion_downscale: int = 8,
+                       writer: Optional[Callable[[int], None]] = None,
+                       stage_depths: Optional[dict] = None, pool: Optional[Executor] = None,
+                       debug_msg: bool = True):
+    """
+    Selects the same frames as video_selection, but runs decoding, analysis, matching, selection
+    and writing concurrently. Each window frame is matched to the base as soon as it is analysed,
+    so most of the matching is done by the time the selection window is complete.
+
+    Checkpointing and coarse-to-fine sampling are only supported by video_selection.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    n_workers : int, optional
+        Number of worker processes for analysis and matching.
+        The default is 2
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+    buffer_size : int, optional
+        Capacity of the decoded frame queue, the analysis queue holds twice n_workers results.
+        The default is 25
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+    start_index : int, optional
+        Begin running from this frame index.
+        The default is 0
+    end_index : Optional[int], optional
+        Stop running at this frame index.
+        The default is None
+    similarity_percentile : float, optional
+        See video_selection.
+        The default is 0.2
+    sharpness_percentile : float, optional
+        See video_selection.
+        The default is 0.15
+    static_threshold : Optional[float], optional
+        See video_selection.
+        The default is None
+    motion_downscale : int, optional
+        See video_selection.
+        The default is 8
+    writer : Optional[Callable[[int], None]], optional
+        Called with each selected index from a separate writer thread, for example to save the
+        selected frame to disk.
+        The default is None
+    stage_depths : Optional[dict], optional
+        Updated in place with the current depth of every stage's queue, under the keys
+        'decoded', 'analysing', 'window', 'matching' and 'writing'.
+        The default is None
+    pool : Optional[Executor], optional
+        Use this (shared) worker pool, or any executor of executor_module, for analysis and
+        matching instead of starting one with n_workers processes. It is left running afterwards.
+        The default is None
+    debug_msg : bool, optional
+        Print out debug messages, including the stage queue depths at each selection.
+        The default is True
+
+    Raises
+    ------
+    Exception
+        Reading the video failed, or the error raised by writer.
+
+    Yields
+    ------
+    int
+        Selected frame index.
+
+    """
+
+    if end_index is not None:
+        assert start_index < end_index, "start index is greater then the end index"
+    assert min_distance < max_distance, "min distance greater then max distance"
+
+    if debug_msg:
+        start_time = timeit.default_timer()
+        print(f'Starting pipelined selection from video frames.')
+
+    frame_queue = queue.Queue(maxsize=buffer_size)
+    result_queue = queue.Queue(maxsize=n_workers * 2)
+    write_queue = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    writer_errors = [] # set by the writer stage, raised by the selecting thread
+    # base frame index, shared with the analysis stage to drop frames that will never be needed
+    base = [max(start_index - 1, 0)]
+    # last decoded frame index, set by the decoder stage before its end marker
+    last_decoded = [None]
+
+    if stage_depths is None:
+        stage_depths = {}
+
+    with executor_context(pool, n_workers) as pool:
+        threads = [threading.Thread(target=_decoder_stage, daemon=True,
+                                    args=(fpath, base[0], end_index, static_threshold,
+                                          motion_downscale, frame_queue, last_decoded,
+                                          stop)),
+                   threading.Thread(target=_analysis_stage, daemon=True,
+                                    args=(pool, max_keypoints, min_distance, frame_queue,
+                                          result_queue, base, stop))]
+        if writer is not None:
+            threads.append(threading.Thread(target=_writer_stage, daemon=True,
+                                            args=(writer, write_queue, writer_errors)))
+        for thread in threads:
+            thread.start()
+
+        # window of analysed frames after the base, with their pending base matches
+        index_buffer = []
+        desc_buffer = []
+        sharp_buffer = []
+        match_buffer = []
+        selected_indexes = []
+        base_descriptor = None
+
+        def update_depths():
+            stage_depths.update({'decoded': frame_queue.qsize(),
+                                 'analysing': result_queue.qsize(),
+                                 'window': len(index_buffer),
+                                 'matching': sum(not match.ready() for match in match_buffer),
+                                 'writing': write_queue.qsize()})
+
+        def write(item):
+            # the writer thread stops on an error, so never block on its full queue
+            while not writer_errors:
+                try:
+                    write_queue.put(item, timeout=_POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+            raise writer_errors[0]
+
+        def select():
+            nonlocal base_descriptor
+            matches = [match.get() for match in match_buffer]
+            selected_idx_rel = normalized_mse_select(matches, sharp_buffer,
+                                                     similarity_avg_percent=similarity_percentile,
+                                                     sharpness_avg_percent=sharpness_percentile)
+            selected_idx = index_buffer[selected_idx_rel]
+            base[0] = selected_idx
+            base_descriptor = desc_buffer[selected_idx_rel]
+
+            # keep the frames past the new minimum distance and rematch them to the new base
+            keep = [i for i, idx in enumerate(index_buffer) if idx > selected_idx + min_distance]
+            index_buffer[:] = [index_buffer[i] for i in keep]
+            desc_buffer[:] = [desc_buffer[i] for i in keep]
+            sharp_buffer[:] = [sharp_buffer[i] for i in keep]
+            match_buffer[:] = [pool.apply_async(match_descriptors, (base_descriptor, desc))
+                               for desc in desc_buffer]
+
+            update_depths()
+            if debug_msg:
+                print(f'<<<< Found best fit image at index [{selected_idx}], stage depths '
+                      f'{stage_depths}')
+            selected_indexes.append(selected_idx)
+            if writer is not None:
+                write(selected_idx)
+            return selected_idx
+
+        try:
+            while True:
+                item = result_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                if item is _END:
+                    break
+                frame_index, result = item
+                desc, sharp = result.get()
+
+                if base_descriptor is None: # first frame is the base
+                    base_descriptor = desc
+                    base[0] = frame_index
+                    continue
+
+                # window complete, frame is past the maximum distance of the base
+                while index_buffer and frame_index > base[0] + max_distance:
+                    yield select()
+                if frame_index <= base[0] + min_distance:
+                    continue
+
+                index_buffer.append(frame_index)
+                desc_buffer.append(desc)
+                sharp_buffer.append(sharp)
+                match_buffer.append(pool.apply_async(match_descriptors, (base_descriptor, desc)))
+
+                # every frame of the window was static, select the first one after it
+                if frame_index > base[0] + max_distance:
+                    yield select()
+
+            # like video_selection, a window reaching exactly the last frame of the video is
+            # selected from as complete, then whatever is left after its selection
+            if (index_buffer and last_decoded[0] == base[0] + max_distance and
+                    (end_index is None or last_decoded[0] < end_index - 1)):
+                yield select()
+            # select from whatever is left at the end of the video
+            if index_buffer:
+                yield select()
+        finally:
+            if writer is not None and not writer_errors:
+                try:
+                    write(_END)
+                except Exception: # raised below, unless another error is allready raised
+                    pass
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if writer_errors: # writing the last selections failed
+            raise writer_errors[0]
+
+    if debug_msg:
+        print(f'!!!! End of file, successfully picked {len(selected_indexes)} images in '
+              f'({round(timeit.default_timer() - start_time, 3)} s)')
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+A collection of functions to run video selection on segments of a video in parallel,
+through a simple work queue directory, and stitch the segment results back together.
+
+The work queue directory has a folder for each job state, jobs are small json files:
+    pending/  jobs waiting for a worker
+    running/  jobs claimed by a worker (claiming is an atomic rename)
+    done/     results of the finished jobs
+    failed/   jobs that raised an exception, with the traceback
+Any machine that can see the directory (and the video) can run segment_worker on it, for example
+through 'python cli.py worker WORK_DIR'. Workers keep touching the job file they are running as a
+heartbeat, the coordinator moves jobs whose heartbeat stopped (lost worker) back to pending.
+"""
+
+# standard library
+from typing import List, Optional
+import os
+import json
+import time
+import uuid
+import socket
+import timeit
+import threading
+import traceback
+import multiprocessing as mp
+
+# installed library
+
+# local library
+from using_skimage.io_module import estimate_video_length
+from selection_module import video_selection
+
+
+JOB_STATES = ('pending', 'running', 'done', 'failed')
+
+
+def _write_json(fpath: str, data: dict) -> None:
+    """
+    Atomically writes a json file, through a temporary file renamed over the target.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the json file.
+    data : dict
+        Data to write.
+
+    Returns
+    -------
+    None
+
+    """
+
+    temp_path = f'{fpath}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp_path, fpath)
+
+
+def _read_json(fpath: str) -> dict:
+    """
+    Reads a json file.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the json file.
+
+    Returns
+    -------
+    dict
+        Data read.
+
+    """
+
+    with open(fpath, 'r') as file:
+        return json.load(file)
+
+
+def create_work_queue(work_dir: str) -> None:
+    """
+    Creates the job state folders of a work queue directory.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+
+    Returns
+    -------
+    None
+
+    """
+
+    for state in JOB_STATES:
+        os.makedirs(os.path.join(work_dir, state), exist_ok=True)
+
+
+def submit_job(work_dir: str, name: str, job: dict) -> None:
+    """
+    Adds a job to the work queue.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+    name : str
+        Unique name of the job.
+    job : dict
+        Keyword arguments of video_selection, including 'fpath'.
+
+    Returns
+    -------
+    None
+
+    """
+
+    _write_json(os.path.join(work_dir, 'pending', name + '.json'), job)
+
+
+def claim_job(work_dir: str) -> Optional[str]:
+    """
+    Claims a pending job by renaming it into the running folder. Renaming is atomic, so when
+    several workers race for the same job only one of them gets it.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+
+    Returns
+    -------
+    Optional[str]
+        Name of the claimed job, None if there are no pending jobs.
+
+    """
+
+    for fname in sorted(os.listdir(os.path.join(work_dir, 'pending'))):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            os.rename(os.path.join(work_dir, 'pending', fname),
+                      os.path.join(work_dir, 'running', fname))
+        except FileNotFoundError: # another worker was faster
+            continue
+        return fname[:-len('.json')]
+    return None
+
+
+def _filesystem_time(work_dir: str) -> float:
+    """
+    Current time according to the file system of the work queue directory, by touching a clock
+    file. Heartbeats are file modification times, comparing them to this instead of the local
+    clock keeps clock differences between machines out of the timeouts.
+
+    """
+
+    clock_path = os.path.join(work_dir, 'clock')
+    with open(clock_path, 'a'):
+        pass
+    os.utime(clock_path)
+    return os.stat(clock_path).st_mtime
+
+
+def _heartbeat(fpath: str, interval: float, stop: threading.Event) -> None:
+    """
+    Touches a file every [interval] seconds until stopped, or until the file is gone.
+
+    """
+
+    while not stop.wait(interval):
+        try:
+            os.utime(fpath)
+        except FileNotFoundError: # job was requeued
+            return
+
+
+def _job_names(work_dir: str, state: str, run_id: Optional[str]) -> List[str]:
+    """
+    Names of the jobs in a job state folder, only those of a run if run_id is given.
+
+    """
+
+    prefix = '' if run_id is None else run_id + '_'
+    return [fname[:-len('.json')] for fname in os.listdir(os.path.join(work_dir, state))
+            if fname.endswith('.json') and fname.startswith(prefix)]
+
+
+def requeue_lost_jobs(work_dir: str, timeout: float = 60,
+                      run_id: Optional[str] = None) -> List[str]:
+    """
+    Moves the running jobs without a heartbeat for [timeout] seconds back to pending, so another
+    worker picks them up. Should the lost worker turn out to be alive after all, both write the
+    same result.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+    timeout : float, optional
+        Seconds since the last heartbeat before a job is considered lost.
+        The default is 60
+    run_id : Optional[str], optional
+        Only requeue the jobs of this run (job names starting with it), leaving the jobs of
+        other coordinators sharing the directory to them.
+        The default is None (every job)
+
+    Returns
+    -------
+    List[str]
+        Names of the requeued jobs.
+
+    """
+
+    now = _filesystem_time(work_dir)
+    requeued = []
+    for name in _job_names(work_dir, 'running', run_id):
+        running_path = os.path.join(work_dir, 'running', name + '.json')
+        try:
+            if now - os.stat(running_path).st_mtime < timeout:
+                continue
+            os.rename(running_path, os.path.join(work_dir, 'pending', name + '.json'))
+        except FileNotFoundError: # finished in the meantime
+            continue
+        requeued.append(name)
+    return requeued
+
+
+def cancel_pending_jobs(work_dir: str, run_id: str) -> List[str]:
+    """
+    Removes the pending jobs of a run, so workers don't waste time on a run that failed. Jobs
+    allready running are left to finish.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+    run_id : str
+        Run whose jobs to remove (job names starting with it).
+
+    Returns
+    -------
+    List[str]
+        Names of the removed jobs.
+
+    """
+
+    cancelled = []
+    for name in _job_names(work_dir, 'pending', run_id):
+        try:
+            os.remove(os.path.join(work_dir, 'pending', name + '.json'))
+        except FileNotFoundError: # claimed in the meantime
+            continue
+        cancelled.append(name)
+    return cancelled
+
+
+def segment_worker(work_dir: str, n_workers: int = 2, buffer_size: int = 25,
+                   poll_interval: float = 1, exit_when_empty: bool = True,
+                   heartbeat_interval: float = 10) -> int:
+    """
+    Runs video_selection jobs from a work queue directory until it runs out of them.
+
+    Parameters
+    ----------
+    work_dir : str
+        Path of the work queue directory.
+    n_workers : int, optional
+        Number of worker processes of each video_selection run.
+        The default is 2
+    buffer_size : int, optional
+        Buffer size of each video_selection run.
+        The default is 25
+    poll_interval : float, optional
+        Seconds to wait between checks for new jobs.
+        The default is 1
+    exit_when_empty : bool, optional
+        Return as soon as there are no pending jobs, instead of waiting for new ones.
+        The default is True
+    heartbeat_interval : float, optional
+        Seconds between heartbeats while running a job, keep it well bellow the coordinator's
+        heartbeat timeout.
+        The default is 10
+
+    Returns
+    -------
+    int
+        Number of jobs finished.
+
+    """
+
+    finished = 0
+    worker_name = f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        name = claim_job(work_dir)
+        if name is None:
+            if exit_when_empty:
+                return finished
+            time.sleep(poll_interval)
+            continue
+
+        running_path = os.path.join(work_dir, 'running', name + '.json')
+        try:
+            os.utime(running_path) # renaming kept the submission time
+            job = _read_json(running_path)
+        except FileNotFoundError: # requeued before it could be read
+            continue
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, daemon=True,
+                                     args=(running_path, heartbeat_interval, stop_heartbeat))
+        heartbeat.start()
+        try:
+            selected = list(video_selection(n_workers=n_workers, buffer_size=buffer_size,
+                                            debug_msg=False, as_generator=True, **job))
+        except Exception:
+            _write_json(os.path.join(work_dir, 'failed', name + '.json'),
+                        {'job': job, 'worker': worker_name, 'error': traceback.format_exc()})
+        else:
+            _write_json(os.path.join(work_dir, 'done', name + '.json'),
+                        {'job': job, 'worker': worker_name, 'selected_indexes': selected})
+            finished += 1
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        try:
+            os.remove(running_path)
+        except FileNotFoundError: # requeued meanwhile, the copy in pending is allready done
+            try:
+                os.remove(os.path.join(work_dir, 'pending', name + '.json'))
+            except FileNotFoundError:
+                pass
+
+
+def stitch_segments(fpath: str, first: List[int], second: List[int], boundary: int,
+                    overlap: int, min_distance: int = 5, max_distance: int = 60,
+                    n_workers: int = 2, **kwargs) -> List[int]:
+    """
+    Joins the selections of two neighbouring segments. The first segment's selection is kept up
+    to its last index before the boundary, the second one's from its first index past the
+    overlap, and the frames between those two are selected again, starting from the first
+    segment's last kept frame, so the selection continues smoothly across the boundary.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file.
+    first : List[int]
+        Selected indexes of the earlier segment (allready stitched segments included).
+    second : List[int]
+        Selected indexes of the later segment.
+    boundary : int
+        Frame index where the later segment's core range begins.
+    overlap : int
+        Number of frames the segments overlap by on each side of the boundary.
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+    n_workers : int, optional
+        Number of worker processes.
+        The default is 2
+    **kwargs
+        Other video_selection selection parameters.
+
+    Returns
+    -------
+    List[int]
+        Joined list of selected indexes.
+
+    """
+
+    head = [i for i in first if i < boundary]
+    tail = [i for i in second if i >= boundary + overlap]
+    if not head or not tail:
+        return head + [i for i in second if i >= boundary]
+
+    anchor, target = head[-1], tail[0]
+    middle = []
+    if target - anchor > min_distance:
+        # read a full window past the target, video_selection only picks once at its end index
+        middle = list(video_selection(fpath, start_index=anchor + 1,
+                                      end_index=target + max_distance + 1,
+                                      image_count=target + max_distance - anchor,
+                                      min_distance=min_distance, max_distance=max_distance,
+                                      n_workers=n_workers, debug_msg=False, as_generator=True,
+                                      **kwargs))
+    # drop re-selected frames that would crowd the second segment's first frame
+    middle = [i for i in middle if i <= target - min_distance]
+    return head + middle + tail
+
+
+def segment_selection(fpath: str, work_dir: str, n_segments: int = 4, local_workers: int = 4,
+                      n_workers: int = 1, buffer_size: int = 25, overlap: Optional[int] = None,
+                      start_index: int = 0, end_index: Optional[int] = None,
+                      poll_interval: float = 1, heartbeat_timeout: float = 60,
+                      max_attempts: int = 3, debug_msg: bool = True,
+                      **kwargs) -> List[int]:
+    """
+    Splits the frame range of a video into segments that overlap by [overlap] frames on each
+    side, runs video_selection on every segment independently and stitches them back together.
+
+    Segments are submitted to a work queue directory and [local_workers] processes are started
+    to work through it. Workers on other machines can help by running segment_worker on the same
+    (shared) directory, set local_workers to 0 to leave all the work to them. Segments of workers
+    that stop sending heartbeats (crashed, killed or disconnected) are requeued.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file, workers on other machines must see it on the same path.
+    work_dir : str
+        Path of the work queue directory, created if it doesn't exist.
+    n_segments : int, optional
+        Number of segments to split the video into.
+        The default is 4
+    local_workers : int, optional
+        Number of segment worker processes to start on this machine.
+        The default is 4
+    n_workers : int, optional
+        Number of analysis worker processes of each segment worker.
+        The default is 1
+    buffer_size : int, optional
+        Buffer size of each segment worker.
+        The default is 25
+    overlap : Optional[int], optional
+        Frames the neighbouring segments overlap by on each side of their boundary.
+        The default is None (twice the max_distance)
+    start_index : int, optional
+        Begin at this frame index.
+        The default is 0
+    end_index : Optional[int], optional
+        Stop at this frame index.
+        The default is None
+    poll_interval : float, optional
+        Seconds to wait between checks for finished segments.
+        The default is 1
+    heartbeat_timeout : float, optional
+        Requeue segments whose worker sent no heartbeat for this many seconds.
+        The default is 60
+    max_attempts : int, optional
+        Give up on a segment after it was lost this many times.
+        The default is 3
+    debug_msg : bool, optional
+        Print out debug messages.
+        The default is True
+    **kwargs
+        Other video_selection selection parameters like min_distance, max_distance,
+        max_keypoints, similarity_percentile or sharpness_percentile.
+
+    Raises
+    ------
+    Exception
+        A segment failed or was lost too many times, or every local worker died.
+
+    Returns
+    -------
+    List[int]
+        Selected frame indexes.
+
+    """
+
+    if debug_msg:
+        start_time = timeit.default_timer()
+
+    max_distance = kwargs.get('max_distance', 60)
+    min_distance = kwargs.get('min_distance', 5)
+    if overlap is None:
+        overlap = 2 * max_distance
+
+    frame_end = end_index if end_index is not None else estimate_video_length(fpath)
+    segment_length = max((frame_end - start_index) // n_segments, 1)
+    boundaries = [start_index + i * segment_length for i in range(n_segments)]
+
+    create_work_queue(work_dir)
+    # a fresh id per run keeps results of earlier runs in the same directory from being reused
+    run_id = f'{os.path.splitext(os.path.basename(fpath))[0]}_{uuid.uuid4().hex[:8]}'
+    names = []
+    for number, boundary in enumerate(boundaries):
+        is_last = number == len(boundaries) - 1
+        job = dict(kwargs, fpath=fpath, start_index=max(boundary - overlap, start_index),
+                   end_index=end_index if is_last else boundary + segment_length + overlap,
+                   image_count=segment_length + 2 * overlap)
+        names.append(f'{run_id}_segment_{number:05d}')
+        submit_job(work_dir, names[-1], job)
+    if debug_msg:
+        print(f'>>>> Submitted [{len(names)}] segments of [{segment_length}] frames to '
+              f'"{work_dir}"')
+
+    # local workers wait for requeued segments, they are stopped once every segment is done
+    processes = [mp.Process(target=segment_worker, args=(work_dir, n_workers, buffer_size,
+                                                         poll_interval, False,
+                                                         heartbeat_timeout / 6))
+                 for _ in range(local_workers)]
+    for process in processes:
+        process.start()
+
+    results = {}
+    try:
+        # wait for every segment
+        attempts = {name: 1 for name in names}
+        while len(results) < len(names):
+            for name in names:
+                if name in results:
+                    continue
+                if os.path.isfile(os.path.join(work_dir, 'failed', name + '.json')):
+                    failure = _read_json(os.path.join(work_dir, 'failed', name + '.json'))
+                    raise Exception(f'Segment "{name}" failed on [{failure["worker"]}]:\n'
+                                    f'{failure["error"]}')
+                if os.path.isfile(os.path.join(work_dir, 'done', name + '.json')):
+                    results[name] = _read_json(os.path.join(work_dir, 'done',
+                                                            name + '.json'))['selected_indexes']
+                    if debug_msg:
+                        print(f'<<<< Segment "{name}" finished, '
+                              f'[{len(results)}/{len(names)}] done')
+
+            if len(results) < len(names):
+                for name in requeue_lost_jobs(work_dir, heartbeat_timeout, run_id):
+                    attempts[name] += 1
+                    if attempts[name] > max_attempts:
+                        raise Exception(f'Segment "{name}" was lost [{max_attempts}] times')
+                    if debug_msg:
+                        print(f'!!!! Segment "{name}" lost its worker, requeued for attempt '
+                              f'[{attempts[name]}/{max_attempts}]')
+                if processes and not any(process.is_alive() for process in processes):
+                    raise Exception(f'Local segment workers died with '
+                                    f'[{len(names) - len(results)}] segments unfinished')
+                time.sleep(poll_interval)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        if len(results) < len(names): # failed or interrupted, nobody will collect the rest
+            cancelled = cancel_pending_jobs(work_dir, run_id)
+            if debug_msg and cancelled:
+                print(f'!!!! Removed [{len(cancelled)}] pending segments of the failed run')
+
+    # stitch segments together across their boundaries
+    selected_indexes = results[names[0]]
+    for name, boundary in zip(names[1:], boundaries[1:]):
+        selected_indexes = stitch_segments(fpath, selected_indexes, results[name], boundary,
+                                           overlap, n_workers=max(n_workers, 1),
+                                           **dict(kwargs, min_distance=min_distance,
+                                                  max_distance=max_distance))
+
+    if debug_msg:
+        print(f'!!!! Selected [{len(selected_indexes)}] images from [{len(names)}] segments in '
+              f'({round(timeit.default_timer() - start_time, 3)} s)')
+    return selected_indexes
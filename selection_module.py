@@ -9,18 +9,33 @@ A collection of functions to select images from sequences such as video.
 """
 
 # standard library
-from typing import List, Optional, Iterable, Union
+from typing import List, Optional, Iterable, Union, Tuple
 import timeit
 import warnings
+import os
 import math
+import bisect
+import pickle
+import itertools
+from collections import deque
+try:
+    import resource # unix only, for reporting peak memory
+except ImportError:
+    resource = None
 import multiprocessing as mp
 
 # installed library
+from numpy import ndarray # for typing only
+import numpy as np
 
 # local library
-from using_skimage.io_module import test_video_length, read_video
+from using_skimage.io_module import estimate_video_length, read_video
 from using_skimage.analysis_module import (image_descriptors, laplace_sharpness_estimate,
-                                           base_match_descriptors_parallel)
+                                           base_match_descriptors_parallel, gray_thumbnail,
+                                           motion_estimate, match_descriptors)
+from using_skimage.executor_module import Executor, executor_context
+from using_skimage.timing_module import TimingMetrics, as_metrics, timed_starmap
+from using_skimage.profiling_module import StageProfiler, as_profiler, worker_initializer
 
 
 def plot_results(similarity_estimate: Iterable[Union[float, int]],
@@ -91,8 +106,52 @@ def plot_results(similarity_estimate: Iterable[Union[float, int]],
 
 
 
-def simple_select(similarity_estimate: Iterable[Union[float, int]],
-                  sharpness_estimate: Iterable[Union[float, int]],
+def normalize_estimate(estimate: Union[Iterable[Union[float, int]], ndarray]) -> ndarray:
+    """
+    Scales an estimate so its maximum value is 1.
+
+    Parameters
+    ----------
+    estimate : Union[Iterable[Union[float, int]], ndarray]
+        List or array of estimate values (all positive).
+
+    Returns
+    -------
+    ndarray
+        Normalized float32 array of the estimate values.
+
+    """
+
+    estimate = np.asarray(estimate, dtype=np.float32)
+    maximum = estimate.max()
+    return estimate / maximum if maximum > 0 else estimate
+
+
+def highest_average(values: ndarray, percent: float) -> float:
+    """
+    Calculates the average of the highest X% of values, using a partial sort.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of values.
+    percent : float
+        Percentage of the highest values to include in the average, where 1 is 100%.
+
+    Returns
+    -------
+    float
+        Average of the highest values.
+
+    """
+
+    count = min(max(math.ceil(len(values)*percent), 1), len(values))
+    return float(np.partition(values, len(values) - count)[len(values) - count:].mean())
+
+
+
+def simple_select(similarity_estimate: Union[Iterable[Union[float, int]], ndarray],
+                  sharpness_estimate: Union[Iterable[Union[float, int]], ndarray],
                   debug_plotting: bool = False, debug_plot_index_start: int = 0) -> int:
     """
     Picks the best image index using an extremely simple selection process.
@@ -101,10 +160,10 @@ def simple_select(similarity_estimate: Iterable[Union[float, int]],
 
     Parameters
     ----------
-    similarity_estimate : Iterable[Union[float, int]]
-        List containing how similar images are to a base image.
-    sharpness_estimate : Iterable[Union[float, int]]
-        List containing an estimate of how sharp an image is.
+    similarity_estimate : Union[Iterable[Union[float, int]], ndarray]
+        List or array containing how similar images are to a base image.
+    sharpness_estimate : Union[Iterable[Union[float, int]], ndarray]
+        List or array containing an estimate of how sharp an image is.
     debug_plotting : bool, optional
         Wether to plot the results using matplotlib.
         The default is False
@@ -119,9 +178,10 @@ def simple_select(similarity_estimate: Iterable[Union[float, int]],
 
     """
 
-    goodness_estimate = [sharp / keyp for keyp, sharp in zip(similarity_estimate,
-                                                             sharpness_estimate)]
-    best_fit_index = goodness_estimate.index(max(goodness_estimate))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        goodness_estimate = (np.asarray(sharpness_estimate, dtype=np.float32) /
+                             np.asarray(similarity_estimate, dtype=np.float32))
+    best_fit_index = int(np.argmax(goodness_estimate))
 
     if debug_plotting:
         plot_results(similarity_estimate, sharpness_estimate, goodness_estimate,
@@ -132,8 +192,8 @@ def simple_select(similarity_estimate: Iterable[Union[float, int]],
 
 
 
-def normalized_mse_select(similarity_estimate: Iterable[Union[float, int]],
-                          sharpness_estimate: Iterable[Union[float, int]],
+def normalized_mse_select(similarity_estimate: Union[Iterable[Union[float, int]], ndarray],
+                          sharpness_estimate: Union[Iterable[Union[float, int]], ndarray],
                           similarity_avg_percent: float = 0.2, sharpness_avg_percent: float = 0.15,
                           debug_plotting: bool = False, debug_plot_index_start: int = 0) -> int:
     """
@@ -144,10 +204,10 @@ def normalized_mse_select(similarity_estimate: Iterable[Union[float, int]],
 
     Parameters
     ----------
-    similarity_estimate : Iterable[Union[float, int]]
-        List containing how similar images are to a base image.
-    sharpness_estimate : Iterable[Union[float, int]]
-        List containing an estimate of how sharp each image is.
+    similarity_estimate : Union[Iterable[Union[float, int]], ndarray]
+        List or array containing how similar images are to a base image.
+    sharpness_estimate : Union[Iterable[Union[float, int]], ndarray]
+        List or array containing an estimate of how sharp each image is.
     similarity_avg_percent : float, optional
         Percentage of the highest values to include in average calculation of similarity estimate.
         The default is 0.2
@@ -166,22 +226,17 @@ def normalized_mse_select(similarity_estimate: Iterable[Union[float, int]],
 
     """
 
-    # average
-    norm_sim = [i * (1/max(similarity_estimate)) for i in similarity_estimate]
-    norm_sharp = [i * (1/max(sharpness_estimate)) for i in sharpness_estimate]
+    # normalize
+    norm_sim = normalize_estimate(similarity_estimate)
+    norm_sharp = normalize_estimate(sharpness_estimate)
 
     # average of the X% highest value elements
-    sim_percentile_index = math.ceil(len(norm_sim)*similarity_avg_percent)
-    sim_avg_highest = sum(sorted(norm_sim, reverse=True)[:sim_percentile_index]) / sim_percentile_index
+    sim_avg_highest = highest_average(norm_sim, similarity_avg_percent)
+    sharpness_avg_highest = highest_average(norm_sharp, sharpness_avg_percent)
 
-    # average of the X% highest value elements
-    sharpness_percentile_index = math.ceil(len(norm_sharp)*sharpness_avg_percent)
-    sharpness_highest = sorted(norm_sharp, reverse=True)[:sharpness_percentile_index]
-    sharpness_avg_highest = sum(sharpness_highest) / sharpness_percentile_index
-    goodness_estimate = [(sharp - sharpness_avg_highest)**2 +
-                         (keyp - sim_avg_highest)**2 for sharp, keyp in zip(norm_sharp, norm_sim)]
+    goodness_estimate = (norm_sharp - sharpness_avg_highest)**2 + (norm_sim - sim_avg_highest)**2
 
-    best_fit_index = goodness_estimate.index(min(goodness_estimate))
+    best_fit_index = int(np.argmin(goodness_estimate))
 
     if debug_plotting:
         plot_results(similarity_estimate, sharpness_estimate, goodness_estimate,
@@ -193,12 +248,129 @@ def normalized_mse_select(similarity_estimate: Iterable[Union[float, int]],
 
 
 
-# IDEA: New video selection algorithm
-#     Go through entire video, estimate each frame's sharpness.
-#     For each frame sharpness, select the highest X% from around it (like 60 frames ahead and behind).
-#     Check similarity of the selected frames and remove too similar ones.
-#     Return the now sharpest and not too similar images as list.
+def save_selection_checkpoint(fpath: str, state: dict) -> None:
+    """
+    Atomically writes a video_selection checkpoint to disk. The state is written into a temporary
+    file next to the target first, then renamed over it, so a run killed while writing never
+    leaves a broken checkpoint behind. Keypoint descriptors are stored bit packed.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the checkpoint file.
+    state : dict
+        Selection state to save.
 
+    Returns
+    -------
+    None
+
+    """
+
+    state = dict(state)
+    state['desc_buffer'] = [(np.packbits(desc, axis=1), desc.shape[1])
+                            for desc in state['desc_buffer']]
+    state['base_descriptor'] = (np.packbits(state['base_descriptor'], axis=1),
+                                state['base_descriptor'].shape[1])
+
+    temp_path = fpath + '.tmp'
+    with open(temp_path, 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, fpath)
+
+
+def load_selection_checkpoint(fpath: str) -> dict:
+    """
+    Reads a video_selection checkpoint written by save_selection_checkpoint.
+
+    Parameters
+    ----------
+    fpath : str
+        Path of the checkpoint file.
+
+    Returns
+    -------
+    dict
+        Saved selection state.
+
+    """
+
+    with open(fpath, 'rb') as file:
+        state = pickle.load(file)
+
+    def unpack(packed):
+        bits, length = packed
+        return np.unpackbits(bits, axis=1, count=length).astype(bool)
+
+    state['desc_buffer'] = [unpack(desc) for desc in state['desc_buffer']]
+    state['base_descriptor'] = unpack(state['base_descriptor'])
+    return state
+
+
+# float64 copies of a frame a worker holds at once while extracting its keypoint descriptors
+# (grayscale conversion, image pyramid, filter responses), measured on 720p to 4K frames
+WORKER_FRAME_COPIES = 12
+DESCRIPTOR_BYTES = 256 # an unpacked ORB descriptor, one bool per bit
+
+
+def memory_budget_limits(memory_budget: int, frame_shape: Tuple[int, ...], frame_dtype: type,
+                         n_workers: int = 2, max_keypoints: int = 1000, min_distance: int = 5,
+                         max_distance: int = 60) -> Tuple[int, int, int]:
+    """
+    Converts a memory budget into the buffer size and the number of frames in flight to the
+    workers at once. The budget first covers the fixed costs, the working memory of every worker
+    and a full window of keypoint descriptors, the rest is shared by the image buffer and the
+    frames in flight, which exist twice more (pickled on the way, unpickled in a worker).
+
+    Parameters
+    ----------
+    memory_budget : int
+        Bytes the selection may use.
+    frame_shape : Tuple[int, ...]
+        Shape of the decoded video frames.
+    frame_dtype : type
+        Data type of the decoded video frames.
+    n_workers : int, optional
+        Number of worker processes.
+        The default is 2
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per video frame (image).
+        The default is 1000
+    min_distance : int, optional
+        See video_selection.
+        The default is 5
+    max_distance : int, optional
+        See video_selection.
+        The default is 60
+
+    Raises
+    ------
+    Exception
+        The budget can't hold the fixed costs and a single frame in flight.
+
+    Returns
+    -------
+    Tuple[int, int, int]
+        Buffer size, frames in flight and the fixed bytes (workers and descriptors).
+
+    """
+
+    frame_bytes = int(np.prod(frame_shape)) * np.dtype(frame_dtype).itemsize
+    worker_bytes = n_workers * WORKER_FRAME_COPIES * int(np.prod(frame_shape[:2])) * 8
+    window = max_distance - min_distance
+    fixed_bytes = worker_bytes + (window + 1) * max_keypoints * DESCRIPTOR_BYTES
+
+    remaining = memory_budget - fixed_bytes
+    if remaining < 3 * frame_bytes:
+        raise Exception(f'Memory budget of [{memory_budget}] bytes is too small, [{n_workers}] '
+                        f'workers and the descriptors alone need [{fixed_bytes}] bytes, and '
+                        f'[{3 * frame_bytes}] more are needed for a frame in flight')
+
+    in_flight = max(min(2 * n_workers, window, remaining // (3 * frame_bytes)), 1)
+    buffer_size = min(window, (remaining - 2 * in_flight * frame_bytes) // frame_bytes)
+    return int(buffer_size), int(in_flight), fixed_bytes
 
 
 def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, buffer_size: int = 25,
@@ -206,7 +378,14 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
                     start_index: int = 0, end_index: Optional[int] = None,
                     similarity_percentile: float = 0.2, sharpness_percentile: float = 0.15,
                     debug_msg: bool = True, debug_plots: bool = False,
-                    as_generator: bool = False) -> List[int]:
+                    as_generator: bool = False, static_threshold: Optional[float] = None,
+                    motion_downscale: int = 8, checkpoint_path: Optional[str] = None,
+                    checkpoint_interval: float = 60, resume: bool = False,
+                    coarse_step: Optional[int] = None, coarse_neighbourhoods: Optional[int] = None,
+                    coarse_downscale: int = 1, executor: Optional[Executor] = None,
+                    metrics: Optional[TimingMetrics] = None,
+                    profiler: Optional[StageProfiler] = None,
+                    memory_budget: Optional[int] = None) -> List[int]:
     """
     TODO: make awesome description
 
@@ -233,9 +412,9 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
         The default is 60
     image_count : Optional[int], optional
         The video file contains this many images (frames). This is mainly used for debug
-        messages and if video ends prematurely will cause no errors. If not supplied, video
-        will have it's number of frames counted accurately and that will take several seconds
-        if not minutes on very large videos.
+        messages and if video ends prematurely will cause no errors. If not supplied, it is
+        estimated from the container metadata without decoding (see estimate_video_length)
+        and refined as the video is decoded.
         The default is None.
     start_index : int, optional
         Begin running from this frame index. Useful when resuming previous run or when only a
@@ -263,12 +442,67 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
     as_generator : bool, optional
         Behave like a generator instead of a function, returning the index of each new selected
         frame, raising StopIteration when the function terminates.
+    static_threshold : Optional[float], optional
+        Skip video frames (images) whose motion estimate to the last kept frame is bellow this,
+        collapsing static segments (tripod shots, pauses) into their first frame before any
+        descriptor extraction. Motion is the mean absolute difference of grayscale thumbnails
+        in the range of [0, 1], a value around 0.01 works for most footage.
+        The default is None (no skipping)
+    motion_downscale : int, optional
+        Downscaling factor of the thumbnails used for the motion estimate.
+        The default is 8
+    checkpoint_path : Optional[str], optional
+        Periodically save the selection state (reader position, base frame, buffered scores and
+        selected indexes) to this file, so the run can be resumed if it dies or gets killed.
+        The default is None
+    checkpoint_interval : float, optional
+        Seconds between checkpoints, they are only written right after a frame was selected.
+        The default is 60
+    resume : bool, optional
+        Continue from the checkpoint at checkpoint_path if it exists, seeking directly to where
+        it left off. Only newly selected indexes are yielded, the returned list has all of them.
+        The default is False
+    coarse_step : Optional[int], optional
+        Coarse-to-fine sampling, only estimate the sharpness of every [coarse_step]-th frame of
+        each image buffer first, then extract descriptors (and full sharpness) only for the
+        frames within half a step of the sharpest of those coarse samples. Adjacent frames of
+        high framerate footage are nearly the same, a step of 3-5 cuts descriptor extraction
+        about as many times.
+        The default is None (analyse every frame)
+    coarse_neighbourhoods : Optional[int], optional
+        Number of the sharpest coarse samples per image buffer whose neighbourhood is analysed.
+        The default is None (one per [coarse_step] coarse samples, at least one)
+    coarse_downscale : int, optional
+        Estimate the coarse sharpness on grayscale thumbnails downscaled by this factor.
+        The default is 1 (full resolution)
+    executor : Optional[Executor], optional
+        Run the analysis on this executor (see executor_module), like a thread pool or a dask
+        cluster, instead of a new pool of [n_workers] processes.
+        The default is None
+    metrics : Optional[TimingMetrics], optional
+        Record the duration of the decode, transfer, descriptors, sharpness, matching and
+        selection stages, and count frames, bytes and selections, into this collector.
+        The default is None (no timing)
+    profiler : Optional[StageProfiler], optional
+        Profile the decode, descriptors, sharpness, matching and selection stages with cProfile
+        and tracemalloc, the descriptors and sharpness stages inside the workers.
+        The default is None (no profiling)
+    memory_budget : Optional[int], optional
+        Keep the buffers within this many bytes, replacing buffer_size with what fits the budget
+        for the actual frame size (see memory_budget_limits) and sending only a few frames to
+        the workers at a time. The peak accounted usage, an estimate sampled once per buffer, is
+        reported at the end and recorded into metrics as 'estimated buffered bytes', next to the
+        measured peak resident memory of this process and its finished workers (unix only) as
+        'resident bytes' and 'worker resident bytes'.
+        The default is None (buffer_size frames, all sent at once)
 
     Raises
     ------
     StopIteration
         Premature end of video file. Program will continue to run and not fail.
         Will also raise it if as_generator is set True, as it will behave as a slow.. generator.
+    Exception
+        Resuming from a checkpoint of another video or saved with other selection parameters.
 
     Returns
     -------
@@ -287,7 +521,7 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
         assert start_index < end_index, "start index is greater then the end index"
     assert min_distance < max_distance, "min distance greater then max distance"
 
-    if buffer_size <= n_workers*2:
+    if buffer_size <= n_workers*2 and memory_budget is None:
         warnings.warn(f"Chunk size is less then twice the worker process count. "
                       f"Performace will suffer.")
 
@@ -299,76 +533,234 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
     if debug_msg:
         start_time = timeit.default_timer()
         print(f'Starting simple selection from video frames.')
-
-    # count frames in video if no count supplied
-    if image_count is None:
+    metrics = as_metrics(metrics)
+    profiler = as_profiler(profiler)
+
+    state = None
+    if resume and checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        state = load_selection_checkpoint(checkpoint_path)
+        # the saved buffers and selections are only valid for the same video and parameters
+        current = {'fpath': os.path.abspath(fpath), 'max_keypoints': max_keypoints,
+                   'min_distance': min_distance, 'max_distance': max_distance,
+                   'end_index': end_index, 'similarity_percentile': similarity_percentile,
+                   'sharpness_percentile': sharpness_percentile,
+                   'static_threshold': static_threshold, 'motion_downscale': motion_downscale,
+                   'coarse_step': coarse_step, 'coarse_neighbourhoods': coarse_neighbourhoods,
+                   'coarse_downscale': coarse_downscale}
+        saved = dict(state, fpath=os.path.abspath(state['fpath']))
+        mismatches = [f'{key} [{saved[key]}] (now [{value}])' for key, value in current.items()
+                      if key in saved and saved[key] != value]
+        if mismatches:
+            raise Exception(f'Checkpoint "{checkpoint_path}" was saved with a different '
+                            f'{", ".join(mismatches)}, delete it or resume with the same video '
+                            f'and selection parameters')
+        if image_count is None:
+            image_count = state['image_count']
         if debug_msg:
-            print(f'No image count supplied, starting accurate image count.')
-        tmp_start_time = timeit.default_timer()
-        image_count = test_video_length(fpath, debug=debug_msg)
+            print(f'Resuming from checkpoint at index [{state["reader_index"]}] with '
+                  f'[{len(state["selected_indexes"])}] images allready selected')
+
+    # estimate frames in video if no count supplied, refined while decoding
+    count_estimated = image_count is None
+    if count_estimated:
+        image_count = estimate_video_length(fpath)
         if debug_msg:
-            print(f'[{image_count}] images counted in '
-                  f'({round(timeit.default_timer() - tmp_start_time, 2)} s)')
+            print(f'No image count supplied, estimated [{image_count}] images from metadata')
 
     if debug_msg:
         print(f'Starting analysis and selection of [{image_count}] images')
 
-    reader_end = False
-
-    reader = read_video(fpath, as_gray=True)
-    reader_index = 0
-    if debug_msg:
-        print(f'**** Seeking to start index [{start_index}]')
-    # seek to start index
-    for _ in range(start_index - 1):
-        next(reader)
+    if state is None:
+        reader_end = False
+        # seek directly to the base frame before the start index
+        reader_index = max(start_index - 1, 0)
+        if debug_msg:
+            print(f'**** Seeking to start index [{start_index}]')
+        reader = read_video(fpath, as_gray=True, start_index=reader_index)
+        # set up base image descriptors to match to
+        base_image = next(reader)
+        frame_format = (base_image.shape, base_image.dtype)
+        base_descriptor = image_descriptors(base_image, max_keypoints, False)
+        base_index = reader_index
         reader_index += 1
-    # set up base image descriptors to match to
-    base_descriptor = image_descriptors(next(reader))
-    base_index = reader_index
-    reader_index += 1
+        # thumbnail of the last frame that was not skipped as static
+        last_thumbnail = None if static_threshold is None else gray_thumbnail(base_image,
+                                                                              motion_downscale)
+        del base_image
+        static_count = 0
+
+        desc_buffer = []
+        sharp_buffer = []
+        index_buffer = []
+        selected_indexes = []
+
+    else:
+        reader_end = state['reader_end']
+        reader_index = state['reader_index']
+        if debug_msg:
+            print(f'**** Seeking to checkpoint index [{reader_index}]')
+        reader = read_video(fpath, as_gray=True, start_index=reader_index)
+        frame_format = None
+        if memory_budget is not None and not reader_end:
+            # peek at a frame for its size
+            frame = next(reader, None)
+            if frame is not None:
+                frame_format = (frame.shape, frame.dtype)
+                reader = itertools.chain([frame], reader)
+            del frame
+        base_index = state['base_index']
+        base_descriptor = state['base_descriptor']
+        last_thumbnail = state['last_thumbnail']
+        static_count = state['static_count']
+
+        desc_buffer = state['desc_buffer']
+        sharp_buffer = state['sharp_buffer']
+        index_buffer = state['index_buffer']
+        selected_indexes = state['selected_indexes']
+        del state
 
     if debug_msg:
         print(f'#### Seeking finished')
+
+    in_flight = None
+    buffer_peak = 0
+    if memory_budget is not None and frame_format is not None:
+        buffer_size, in_flight, fixed_bytes = memory_budget_limits(
+            memory_budget, *frame_format, n_workers=n_workers, max_keypoints=max_keypoints,
+            min_distance=min_distance, max_distance=max_distance)
+        frame_bytes = int(np.prod(frame_format[0])) * np.dtype(frame_format[1]).itemsize
+        worker_bytes = fixed_bytes - (max_distance - min_distance + 1) * max_keypoints * \
+            DESCRIPTOR_BYTES
+        if debug_msg:
+            print(f'**** Memory budget of ({round(memory_budget / 2**20)} MiB) allows buffering '
+                  f'[{buffer_size}] frames of ({round(frame_bytes / 2**20, 2)} MiB) with '
+                  f'[{in_flight}] in flight')
     # init global vars in function
     img_buffer = []
-    desc_buffer = []
-    sharp_buffer = []
-    selected_indexes = []
+    img_index_buffer = []
+    last_checkpoint_time = timeit.default_timer()
+
+    def checkpoint():
+        save_selection_checkpoint(checkpoint_path, {
+            'fpath': fpath, 'image_count': image_count, 'max_keypoints': max_keypoints,
+            'min_distance': min_distance, 'max_distance': max_distance, 'end_index': end_index,
+            'similarity_percentile': similarity_percentile,
+            'sharpness_percentile': sharpness_percentile, 'static_threshold': static_threshold,
+            'motion_downscale': motion_downscale, 'coarse_step': coarse_step,
+            'coarse_neighbourhoods': coarse_neighbourhoods, 'coarse_downscale': coarse_downscale,
+            'reader_end': reader_end,
+            'reader_index': reader_index, 'base_index': base_index,
+            'base_descriptor': base_descriptor, 'last_thumbnail': last_thumbnail,
+            'static_count': static_count, 'desc_buffer': desc_buffer,
+            'sharp_buffer': sharp_buffer, 'index_buffer': index_buffer,
+            'selected_indexes': selected_indexes})
 
 
     # run untill out of frames or at end index
-    with mp.Pool(n_workers) as pool: # start pool context manager
+    # profiled workers write their statistics when they exit (see profiling_module)
+    initializer = worker_initializer if profiler.enabled else None
+    with executor_context(executor, n_workers, initializer) as pool: # start pool context manager
         while not reader_end:
 
             if debug_msg:
                 print(f'>><< Starting to fill image buffer with a maximum of [{buffer_size}] images')
                 tmp_start_time = timeit.default_timer()
-            # try and fill Frame buffer from video
-            while len(img_buffer) < buffer_size and (len(img_buffer) + len(desc_buffer) <
-                                                    max_distance - min_distance):
-                try:
-                    if reader_index <= base_index + min_distance:
-                        next(reader)
+            # try and fill Frame buffer from video, until the end of the selection window
+            # (or further if every frame in the window so far was skipped as static)
+            while len(img_buffer) < buffer_size and (reader_index <= base_index + max_distance or
+                                                    not (img_buffer or desc_buffer)):
+                with metrics.time('decode'), profiler.stage('decode'):
+                    try:
+                        frame = next(reader)
+                    except StopIteration:
+                        reader_end = True
+                        break
+                metrics.count('frames decoded')
+                frame_index = reader_index
+                reader_index += 1
+                if count_estimated and reader_index > image_count:
+                    image_count = reader_index
+
+                # collapse static runs into the first frame of the run
+                is_static = False
+                if static_threshold is not None:
+                    thumbnail = gray_thumbnail(frame, motion_downscale)
+                    if motion_estimate(last_thumbnail, thumbnail) < static_threshold:
+                        is_static = True
+                        static_count += 1
                     else:
-                        img_buffer.append(next(reader))
-                    reader_index += 1
-                    if end_index is not None and reader_index >= end_index:
-                        raise StopIteration
-                except StopIteration:
+                        last_thumbnail = thumbnail
+
+                if not is_static and frame_index > base_index + min_distance:
+                    metrics.count('bytes transferred', frame.nbytes)
+                    img_buffer.append(frame)
+                    img_index_buffer.append(frame_index)
+                del frame
+
+                if end_index is not None and reader_index >= end_index:
                     reader_end = True
                     break
 
             if debug_msg:
                 print(f'<<>> Buffered [{len(img_buffer)}] images in '
                       f'({round(timeit.default_timer() - tmp_start_time, 3)} s)')
+                if static_threshold is not None:
+                    print(f'<<>> Skipped [{static_count}] static images so far')
                 print(f'++++ Starting keypoint descriptor extraction and sharpness estimation of '
                       f'[{len(img_buffer)}] images in buffer')
                 tmp_start_time = timeit.default_timer()
 
+            if coarse_step is not None and img_buffer:
+                # coarse pass, sharpness of every coarse_step-th frame only
+                coarse = [i for i, idx in enumerate(img_index_buffer) if idx % coarse_step == 0]
+                if not coarse:
+                    coarse = [len(img_buffer) // 2]
+                if coarse_downscale > 1:
+                    coarse_sharp = pool.starmap(laplace_sharpness_estimate,
+                                                [[gray_thumbnail(img_buffer[i], coarse_downscale),]
+                                                 for i in coarse])
+                else:
+                    coarse_sharp = pool.starmap(laplace_sharpness_estimate,
+                                                [[img_buffer[i],] for i in coarse])
+                n_best = coarse_neighbourhoods
+                if n_best is None:
+                    n_best = max(math.ceil(len(coarse) / coarse_step), 1)
+                best = np.argsort(coarse_sharp)[::-1][:n_best]
+
+                # fine pass only around the sharpest coarse samples
+                radius = coarse_step // 2
+                fine = sorted({i for b in best for i in range(coarse[b] - radius,
+                                                              coarse[b] + radius + 1)
+                               if 0 <= i < len(img_buffer)})
+                if debug_msg:
+                    print(f'++++ Coarse pass kept [{len(fine)}] of [{len(img_buffer)}] images '
+                          f'around [{len(best)}] of [{len(coarse)}] coarse samples')
+                img_buffer = [img_buffer[i] for i in fine]
+                img_index_buffer = [img_index_buffer[i] for i in fine]
+
+            if in_flight is not None:
+                # what is held right now, buffered frames, copies in flight, descriptors, workers
+                buffered = (len(img_buffer) * frame_bytes +
+                            2 * min(in_flight, len(img_buffer)) * frame_bytes +
+                            sum(d.nbytes for d in desc_buffer) + worker_bytes)
+                buffer_peak = max(buffer_peak, buffered)
+                metrics.peak('estimated buffered bytes', buffered)
+
             # calculate sharpness and descriptors for the buffer images, purge buffer
-            desc = pool.starmap(image_descriptors, [[img, max_keypoints,] for img in img_buffer])
-            sharp = pool.starmap(laplace_sharpness_estimate, [[img,] for img in img_buffer])
+            # every frame is unique, caching their descriptors would only cost hashing time
+            # (a few frames at a time within a memory budget)
+            desc, sharp = [], []
+            chunk = len(img_buffer) if in_flight is None else in_flight
+            for first in range(0, len(img_buffer), max(chunk, 1)):
+                desc.extend(timed_starmap(pool, profiler.wrap(image_descriptors, 'descriptors'),
+                                          [[img, max_keypoints, False]
+                                           for img in img_buffer[first:first + chunk]],
+                                          metrics, 'descriptors', n_workers))
+                sharp.extend(timed_starmap(pool, profiler.wrap(laplace_sharpness_estimate,
+                                                               'sharpness'),
+                                           [[img,] for img in img_buffer[first:first + chunk]],
+                                           metrics, 'sharpness', n_workers))
+            metrics.count('frames analysed', len(img_buffer))
 
             del img_buffer
             img_buffer = []
@@ -379,11 +771,14 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
             sharp_buffer.extend(sharp)
             del sharp
 
+            index_buffer.extend(img_index_buffer)
+            img_index_buffer = []
+
             if debug_msg:
                 print(f'---- Finished extraction, sharpness estimate and purged image buffer in'
                       f' ({round(timeit.default_timer() - tmp_start_time, 3)} s)')
 
-            if len(desc_buffer) >= max_distance - min_distance or reader_end:
+            if desc_buffer and (reader_index > base_index + max_distance or reader_end):
                 if debug_msg:
                     print(f'>>>> Selecting best fit from [{len(desc_buffer)}] images '
                           f'with base index [{base_index}]')
@@ -391,42 +786,525 @@ def video_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000, b
                     print(f"++++ Matching [{len(desc_buffer)}] image's descriptors to base...")
 
                 # calculate similarity to base image
-                matches = base_match_descriptors_parallel(base_descriptor, desc_buffer,
-                                                          workers=n_workers)
+                with metrics.time('matching'), profiler.stage('matching'):
+                    matches = base_match_descriptors_parallel(base_descriptor, desc_buffer,
+                                                              executor=pool)
                 if debug_msg:
                     print(f'---- Matching finished in '
                           f'({round(timeit.default_timer() - tmp_start_time, 3)} s)')
 
                 # select best fit index
-                selected_idx_rel = normalized_mse_select(matches, sharp_buffer,
-                                                         debug_plotting=debug_plots,
-                                                         debug_plot_index_start=base_index,
-                                                         similarity_avg_percent=similarity_percentile,
-                                                         sharpness_avg_percent=sharpness_percentile)
-                selected_idx = selected_idx_rel + base_index + min_distance
+                with metrics.time('selection'), profiler.stage('selection'):
+                    selected_idx_rel = normalized_mse_select(
+                        matches, sharp_buffer, debug_plotting=debug_plots,
+                        debug_plot_index_start=index_buffer[0],
+                        similarity_avg_percent=similarity_percentile,
+                        sharpness_avg_percent=sharpness_percentile)
+                metrics.count('selections')
+                selected_idx = index_buffer[selected_idx_rel]
                 if debug_msg:
+                    stop_index = image_count if end_index is None else end_index
+                    elapsed = timeit.default_timer() - start_time
+                    eta = elapsed / max(reader_index - start_index, 1) * max(stop_index -
+                                                                            reader_index, 0)
                     print(f'<<<< Found best fit image at index [{selected_idx}] of '
-                          f'[{image_count if end_index is None else end_index}] total images')
+                          f'[{"~" if count_estimated else ""}{stop_index}] total images, '
+                          f'estimated time left ({round(eta)} s)')
                 selected_indexes.append(selected_idx)
-                if as_generator:
-                    yield selected_idx
 
                 # set new base, remove unneeded data (sharpness and descriptors bellow base index)
                 base_index = selected_idx
                 base_descriptor = desc_buffer[selected_idx_rel]
 
-                deletion_end = selected_idx_rel + 1 + min_distance
-                deletion_end = deletion_end if deletion_end <= len(desc_buffer) else len(desc_buffer)
+                deletion_end = bisect.bisect_right(index_buffer, selected_idx + min_distance)
                 del matches
                 del desc_buffer[:deletion_end]
                 del sharp_buffer[:deletion_end]
+                del index_buffer[:deletion_end]
+
+                if (checkpoint_path is not None and
+                        timeit.default_timer() - last_checkpoint_time >= checkpoint_interval):
+                    checkpoint()
+                    last_checkpoint_time = timeit.default_timer()
+
+                if as_generator:
+                    yield selected_idx
 
             elif debug_msg:
-                print(f'<><> [{len(desc_buffer)}/{max_distance - min_distance}] '
-                      f'images ready for selection, continuing....')
+                print(f'<><> [{len(desc_buffer)}] images ready for selection, window reaches '
+                      f'[{reader_index - 1}/{base_index + max_distance}], continuing....')
+
+    if count_estimated and end_index is None:
+        image_count = reader_index # decoded to the end, the count is exact now
+    if checkpoint_path is not None:
+        checkpoint()
+
+    # measured peaks (ru_maxrss is in KiB), for the children it is the largest worker that has
+    # exited allready, like those of a pool made here
+    if in_flight is not None and resource is not None:
+        resident = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10
+        worker_resident = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 2**10
+        metrics.peak('resident bytes', resident)
+        metrics.peak('worker resident bytes', worker_resident)
 
     if debug_msg:
         print(f'!!!! End of file, successfully picked {len(selected_indexes)} images'
               f' out of [{image_count}] in ({round(timeit.default_timer() - start_time, 3)} s)')
+        if in_flight is not None:
+            print(f'!!!! Estimated peak of the accounted buffers ({round(buffer_peak / 2**20, 1)} '
+                  f'MiB, sampled once per buffer) of the ({round(memory_budget / 2**20, 1)} MiB) '
+                  f'budget' + ('' if resource is None else
+                               f', measured peak resident memory of this process '
+                               f'({round(resident / 2**20, 1)} MiB) and of the largest finished '
+                               f'worker ({round(worker_resident / 2**20, 1)} MiB)'))
     if not as_generator:
-        return selected_indexes
\ No newline at end of file
+        return selected_indexes
+
+
+def resume_video_selection(checkpoint_path: str, **kwargs) -> List[int]:
+    """
+    Resumes a video_selection run from its checkpoint file, using the video path and selection
+    parameters saved in it.
+
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path of the checkpoint file written by video_selection.
+    **kwargs
+        Other video_selection arguments, like n_workers, buffer_size or as_generator.
+        Selection parameters must be the saved ones, video_selection raises on a mismatch.
+
+    Returns
+    -------
+    List[int]
+        See video_selection.
+
+    """
+
+    state = load_selection_checkpoint(checkpoint_path)
+    parameters = {key: state[key] for key in ('image_count', 'max_keypoints', 'min_distance',
+                                              'max_distance', 'end_index',
+                                              'similarity_percentile', 'sharpness_percentile',
+                                              'static_threshold', 'motion_downscale',
+                                              'coarse_step', 'coarse_neighbourhoods',
+                                              'coarse_downscale') if key in state}
+    fpath = state['fpath']
+    del state
+    parameters.update(kwargs)
+    return video_selection(fpath, checkpoint_path=checkpoint_path, resume=True, **parameters)
+
+
+
+def too_similar(desc1: ndarray, desc2: ndarray, max_similarity: float) -> bool:
+    """
+    Tests if two images are too similar, by the ratio of their keypoint descriptor matches to the
+    descriptor count of the image with less keypoints.
+
+    Parameters
+    ----------
+    desc1 : ndarray
+        Image keypoint descriptors.
+    desc2 : ndarray
+        Image keypoint descriptors.
+    max_similarity : float
+        Highest allowed ratio of matches, where 1 is 100% and 0 is 0%.
+
+    Returns
+    -------
+    bool
+        True if the images are too similar.
+
+    """
+
+    keypoints = min(len(desc1), len(desc2))
+    if keypoints == 0:
+        return False
+    return match_descriptors(desc1, desc2) / keypoints > max_similarity
+
+
+def global_selection(fpath: str, n_workers: int = 2, max_keypoints: int = 1000,
+                     buffer_size: int = 25, window: int = 30, max_similarity: float = 0.7,
+                     start_index: int = 0, end_index: Optional[int] = None,
+                     static_threshold: Optional[float] = None, motion_downscale: int = 8,
+                     executor: Optional[Executor] = None, debug_msg: bool = True) -> List[int]:
+    """
+    Two pass global selection of video frames (images).
+
+    The first pass streams through the video once, estimating the sharpness of every frame and
+    keeping only the frames that are the sharpest within [window] frames ahead and behind them.
+    A sliding window maximum (monotonic queue) does this in O(1) amortized time per frame and
+    only holds the frames that can still become a local maximum in memory.
+    Keypoint descriptors are extracted only for these candidates.
+
+    The second pass goes through the candidates from sharpest to least sharp and drops the ones
+    that are too similar to an allready accepted candidate next to them in time.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path to video file
+    n_workers : int, optional
+        Number of worker processes.
+        The default is 2
+    max_keypoints : int, optional
+        Maximum number of keypoint descriptors per candidate frame.
+        The default is 1000
+    buffer_size : int, optional
+        Number of video frames (images) to load into memory at once before their sharpness
+        is estimated.
+        The default is 25
+    window : int, optional
+        A frame is only a candidate if it is the sharpest this many frames ahead and behind it.
+        The default is 30
+    max_similarity : float, optional
+        Highest allowed ratio of keypoint matches between neighbouring selected frames,
+        where 1 is 100% and 0 is 0%. Unrelated images still cross check match around 40%
+        of their keypoints.
+        The default is 0.7
+    start_index : int, optional
+        Begin running from this frame index.
+        The default is 0
+    end_index : Optional[int], optional
+        Stop running at this frame index.
+        The default is None
+    static_threshold : Optional[float], optional
+        Skip frames whose motion estimate to the last kept frame is bellow this,
+        see video_selection.
+        The default is None
+    motion_downscale : int, optional
+        Downscaling factor of the thumbnails used for the motion estimate.
+        The default is 8
+    executor : Optional[Executor], optional
+        Run the analysis on this executor (see executor_module) instead of a new pool of
+        [n_workers] processes.
+        The default is None
+    debug_msg : bool, optional
+        Print out debug messages during function run.
+        The default is True
+
+    Returns
+    -------
+    List[int]
+        Sorted list of selected frame indexes.
+
+    """
+
+    if end_index is not None:
+        assert start_index < end_index, "start index is greater then the end index"
+    assert window > 0, "window must be positive"
+
+    if debug_msg:
+        start_time = timeit.default_timer()
+        print(f'Starting global selection from video frames.')
+
+    reader = read_video(fpath, as_gray=True)
+    reader_index = 0
+    # seek to start index
+    for _ in range(start_index):
+        next(reader)
+        reader_index += 1
+
+    reader_end = False
+    last_thumbnail = None
+    # monotonic queue of [index, sharpness, frame, dominated] with decreasing sharpness,
+    # a frame is dominated if a sharper (or equally sharp) earlier frame is within the window
+    maxima = deque()
+    candidates = {}
+    sharpness = {}
+    frame_count = 0
+
+    with executor_context(executor, n_workers) as pool:
+        # first pass, sharpness estimate and sliding window maximum
+        while not reader_end:
+            img_buffer = []
+            index_buffer = []
+            while len(img_buffer) < buffer_size:
+                try:
+                    frame = next(reader)
+                except StopIteration:
+                    reader_end = True
+                    break
+                frame_index = reader_index
+                reader_index += 1
+
+                is_static = False
+                if static_threshold is not None:
+                    thumbnail = gray_thumbnail(frame, motion_downscale)
+                    if (last_thumbnail is not None and
+                            motion_estimate(last_thumbnail, thumbnail) < static_threshold):
+                        is_static = True
+                    else:
+                        last_thumbnail = thumbnail
+
+                if not is_static:
+                    img_buffer.append(frame)
+                    index_buffer.append(frame_index)
+                del frame
+
+                if end_index is not None and reader_index >= end_index:
+                    reader_end = True
+                    break
+
+            sharp = pool.starmap(laplace_sharpness_estimate, [[img,] for img in img_buffer])
+            frame_count += len(img_buffer)
+
+            for frame_index, frame_sharpness, frame in zip(index_buffer, sharp, img_buffer):
+                # frames out of window can no longer be beaten, decide if they are candidates
+                while maxima and maxima[0][0] + window < frame_index:
+                    old_index, old_sharpness, old_frame, dominated = maxima.popleft()
+                    if not dominated:
+                        sharpness[old_index] = old_sharpness
+                        candidates[old_index] = pool.apply_async(image_descriptors,
+                                                                 (old_frame, max_keypoints, False))
+                while maxima and maxima[-1][1] < frame_sharpness:
+                    maxima.pop()
+                dominated = bool(maxima) and maxima[-1][0] >= frame_index - window
+                maxima.append([frame_index, frame_sharpness, frame, dominated])
+
+            del img_buffer, sharp
+
+            if debug_msg:
+                print(f'<<>> Estimated sharpness up to index [{reader_index - 1}], '
+                      f'[{len(candidates)}] candidates so far')
+
+        for old_index, old_sharpness, old_frame, dominated in maxima:
+            if not dominated:
+                sharpness[old_index] = old_sharpness
+                candidates[old_index] = pool.apply_async(image_descriptors,
+                                                         (old_frame, max_keypoints, False))
+        maxima.clear()
+
+        if debug_msg:
+            print(f'---- First pass found [{len(candidates)}] candidates out of [{frame_count}] '
+                  f'frames in ({round(timeit.default_timer() - start_time, 3)} s)')
+
+        descriptors = {index: result.get() for index, result in candidates.items()}
+
+    # second pass, drop candidates too similar to their sharper accepted neighbours
+    selected_indexes = []
+    for index in sorted(descriptors, key=lambda i: sharpness[i], reverse=True):
+        position = bisect.bisect_left(selected_indexes, index)
+        neighbours = selected_indexes[max(position - 1, 0):position + 1]
+        if not any(too_similar(descriptors[index], descriptors[neighbour], max_similarity)
+                   for neighbour in neighbours):
+            selected_indexes.insert(position, index)
+
+    if debug_msg:
+        print(f'!!!! Successfully picked {len(selected_indexes)} images out of [{frame_count}] in '
+              f'({round(timeit.default_timer() - start_time, 3)} s)')
+    return selected_indexes
+
+
+def _trailing_maximum(values: ndarray, width: int) -> ndarray:
+    """
+    Sliding window maximum over the last [width] values (values before the start count as -inf),
+    built by repeatedly doubling the window so every step is a single vectorized maximum.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of values.
+    width : int
+        Width of the window.
+
+    Returns
+    -------
+    ndarray
+        Maximum of values[i - width + 1 : i + 1] for every i.
+
+    """
+
+    padded = np.concatenate([np.full(width - 1, -np.inf), values])
+    size = 1
+    while size * 2 <= width:
+        np.maximum(padded[size:], padded[:-size], out=padded[size:])
+        size *= 2
+    # padded now holds the maximum of the last [size] values
+    if size == width:
+        return padded[width - 1:]
+    return np.maximum(padded[width - 1:], padded[size - 1:len(padded) - width + size])
+
+
+def _budget_layer(previous: ndarray, sharpness: ndarray, min_distance: int, max_distance: int,
+                  low: int, high: int, allowed: Optional[ndarray] = None) -> ndarray:
+    """
+    Computes the next dynamic programming layer of budget_selection, only between the
+    low and high frame index that can still be part of a complete selection.
+
+    Parameters
+    ----------
+    previous : ndarray
+        Best total sharpness of a selection of k frames ending at each frame.
+    sharpness : ndarray
+        Sharpness estimate of each frame.
+    min_distance : int
+        Smallest allowed distance to the predecessor.
+    max_distance : int
+        Largest allowed distance to the predecessor.
+    low : int
+        First frame index to compute.
+    high : int
+        Last frame index to compute.
+    allowed : Optional[ndarray], optional
+        Whether each frame (row) may follow the frame min_distance + column before it, if not
+        every predecessor min_distance to max_distance before it is allowed.
+        The default is None
+
+    Returns
+    -------
+    ndarray
+        Best total sharpness of a selection of k+1 frames ending at each frame.
+
+    """
+
+    layer = np.full(len(previous), -np.inf)
+    window_start = max(low - max_distance, 0)
+    window_end = high - min_distance + 1
+    if window_end <= window_start:
+        return layer
+
+    if allowed is None:
+        # same sized windows, a sliding maximum shifted by min_distance does it
+        best = _trailing_maximum(previous[window_start:window_end],
+                                 max_distance - min_distance + 1)
+        skip = max(window_start + min_distance - low, 0)
+        layer[low + skip:high + 1] = best[low + skip - min_distance - window_start:]
+        layer[low + skip:high + 1] += sharpness[low + skip:high + 1]
+        return layer
+
+    # the best allowed predecessor, one distance at a time over all frames
+    best = np.full(high - low + 1, -np.inf)
+    frames = np.arange(low, high + 1)
+    for column, distance in enumerate(range(min_distance, max_distance + 1)):
+        predecessors = frames - distance
+        usable = (predecessors >= 0) & allowed[low:high + 1, column]
+        candidate = np.where(usable, previous[np.maximum(predecessors, 0)], -np.inf)
+        np.maximum(best, candidate, out=best)
+    layer[low:high + 1] = best + sharpness[low:high + 1]
+    return layer
+
+
+def budget_selection(sharpness_estimate: Union[Iterable[float], ndarray], count: int,
+                     min_distance: int = 5, max_distance: int = 60,
+                     band_matches: Optional[ndarray] = None, min_matches: int = 0,
+                     max_matches: Optional[int] = None, cover_ends: bool = True) -> List[int]:
+    """
+    Selects exactly [count] frames maximizing their total sharpness, subject to overlap
+    constraints between consecutive selected frames, using dynamic programming over
+    precomputed per-frame scores.
+
+    Consecutive selected frames must be between min_distance and max_distance frames apart.
+    If band matches are given, each pair of consecutive selected frames must also have between
+    min_matches (still enough overlap) and max_matches (not too similar) keypoint matches.
+
+    Each of the [count] layers is solved at once for all frames that can still be part of a
+    complete selection with a vectorized sliding maximum, taking at most O(count * frames) time,
+    or O(count * frames * (max_distance - min_distance)) with band matches, and only
+    O(sqrt(count)) layers are kept in memory for recovering the selection.
+
+    Parameters
+    ----------
+    sharpness_estimate : Union[Iterable[float], ndarray]
+        Sharpness estimate of every frame.
+    count : int
+        Number of frames to select.
+    min_distance : int, optional
+        Smallest allowed distance between consecutive selected frames.
+        The default is 5
+    max_distance : int, optional
+        Largest allowed distance between consecutive selected frames.
+        The default is 60
+    band_matches : Optional[ndarray], optional
+        Keypoint matches between nearby frames, as returned by
+        analysis_module.band_match_descriptors with a band of at least max_distance.
+        The default is None
+    min_matches : int, optional
+        Fewest keypoint matches between consecutive selected frames.
+        The default is 0
+    max_matches : Optional[int], optional
+        Most keypoint matches between consecutive selected frames.
+        The default is None
+    cover_ends : bool, optional
+        Require the first and last selected frames to be within max_distance of the first and
+        last frame, so the selection covers the whole video.
+        The default is True
+
+    Raises
+    ------
+    Exception
+        No selection of [count] frames satisfies the constraints.
+
+    Returns
+    -------
+    List[int]
+        Sorted list of the selected frame indexes.
+
+    """
+
+    assert 0 < min_distance <= max_distance, "min distance greater then max distance"
+    assert count > 0, "count must be positive"
+
+    sharpness = np.asarray(sharpness_estimate, dtype=np.float64)
+    frames = len(sharpness)
+    indexes = np.arange(frames)
+
+    # allowed predecessors of each frame (at min_distance + column), if the keypoint matches
+    # of each pair have to be within the limits
+    allowed = None
+    if band_matches is not None:
+        assert band_matches.shape[1] > max_distance, "band matches are narrower then max distance"
+        distances = np.arange(min_distance, max_distance + 1)
+        rows = indexes[:, None] - distances[None, :]
+        backward = band_matches[np.maximum(rows, 0), distances[None, :]]
+        allowed = (rows >= 0) & (backward >= min_matches)
+        if max_matches is not None:
+            allowed &= backward <= max_matches
+        del rows, backward
+
+    def bounds(k: int) -> Tuple[int, int]:
+        # frames that can be the k-th selected one, leaving room for the others before and after
+        low = (k - 1) * min_distance
+        high = frames - 1 - (count - k) * min_distance
+        if cover_ends:
+            low = max(low, frames - 1 - max_distance - (count - k) * max_distance)
+            high = min(high, k * max_distance)
+        return max(low, 0), min(high, frames - 1)
+
+    low, high = bounds(1)
+    layer = np.full(frames, -np.inf)
+    layer[low:high + 1] = sharpness[low:high + 1]
+
+    # forward pass, keeping every [step]th layer
+    step = max(int(math.sqrt(count)), 1)
+    checkpoints = {1: layer}
+    for k in range(2, count + 1):
+        low, high = bounds(k)
+        if low > high:
+            break
+        layer = _budget_layer(layer, sharpness, min_distance, max_distance, low, high, allowed)
+        if (k - 1) % step == 0:
+            checkpoints[k] = layer
+
+    if not frames or low > high or not np.isfinite(layer).any():
+        raise Exception(f"No selection of [{count}] frames satisfies the distance and "
+                        f"overlap constraints.")
+
+    # backtrack, recomputing the layers after the closest checkpoint
+    selected_indexes = [int(np.argmax(layer))]
+    k = count
+    while k > 1:
+        start = max(c for c in checkpoints if c < k)
+        layers = [checkpoints[start]]
+        for block_k in range(start + 1, k):
+            layers.append(_budget_layer(layers[-1], sharpness, min_distance, max_distance,
+                                        *bounds(block_k), allowed))
+        for layer in reversed(layers):
+            current = selected_indexes[-1]
+            low, high = max(current - max_distance, 0), current - min_distance
+            candidates = layer[low:high + 1].copy()
+            if allowed is not None: # predecessor columns run from min_distance, reversed here
+                candidates[~allowed[current, high - low::-1]] = -np.inf
+            selected_indexes.append(low + int(np.argmax(candidates)))
+        k = start
+
+    return selected_indexes[::-1]
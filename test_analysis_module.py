@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Tests of analysis_module, mainly that the numba compiled kernels give the same results as the
+NumPy and scikit-image path they replace. Run with 'python -m pytest test_analysis_module.py'.
+"""
+
+# installed library
+import numpy as np
+import pytest
+
+# local library
+from using_skimage import analysis_module
+
+
+requires_numba = pytest.mark.skipif(analysis_module.njit is None, reason='numba is not installed')
+
+
+def _both_paths(monkeypatch, function, *args):
+    monkeypatch.setattr(analysis_module, 'USE_JIT', True)
+    jit = function(*args)
+    monkeypatch.setattr(analysis_module, 'USE_JIT', False)
+    return jit, function(*args)
+
+
+@requires_numba
+def test_match_descriptors(monkeypatch):
+    rng = np.random.default_rng(0)
+    base = rng.random((300, 256)) > 0.5
+    for rows in (300, 120, 1):
+        # similar descriptors (a few flipped bits) mixed with unrelated ones
+        other = base[:rows] ^ (rng.random((rows, 256)) > 0.97)
+        other[::3] = rng.random((len(other[::3]), 256)) > 0.5
+        jit, reference = _both_paths(monkeypatch, analysis_module.match_descriptors, base, other)
+        assert jit == reference
+
+
+@requires_numba
+def test_match_descriptors_empty(monkeypatch):
+    base = np.random.default_rng(1).random((50, 256)) > 0.5
+    empty = np.zeros((0, 256), dtype=bool)
+    jit, reference = _both_paths(monkeypatch, analysis_module.match_descriptors, base, empty)
+    assert jit == reference == 0
+
+
+@requires_numba
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float64, bool])
+def test_laplace_sharpness_estimate(monkeypatch, dtype):
+    rng = np.random.default_rng(2)
+    if dtype is bool:
+        image = rng.random((48, 64)) > 0.5
+    elif dtype is np.float64:
+        image = rng.random((48, 64))
+    else:
+        image = rng.integers(0, np.iinfo(dtype).max, (48, 64), dtype=dtype, endpoint=True)
+    jit, reference = _both_paths(monkeypatch, analysis_module.laplace_sharpness_estimate, image)
+    assert jit == pytest.approx(reference, rel=1e-9)
+
+
+@requires_numba
+def test_laplace_sharpness_estimate_rgb(monkeypatch):
+    image = np.random.default_rng(3).integers(0, 255, (48, 64, 3), dtype=np.uint8, endpoint=True)
+    jit, reference = _both_paths(monkeypatch, analysis_module.laplace_sharpness_estimate, image)
+    assert jit == pytest.approx(reference, rel=1e-9)
+
+
+@requires_numba
+def test_gray(monkeypatch):
+    image = np.random.default_rng(4).integers(0, 255, (48, 64, 3), dtype=np.uint8, endpoint=True)
+    jit, reference = _both_paths(monkeypatch, analysis_module.gray, image)
+    np.testing.assert_allclose(jit, reference, rtol=1e-12, atol=1e-12)
+
+
+def test_match_matrices_with_missing_descriptors():
+    rng = np.random.default_rng(5)
+    descriptors = [rng.random((40, 256)) > 0.5 for _ in range(5)]
+    descriptors[2] = None
+    matrix = analysis_module.all_pairs_match_descriptors(descriptors, workers=1, block_size=2)
+    band = analysis_module.band_match_descriptors(descriptors, 2, workers=1, block_size=2)
+    assert not matrix[2].any() and not matrix[:, 2].any()
+    assert not band[2].any() and band[1, 1] == 0 and band[0, 2] == 0
+    assert matrix[0, 1] == band[0, 1] == analysis_module.match_descriptors(descriptors[0],
+                                                                           descriptors[1])
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Tests of pipeline_module, that the pipelined selection picks the same frames as video_selection.
+Run with 'python -m pytest test_pipeline_module.py'.
+"""
+
+# installed library
+import pytest
+
+# local library
+from benchmark_module import synthesize_video
+from selection_module import video_selection
+from pipeline_module import pipeline_selection
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp('video') / 'synthetic.mp4')
+    synthesize_video(fpath, n_frames=120, resolution=(240, 320),
+                     static_segments=((30, 45), (80, 95)))
+    return fpath
+
+
+@pytest.mark.parametrize('static_threshold', [None, 0.01])
+@pytest.mark.parametrize('end_index', [None, 100])
+def test_pipeline_matches_video_selection(video, static_threshold, end_index):
+    parameters = dict(n_workers=2, max_keypoints=200, min_distance=3, max_distance=20,
+                      end_index=end_index, static_threshold=static_threshold, debug_msg=False)
+    expected = list(video_selection(video, as_generator=True, **parameters))
+    assert list(pipeline_selection(video, **parameters)) == expected
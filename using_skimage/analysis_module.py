@@ -9,18 +9,143 @@ A collection of functions to analyze image data.
 """
 
 # standard library
-from typing import Union, List, Iterable
+from typing import Union, List, Iterable, Optional, Tuple, Dict
+from collections import OrderedDict
 import warnings
+import hashlib
+import threading
 import multiprocessing as mp
 
 # installed library
+from skimage import __version__ as skimage_version
 from skimage.feature import ORB, match_descriptors as match, canny
 from skimage.color import rgb2gray
 from skimage.metrics import structural_similarity as ssim
-from skimage.filters import laplace, gaussian
+from skimage.filters import gaussian
+from scipy.ndimage import uniform_filter, convolve
 from numpy import ndarray # for typing only
 import numpy as np
 
+# local library
+from using_skimage.executor_module import Executor, executor_context
+
+# optional library
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Use the numba compiled kernels when numba is installed. Set to False to force the NumPy path.
+USE_JIT = njit is not None
+
+_LAPLACE_KERNEL = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]], dtype=np.float64)
+
+# scikit-image 0.19 replaced the multichannel argument with channel_axis, 0.21 removed it
+_USE_CHANNEL_AXIS = tuple(int(part) for part in skimage_version.split('.')[:2]) >= (0, 19)
+
+
+def _channel_arguments(multichannel: bool) -> dict:
+    """
+    Keyword arguments telling a scikit-image function whether the last axis holds the color
+    channels, in the form the installed version takes.
+
+    """
+
+    if _USE_CHANNEL_AXIS:
+        return {'channel_axis': -1 if multichannel else None}
+    return {'multichannel': multichannel}
+
+
+# JIT compiled kernels ###########################################################################
+# Fused loops without temporary arrays, compiled with nogil so they can run in threads.
+
+if njit is not None:
+
+    @njit(nogil=True, cache=True)
+    def _gray_jit(image):
+        height, width = image.shape[0], image.shape[1]
+        result = np.empty((height, width), dtype=np.float64)
+        for y in range(height):
+            for x in range(width):
+                result[y, x] = (image[y, x, 0] / 255.0 * 0.2125 + image[y, x, 1] / 255.0 * 0.7154 +
+                                image[y, x, 2] / 255.0 * 0.0721)
+        return result
+
+    @njit(nogil=True, cache=True)
+    def _laplace_variance_jit(image):
+        # 3x3 laplacian with 'reflect' borders, which for a radius of 1 is edge clamping
+        height, width = image.shape
+        total = 0.0
+        total_sq = 0.0
+        for y in range(height):
+            up = max(y - 1, 0)
+            down = min(y + 1, height - 1)
+            for x in range(width):
+                left = max(x - 1, 0)
+                right = min(x + 1, width - 1)
+                value = (4.0 * image[y, x] - image[up, x] - image[down, x] -
+                         image[y, left] - image[y, right])
+                total += value
+                total_sq += value * value
+        count = height * width
+        mean = total / count
+        return total_sq / count - mean * mean
+
+    @njit(nogil=True, cache=True)
+    def _popcount64(value):
+        value = value - ((value >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        value = ((value & np.uint64(0x3333333333333333)) +
+                 ((value >> np.uint64(2)) & np.uint64(0x3333333333333333)))
+        value = (value + (value >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (value * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+    @njit(nogil=True, cache=True)
+    def _match_count_jit(packed1, packed2):
+        # cross checked nearest neighbour matching on hamming distance, without distance matrix
+        n1, n2, words = packed1.shape[0], packed2.shape[0], packed1.shape[1]
+        best_for_1 = np.zeros(n1, dtype=np.int64)
+        best_dist_1 = np.full(n1, np.iinfo(np.int64).max, dtype=np.int64)
+        best_for_2 = np.zeros(n2, dtype=np.int64)
+        best_dist_2 = np.full(n2, np.iinfo(np.int64).max, dtype=np.int64)
+        for i in range(n1):
+            for j in range(n2):
+                distance = 0
+                for w in range(words):
+                    distance += _popcount64(packed1[i, w] ^ packed2[j, w])
+                if distance < best_dist_1[i]:
+                    best_dist_1[i] = distance
+                    best_for_1[i] = j
+                if distance < best_dist_2[j]:
+                    best_dist_2[j] = distance
+                    best_for_2[j] = i
+        count = 0
+        for i in range(n1):
+            if best_for_2[best_for_1[i]] == i:
+                count += 1
+        return count
+
+
+def _pack_descriptors(descriptors: ndarray) -> ndarray:
+    """
+    Packs boolean keypoint descriptors into uint64 words for the JIT hamming kernels.
+
+    Parameters
+    ----------
+    descriptors : ndarray
+        Boolean keypoint descriptors.
+
+    Returns
+    -------
+    ndarray
+        Packed descriptors, shape (N, words).
+
+    """
+
+    packed = np.packbits(np.asarray(descriptors, dtype=bool), axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
 
 
 
@@ -43,7 +168,7 @@ def blur_image(image: ndarray, strength: float = 1) -> ndarray:
 
     """
 
-    return gaussian(image, multichannel=not test_image_grayness(image), sigma=strength)
+    return gaussian(image, sigma=strength, **_channel_arguments(not test_image_grayness(image)))
 
 
 def test_image_grayness(image: ndarray) -> bool:
@@ -95,13 +220,129 @@ def gray(image: ndarray) -> ndarray:
     if test_image_grayness(image):
         return image
     elif np.shape(image)[2] == 3:
+        if USE_JIT and image.dtype == np.uint8:
+            return _gray_jit(image)
         return rgb2gray(image)
     else:
         raise Exception("Image was not grayscale, neither did it have 3 color channels. "
                         "This only supports rgb conversion.")
 
 
-def image_descriptors(image: ndarray, num_keypoints: int = 500) -> ndarray:
+class DescriptorCache:
+    """
+    Least recently used cache of keypoint descriptors, bounded by the bytes of the cached
+    descriptors. Keys are a hash of the image content together with the ORB parameters.
+    Every process has its own cache, worker processes of a pool don't share it. Threads of a
+    process (like the workers of a thread executor) share it, every operation holds a lock.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Evict the least recently used descriptors when the cache grows beyond this.
+        The default is 64 MiB
+
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image: ndarray, num_keypoints: int) -> Tuple:
+        """
+        Cache key of an image and the ORB parameters.
+
+        """
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest()
+        return digest, image.shape, image.dtype.str, num_keypoints
+
+    def get(self, key: Tuple) -> Optional[ndarray]:
+        """
+        Cached descriptors of a key, None when they aren't cached.
+
+        """
+        with self._lock:
+            descriptors = self._entries.get(key)
+            if descriptors is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return descriptors
+
+    def put(self, key: Tuple, descriptors: ndarray) -> None:
+        """
+        Caches descriptors, evicting the least recently used ones to stay within max_bytes.
+        The cached array is made read only, as every hit returns the same array.
+
+        """
+        with self._lock:
+            if descriptors.nbytes > self.max_bytes or key in self._entries:
+                return
+            descriptors.flags.writeable = False
+            self._entries[key] = descriptors
+            self.nbytes += descriptors.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        """
+        Empties the cache and resets the statistics.
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit and miss counts, number of cached entries and their size in bytes.
+
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+# descriptor cache consulted by image_descriptors, set its max_bytes to 0 to disable it
+descriptor_cache = DescriptorCache()
+
+
+def descriptor_cache_stats() -> Dict[str, int]:
+    """
+    Statistics of this process' descriptor cache, see DescriptorCache.stats.
+
+    Returns
+    -------
+    Dict[str, int]
+        Hits, misses, entries, bytes and max_bytes.
+
+    """
+
+    return descriptor_cache.stats()
+
+
+def clear_descriptor_cache() -> None:
+    """
+    Empties this process' descriptor cache and resets its statistics.
+
+    Returns
+    -------
+    None
+
+    """
+
+    descriptor_cache.clear()
+
+
+def image_descriptors(image: ndarray, num_keypoints: int = 500, use_cache: bool = True) -> ndarray:
     """
     Calculates and image's keypoint descriptors.
 
@@ -112,6 +353,10 @@ def image_descriptors(image: ndarray, num_keypoints: int = 500) -> ndarray:
     num_keypoints : int, optional
         Maximum number of keypoints and descriptors to calculate.
         The default is 500
+    use_cache : bool, optional
+        Look up and store the descriptors in the descriptor cache, so the same image is only
+        analysed once. Cached descriptors are read only.
+        The default is True
 
     Returns
     -------
@@ -120,8 +365,17 @@ def image_descriptors(image: ndarray, num_keypoints: int = 500) -> ndarray:
 
     """
 
+    use_cache = use_cache and descriptor_cache.max_bytes > 0
+    if use_cache:
+        key = DescriptorCache.key(image, num_keypoints)
+        descriptors = descriptor_cache.get(key)
+        if descriptors is not None:
+            return descriptors
+
     orb = ORB(n_keypoints=num_keypoints)
     orb.detect_and_extract(gray(image))
+    if use_cache:
+        descriptor_cache.put(key, orb.descriptors)
     return orb.descriptors
 
 
@@ -143,6 +397,10 @@ def match_descriptors(desc1: ndarray, desc2: ndarray) -> int:
         Number of matches between the two image keypoint descriptors.
 
     """
+    if len(desc1) == 0 or len(desc2) == 0: # skimage's match raises on empty descriptors
+        return 0
+    if USE_JIT:
+        return _match_count_jit(_pack_descriptors(desc1), _pack_descriptors(desc2))
     return len(match(desc1, desc2))
 
 
@@ -211,11 +469,212 @@ def ssim_images(image1: ndarray, image2: ndarray) -> float:
             image2 = gray(image2)
             is_gray2 = True
 
-    elif np.shape(image1)[2] != np.shape(image2)[2]:
+    elif not is_gray1 and np.shape(image1)[2] != np.shape(image2)[2]:
         raise Exception(f'Input images are multichannel and have different amount of color channels'
                         f', this is unsupported')
 
-    return ssim(image1, image2, multichannel=is_gray1)
+    return ssim(image1, image2, **_channel_arguments(not is_gray1))
+
+
+def gray_thumbnail(image: ndarray, downscale: int = 8) -> ndarray:
+    """
+    Creates a small grayscale float32 version of an image in the range of [0, 1], by averaging
+    each downscale x downscale pixel block. Downscaling happens before the grayscale conversion
+    so it stays cheap on full resolution color frames.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image array, either grayscale or RGB.
+    downscale : int, optional
+        Integer downscaling factor, 1 keeps the original resolution.
+        The default is 8
+
+    Returns
+    -------
+    ndarray
+        Downscaled float32 grayscale image.
+
+    """
+
+    scale = np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.integer) else 1
+    if downscale > 1:
+        height = image.shape[0] - image.shape[0] % downscale
+        width = image.shape[1] - image.shape[1] % downscale
+        image = image[:height, :width].reshape(height // downscale, downscale,
+                                               width // downscale, downscale,
+                                               *image.shape[2:]).mean(axis=(1, 3), dtype=np.float32)
+    else:
+        image = image.astype(np.float32)
+    if scale != 1:
+        image /= scale
+
+    image = gray(image)
+    if image.ndim == 3:
+        image = image[:, :, 0]
+    return image.astype(np.float32, copy=False)
+
+
+def motion_estimate(thumbnail1: ndarray, thumbnail2: ndarray) -> float:
+    """
+    Estimates how much the camera or scene moved between two frames, as the mean absolute
+    difference of their thumbnails. (0 is identical, higher is more motion)
+
+    Parameters
+    ----------
+    thumbnail1 : ndarray
+        Frame thumbnail, as returned by gray_thumbnail.
+    thumbnail2 : ndarray
+        Frame thumbnail, as returned by gray_thumbnail.
+
+    Returns
+    -------
+    float
+        Mean absolute difference of the two thumbnails.
+
+    """
+
+    return float(np.abs(thumbnail1 - thumbnail2).mean())
+
+
+def ssim_prepare(image: ndarray, downscale: int = 2) -> ndarray:
+    """
+    Converts an image into the form used by the SSIM fast path, see gray_thumbnail.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image array, either grayscale or RGB.
+    downscale : int, optional
+        Integer downscaling factor, 1 keeps the original resolution.
+        The default is 2
+
+    Returns
+    -------
+    ndarray
+        Downscaled float32 grayscale image.
+
+    """
+
+    return gray_thumbnail(image, downscale)
+
+
+def ssim_pivot_statistics(pivot: ndarray, win_size: int = 7) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Precomputes the local statistics of a pivot image used in every SSIM comparison against it.
+
+    Parameters
+    ----------
+    pivot : ndarray
+        Pivot image, as returned by ssim_prepare.
+    win_size : int, optional
+        Side length of the sliding window the local statistics are calculated in.
+        The default is 7
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray, ndarray]
+        The pivot image, its local means and its local (sample) variances.
+
+    """
+
+    cov_norm = win_size**2 / (win_size**2 - 1)
+    mean = uniform_filter(pivot, size=win_size)
+    variance = cov_norm * (uniform_filter(pivot * pivot, size=win_size) - mean * mean)
+    return pivot, mean, variance
+
+
+def ssim_to_pivot(pivot: ndarray, images: Iterable[ndarray], downscale: int = 2,
+                  batch_size: int = 16, win_size: int = 7) -> List[float]:
+    """
+    Calculates the structural similarity of each image to a single pivot image.
+    The pivot's local statistics are only computed once, the images are converted to
+    downscaled float32 grayscale and compared in batches.
+    Matches skimage's structural_similarity of the prepared (see ssim_prepare) images.
+
+    Parameters
+    ----------
+    pivot : ndarray
+        Pivot image array to compare every other image to.
+    images : Iterable[ndarray]
+        Image arrays to compare to the pivot, must have the same shape as the pivot.
+    downscale : int, optional
+        Integer downscaling factor of all images before comparison.
+        The default is 2
+    batch_size : int, optional
+        Number of images filtered at once.
+        The default is 16
+    win_size : int, optional
+        Side length of the sliding window.
+        The default is 7
+
+    Returns
+    -------
+    List[float]
+        The similarity of each image to the pivot.
+
+    """
+
+    return ssim_to_pivot_statistics(ssim_pivot_statistics(ssim_prepare(pivot, downscale), win_size),
+                                    images, downscale, batch_size, win_size)
+
+
+def ssim_to_pivot_statistics(pivot_statistics: Tuple[ndarray, ndarray, ndarray],
+                             images: Iterable[ndarray], downscale: int = 2,
+                             batch_size: int = 16, win_size: int = 7) -> List[float]:
+    """
+    ssim_to_pivot with the pivot's local statistics allready computed by ssim_pivot_statistics,
+    so they can be computed once and shared by many calls.
+
+    Parameters
+    ----------
+    pivot_statistics : Tuple[ndarray, ndarray, ndarray]
+        Result of ssim_pivot_statistics on the prepared (see ssim_prepare) pivot image.
+    images : Iterable[ndarray]
+        Image arrays to compare to the pivot, must have the same shape as the pivot.
+    downscale : int, optional
+        Integer downscaling factor of the images, the one the pivot was prepared with.
+        The default is 2
+    batch_size : int, optional
+        Number of images filtered at once.
+        The default is 16
+    win_size : int, optional
+        Side length of the sliding window, the one the statistics were computed with.
+        The default is 7
+
+    Returns
+    -------
+    List[float]
+        The similarity of each image to the pivot.
+
+    """
+
+    pivot, pivot_mean, pivot_var = pivot_statistics
+    cov_norm = win_size**2 / (win_size**2 - 1)
+    c1 = 0.01**2
+    c2 = 0.03**2
+    pad = (win_size - 1) // 2
+    size = (1, win_size, win_size)
+
+    results = []
+    batch = []
+    images = iter(images)
+    while True:
+        image = next(images, None)
+        if image is not None:
+            batch.append(ssim_prepare(image, downscale))
+        if batch and (len(batch) == batch_size or image is None):
+            stack = np.stack(batch)
+            mean = uniform_filter(stack, size=size)
+            variance = cov_norm * (uniform_filter(stack * stack, size=size) - mean * mean)
+            covariance = cov_norm * (uniform_filter(stack * pivot, size=size) - mean * pivot_mean)
+            similarity = (((2 * pivot_mean * mean + c1) * (2 * covariance + c2)) /
+                          ((pivot_mean**2 + mean**2 + c1) * (pivot_var + variance + c2)))
+            similarity = similarity[:, pad:similarity.shape[1] - pad, pad:similarity.shape[2] - pad]
+            results.extend(similarity.mean(axis=(1, 2), dtype=np.float64).tolist())
+            batch = []
+        if image is None:
+            return results
 
 
 def pivot_match_descriptors(descriptors: Iterable[ndarray],
@@ -251,10 +710,11 @@ def pivot_match_descriptors(descriptors: Iterable[ndarray],
 
 
 def base_match_descriptors_parallel(base_desc: ndarray, descriptors: Iterable[ndarray],
-                                    workers: int = 2) -> List[int]:
+                                    workers: int = 2,
+                                    executor: Optional[Executor] = None) -> List[int]:
     """
     Matches a single base keypoint descriptors to a list of them, returning the number of matches.
-    This variant is using dask library to parallelize it with many worker processes.
+    This variant parallelizes it with many worker processes.
 
     Parameters
     ----------
@@ -263,8 +723,11 @@ def base_match_descriptors_parallel(base_desc: ndarray, descriptors: Iterable[nd
     descriptors : Iterable[ndarray]
         The list of image keypoint descriptors to match against.
     workers : int, optional
-        Number of dask worker processes.
+        Number of worker processes.
         The default is 2
+    executor : Optional[Executor], optional
+        Run on this executor (see executor_module) instead of a new pool of [workers] processes.
+        The default is None
 
     Returns
     -------
@@ -272,13 +735,14 @@ def base_match_descriptors_parallel(base_desc: ndarray, descriptors: Iterable[nd
         Keypoint descriptor matches number.
 
     """
-    with mp.Pool(workers) as pool:
+    with executor_context(executor, workers) as pool:
         results = pool.starmap(match_descriptors, [[base_desc, desc,] for desc in descriptors])
     return results
 
 
 def pivot_match_images_parallel(images: Iterable[ndarray], pivot_index: int = 0,
-                                max_keypoints: int = 500, workers: int = 2) -> List[int]:
+                                max_keypoints: int = 500, workers: int = 2,
+                                executor: Optional[Executor] = None) -> List[int]:
     """
     Matches an entire list of input image arrays against the image at a specific index and returns
     the number of keypoint matches. This is a parralellized version.
@@ -294,8 +758,11 @@ def pivot_match_images_parallel(images: Iterable[ndarray], pivot_index: int = 0,
         Max number of keypoints for each image to be used.
         The default is 500
     workers : int, optional
-        Number of dask worker processes to use in parallel.
+        Number of worker processes to use in parallel.
         The default is 2
+    executor : Optional[Executor], optional
+        Run on this executor (see executor_module) instead of a new pool of [workers] processes.
+        The default is None
 
     Returns
     -------
@@ -304,11 +771,14 @@ def pivot_match_images_parallel(images: Iterable[ndarray], pivot_index: int = 0,
 
     """
 
-    base = images[pivot_index]
-    with mp.Pool(workers) as pool:
-        results = pool.starmap(match_images, [([base, img, max_keypoints,] if i != pivot_index else None)
-                                              for i, img in enumerate(images)].remove(None))
-    return results.insert(None, pivot_index)
+    # extract every image's descriptors once, instead of the pivot's in every match
+    with executor_context(executor, workers) as pool:
+        descriptors = pool.starmap(image_descriptors, [[img, max_keypoints,] for img in images])
+        results = pool.starmap(match_descriptors, [[descriptors[pivot_index], desc,]
+                                                   for i, desc in enumerate(descriptors)
+                                                   if i != pivot_index])
+    results.insert(pivot_index, None)
+    return results
 
 
 def pivot_match_images(images: Iterable[ndarray], pivot_index: int = 0,
@@ -346,11 +816,13 @@ def pivot_match_images(images: Iterable[ndarray], pivot_index: int = 0,
 
 
 def pivot_structural_similarity_parallel(images: Iterable[ndarray], pivot_index: int = 0,
-                                         workers: int = 2) -> List[float]:
+                                         workers: int = 2, downscale: int = 2,
+                                         batch_size: int = 16,
+                                         executor: Optional[Executor] = None) -> List[float]:
     """
     Calculates the the structural similarity of each image in the list to a single
-    image at a given base index of the list. This one uses dask to run in parallel on
-    several worker processes.
+    image at a given base index of the list. This one runs batches of ssim_to_pivot_statistics in
+    parallel on several worker processes.
 
     Parameters
     ----------
@@ -362,26 +834,69 @@ def pivot_structural_similarity_parallel(images: Iterable[ndarray], pivot_index:
     workers : int, optional
         Number of worker processes to use.
         The default is 2
+    downscale : int, optional
+        Integer downscaling factor of all images before comparison.
+        The default is 2
+    batch_size : int, optional
+        Number of images compared at once by each worker.
+        The default is 16
+    executor : Optional[Executor], optional
+        Run on this executor (see executor_module) instead of a new pool of [workers] processes.
+        The default is None
 
     Returns
     -------
     List[float]
-        How similar each image is to the base image.
+        How similar each image is to the base image, None at the pivot index.
 
     """
 
-    is_gray = [test_image_grayness(i) for i in images]
-    if True in is_gray and False in is_gray:
-        warnings.warn(f'There are grayscale and multicolor images in list, converting'
-                      f' all to grayscale to avoid errors.')
-        images = [gray(i) for i in images]
-        is_gray = True
+    # the pivot's statistics are computed once here, the workers get them instead of the pivot
+    statistics = ssim_pivot_statistics(ssim_prepare(images[pivot_index], downscale))
+    others = [img for i, img in enumerate(images) if i != pivot_index]
+    batches = [others[i:i + batch_size] for i in range(0, len(others), batch_size)]
+
+    with executor_context(executor, workers) as pool:
+        results = pool.starmap(ssim_to_pivot_statistics, [[statistics, batch, downscale,
+                                                           batch_size,]
+                                                          for batch in batches])
+    results = [similarity for batch in results for similarity in batch]
+    results.insert(pivot_index, None)
+    return results
 
-    with mp.Pool(workers) as pool:
-        base = images[pivot_index]
-        results = pool.starmap(ssim_images, [([base, img,] if i != pivot_index else None)
-                                             for i, img in enumerate(images)].remove(None))
-    return results.append(None, pivot_index)
+
+def pivot_structural_similarity(images: Iterable[ndarray], pivot_index: int = 0,
+                                downscale: int = 2, batch_size: int = 16) -> List[float]:
+    """
+    Calculates the the structural similarity of each image in the list to a single
+    image at a given base index of the list, using the ssim_to_pivot fast path.
+
+    Parameters
+    ----------
+    images : Iterable[ndarray]
+        List of image arrays loaded into memory.
+    pivot_index : int, optional
+        List index to match each other element to.
+        The default is 0
+    downscale : int, optional
+        Integer downscaling factor of all images before comparison.
+        The default is 2
+    batch_size : int, optional
+        Number of images compared at once.
+        The default is 16
+
+    Returns
+    -------
+    List[float]
+        How similar each image is to the base image, None at the pivot index.
+
+    """
+
+    results = ssim_to_pivot(images[pivot_index],
+                            (img for i, img in enumerate(images) if i != pivot_index),
+                            downscale=downscale, batch_size=batch_size)
+    results.insert(pivot_index, None)
+    return results
 
 
 def laplace_sharpness_estimate(image: ndarray) -> float:
@@ -407,7 +922,16 @@ def laplace_sharpness_estimate(image: ndarray) -> float:
     # There is an article using Support-Vector-Machine using both variance
     # and maxximum of the laplacian, might be worth looking into
 
-    return laplace(gray(image)).var()
+    image = gray(image)
+    if image.ndim == 3:
+        image = image[:, :, 0]
+    if image.dtype.kind == 'b':
+        image = image.astype(np.float64)
+    elif image.dtype.kind != 'f':
+        image = image / np.iinfo(image.dtype).max
+    if USE_JIT:
+        return float(_laplace_variance_jit(np.ascontiguousarray(image, dtype=np.float64)))
+    return float(convolve(image.astype(np.float64, copy=False), _LAPLACE_KERNEL).var())
 
 
 def canny_sharpness_estimate(image: ndarray) -> float:
@@ -428,3 +952,402 @@ def canny_sharpness_estimate(image: ndarray) -> float:
     """
 
     return canny(gray(image)).var()
+
+
+def _init_block_worker(descriptors: List[ndarray]) -> None:
+    """
+    Pool initializer, stores the descriptor list in each worker process once so the block tasks
+    only need to send their index ranges instead of the descriptors themselves.
+
+    Parameters
+    ----------
+    descriptors : List[ndarray]
+        List of image keypoint descriptors.
+
+    Returns
+    -------
+    None
+
+    """
+    global _block_descriptors
+    _block_descriptors = descriptors
+
+
+def _match_block(row_start: int, row_end: int, col_start: int, col_end: int,
+                 band: Optional[int] = None) -> Tuple[int, int, ndarray]:
+    """
+    Matches a rectangular block of the all-pairs matrix using the descriptors stored by
+    _init_block_worker. Only the upper triangle (column > row) is computed.
+
+    Parameters
+    ----------
+    row_start : int
+        First row index of the block.
+    row_end : int
+        Row index the block ends before.
+    col_start : int
+        First column index of the block.
+    col_end : int
+        Column index the block ends before.
+    band : Optional[int], optional
+        Only match pairs that are at most this many indexes apart.
+        The default is None
+
+    Returns
+    -------
+    Tuple[int, int, ndarray]
+        Block row and column start with the block of keypoint match numbers.
+
+    """
+
+    block = np.zeros((row_end - row_start, col_end - col_start), dtype=np.int32)
+    for i in range(row_start, row_end):
+        if _block_descriptors[i] is None: # no descriptors, no matches
+            continue
+        for j in range(max(col_start, i + 1), col_end):
+            if band is not None and j - i > band:
+                break
+            if _block_descriptors[j] is not None:
+                block[i - row_start, j - col_start] = match_descriptors(_block_descriptors[i],
+                                                                        _block_descriptors[j])
+    return row_start, col_start, block
+
+
+def _match_block_packed(block: Tuple[int, int, int, int, Optional[int]]
+                        ) -> Tuple[int, int, ndarray]:
+    """
+    _match_block taking its arguments as one tuple, for pool.imap_unordered.
+
+    """
+
+    return _match_block(*block)
+
+
+def all_pairs_match_descriptors(descriptors: List[ndarray], workers: int = 2,
+                                block_size: int = 64, band: Optional[int] = None,
+                                out_path: Optional[str] = None) -> ndarray:
+    """
+    Matches every keypoint descriptor in the list to every other one, returning the N x N matrix
+    of keypoint match numbers. Only the upper triangle is computed and mirrored, as matching is
+    symmetric, and the work is split into square blocks spread over a process pool.
+    The diagonal holds the number of descriptors of each image, images without descriptors
+    (None) have 0 everywhere.
+
+    Parameters
+    ----------
+    descriptors : List[ndarray]
+        List of image keypoint descriptors.
+    workers : int, optional
+        Number of worker processes.
+        The default is 2
+    block_size : int, optional
+        Number of rows and columns in each block sent to a worker.
+        The default is 64
+    band : Optional[int], optional
+        Only match pairs that are at most this many indexes apart (windowed variant for
+        sequential data like video), others are left as 0.
+        The default is None
+    out_path : Optional[str], optional
+        Write the matrix into a memory mapped '.npy' file at this path instead of keeping
+        it in memory, useful when the image count goes into the tens of thousands.
+        The default is None
+
+    Returns
+    -------
+    ndarray
+        Symmetric matrix of keypoint match numbers (int32), memory mapped if out_path was given.
+
+    """
+
+    assert block_size > 0, "block size must be positive"
+    count = len(descriptors)
+
+    if out_path is None:
+        result = np.zeros((count, count), dtype=np.int32)
+    else:
+        result = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.int32,
+                                           shape=(count, count))
+
+    blocks = []
+    for row_start in range(0, count, block_size):
+        row_end = min(row_start + block_size, count)
+        for col_start in range(row_start, count, block_size):
+            # skip blocks that fall entirely outside the band
+            if band is not None and col_start - (row_end - 1) > band:
+                break
+            blocks.append((row_start, row_end, col_start, min(col_start + block_size, count), band))
+
+    with mp.Pool(workers, initializer=_init_block_worker, initargs=(descriptors,)) as pool:
+        # blocks are written into the result as they finish, so only a few are held at once
+        for row_start, col_start, block in pool.imap_unordered(_match_block_packed, blocks):
+            rows, cols = block.shape
+            result[row_start:row_start + rows, col_start:col_start + cols] += block
+            result[col_start:col_start + cols, row_start:row_start + rows] += block.T
+
+    for i, desc in enumerate(descriptors):
+        result[i, i] = 0 if desc is None else len(desc)
+
+    if out_path is not None:
+        result.flush()
+    return result
+
+
+def _match_band_rows(row_start: int, row_end: int, band: int) -> Tuple[int, ndarray]:
+    """
+    Matches each descriptor in a range of rows to the next [band] descriptors, using the
+    descriptors stored by _init_block_worker.
+
+    Parameters
+    ----------
+    row_start : int
+        First row index.
+    row_end : int
+        Row index the range ends before.
+    band : int
+        Number of following descriptors to match to.
+
+    Returns
+    -------
+    Tuple[int, ndarray]
+        First row index with the band of keypoint match numbers of the rows.
+
+    """
+
+    count = len(_block_descriptors)
+    rows = np.zeros((row_end - row_start, band + 1), dtype=np.int32)
+    for i in range(row_start, row_end):
+        if _block_descriptors[i] is None: # no descriptors, no matches
+            continue
+        rows[i - row_start, 0] = len(_block_descriptors[i])
+        for offset in range(1, min(band, count - 1 - i) + 1):
+            if _block_descriptors[i + offset] is not None:
+                rows[i - row_start, offset] = match_descriptors(_block_descriptors[i],
+                                                                _block_descriptors[i + offset])
+    return row_start, rows
+
+
+def band_match_descriptors(descriptors: List[ndarray], band: int, workers: int = 2,
+                           block_size: int = 256) -> ndarray:
+    """
+    Matches every keypoint descriptor in the list to the following [band] ones, storing only
+    the band of the all-pairs matrix. Element [i, d] is the number of matches between i and i+d,
+    the first column holds the number of descriptors of each image and pairs past the end are 0.
+    Images without descriptors (None) have 0 everywhere.
+    This is the compact form for sequential data like video, where the full matrix would not fit.
+
+    Parameters
+    ----------
+    descriptors : List[ndarray]
+        List of image keypoint descriptors.
+    band : int
+        Number of following descriptors to match each one to.
+    workers : int, optional
+        Number of worker processes.
+        The default is 2
+    block_size : int, optional
+        Number of rows sent to a worker at once.
+        The default is 256
+
+    Returns
+    -------
+    ndarray
+        Keypoint match numbers (int32) of shape (N, band + 1).
+
+    """
+
+    count = len(descriptors)
+    result = np.zeros((count, band + 1), dtype=np.int32)
+    with mp.Pool(workers, initializer=_init_block_worker, initargs=(descriptors,)) as pool:
+        for row_start, rows in pool.starmap(_match_band_rows,
+                                            [(start, min(start + block_size, count), band)
+                                             for start in range(0, count, block_size)]):
+            result[row_start:row_start + len(rows)] = rows
+    return result
+
+
+def all_pairs_match_images(images: Iterable[ndarray], max_keypoints: int = 500,
+                           workers: int = 2, block_size: int = 64, band: Optional[int] = None,
+                           out_path: Optional[str] = None,
+                           executor: Optional[Executor] = None) -> ndarray:
+    """
+    Matches every image in the list to every other one, returning the N x N matrix of keypoint
+    match numbers. Each image's descriptors are extracted only once.
+
+    Parameters
+    ----------
+    images : Iterable[ndarray]
+        List of input image arrays, or an ImageCollection from io_module.read_folder.
+    max_keypoints : int, optional
+        Max number of keypoints for each image to be used.
+        The default is 500
+    workers : int, optional
+        Number of worker processes.
+        The default is 2
+    block_size : int, optional
+        Number of rows and columns in each block sent to a worker.
+        The default is 64
+    band : Optional[int], optional
+        Only match pairs that are at most this many indexes apart.
+        The default is None
+    out_path : Optional[str], optional
+        Write the matrix into a memory mapped '.npy' file at this path.
+        The default is None
+    executor : Optional[Executor], optional
+        Extract the descriptors on this executor (see executor_module) instead of a new pool of
+        [workers] processes. The matching itself always runs on a multiprocessing pool, its
+        workers are initialized with the descriptors.
+        The default is None
+
+    Returns
+    -------
+    ndarray
+        Symmetric matrix of keypoint match numbers.
+
+    """
+
+    with executor_context(executor, workers) as pool:
+        descriptors = pool.starmap(image_descriptors, [[img, max_keypoints,] for img in images])
+    return all_pairs_match_descriptors(descriptors, workers=workers, block_size=block_size,
+                                       band=band, out_path=out_path)
+
+
+# number of set bits for every possible byte value, used for hamming distances of packed bits
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class DescriptorHashIndex:
+    """
+    Multi-index hashing structure for binary (ORB) keypoint descriptors. Each descriptor is split
+    into equal bit substrings, each substring is used as the key of its own hash table.
+    Any two descriptors closer then the number of substrings (in hamming distance) share at least
+    one identical substring, so looking up only exact substring matches finds the close
+    descriptors without comparing against every indexed one.
+
+    Frames are inserted with an identifier (like their frame index) and querying with another
+    frame's descriptors returns the approximate number of keypoint matches to each indexed frame.
+
+    Parameters
+    ----------
+    n_tables : int, optional
+        Number of substrings (and hash tables) each descriptor is split into, must divide the
+        descriptor length in bytes. More tables find more distant matches at the cost of speed.
+        The default is 16
+    """
+
+    def __init__(self, n_tables: int = 16):
+        self.n_tables = n_tables
+        self._tables = [{} for _ in range(n_tables)]
+        # packed descriptor rows and the frame number of each, in arrays with spare capacity
+        # (doubled when full) so inserting and querying never copy everything
+        self._packed = None
+        self._frame_of = np.zeros(0, dtype=np.int64)
+        self._rows = 0
+        self._frame_ids = []
+
+    def __len__(self) -> int:
+        return len(self._frame_ids)
+
+    def _keys(self, packed: ndarray) -> ndarray:
+        """
+        Splits packed descriptors into n_tables substrings, returning a hashable key for each.
+
+        Parameters
+        ----------
+        packed : ndarray
+            Bit packed descriptors, shape (N, bytes).
+
+        Returns
+        -------
+        ndarray
+            Substring keys of shape (N, n_tables).
+
+        """
+
+        n_bytes = packed.shape[1]
+        assert n_bytes % self.n_tables == 0, (f"descriptor length of [{n_bytes}] bytes is not "
+                                              f"divisible by [{self.n_tables}] tables")
+        chunks = packed.reshape(len(packed), self.n_tables, n_bytes // self.n_tables)
+        keys = np.zeros(chunks.shape[:2], dtype=np.int64)
+        for byte in range(chunks.shape[2]):
+            keys = (keys << 8) | chunks[:, :, byte]
+        return keys
+
+    def insert(self, frame_id: int, descriptors: ndarray) -> None:
+        """
+        Adds a frame's keypoint descriptors to the index.
+
+        Parameters
+        ----------
+        frame_id : int
+            Identifier of the frame, returned by query. e.g.: the frame index.
+        descriptors : ndarray
+            Boolean keypoint descriptors as returned by image_descriptors.
+
+        Returns
+        -------
+        None
+
+        """
+
+        packed = np.packbits(np.asarray(descriptors, dtype=bool), axis=1)
+        first_row = self._rows
+        frame_number = len(self._frame_ids)
+
+        for table, table_keys in zip(self._tables, self._keys(packed).T):
+            for row, key in enumerate(table_keys.tolist(), first_row):
+                table.setdefault(key, []).append(row)
+
+        if self._packed is None:
+            self._packed = np.zeros((0, packed.shape[1]), dtype=np.uint8)
+        if first_row + len(packed) > len(self._packed):
+            capacity = max(2 * len(self._packed), first_row + len(packed), 1024)
+            grown = np.zeros((capacity, packed.shape[1]), dtype=np.uint8)
+            grown[:first_row] = self._packed[:first_row]
+            self._packed = grown
+            grown_frame_of = np.zeros(capacity, dtype=np.int64)
+            grown_frame_of[:first_row] = self._frame_of[:first_row]
+            self._frame_of = grown_frame_of
+        self._packed[first_row:first_row + len(packed)] = packed
+        self._frame_of[first_row:first_row + len(packed)] = frame_number
+        self._rows += len(packed)
+        self._frame_ids.append(frame_id)
+
+    def query(self, descriptors: ndarray, max_distance: int = 64) -> Dict[int, int]:
+        """
+        Approximately counts the keypoint matches of the given descriptors to each indexed frame.
+        A query descriptor counts as matching a frame if any of the frame's descriptors found
+        by the hash lookup is within max_distance bits of it.
+
+        Parameters
+        ----------
+        descriptors : ndarray
+            Boolean keypoint descriptors as returned by image_descriptors.
+        max_distance : int, optional
+            Maximum hamming distance (in bits) of two matching descriptors.
+            The default is 64
+
+        Returns
+        -------
+        Dict[int, int]
+            Number of keypoint matches for each indexed frame id that has at least one.
+
+        """
+
+        if not self._frame_ids:
+            return {}
+
+        packed = np.packbits(np.asarray(descriptors, dtype=bool), axis=1)
+        counts = np.zeros(len(self._frame_ids), dtype=np.int64)
+
+        for desc, desc_keys in zip(packed, self._keys(packed).tolist()):
+            candidates = []
+            for table, key in zip(self._tables, desc_keys):
+                candidates.extend(table.get(key, ()))
+            if not candidates:
+                continue
+            candidates = np.unique(candidates)
+            distances = _POPCOUNT[self._packed[candidates] ^ desc].sum(axis=1)
+            matched = candidates[distances <= max_distance]
+            counts[np.unique(self._frame_of[matched])] += 1
+
+        return {self._frame_ids[i]: int(counts[i]) for i in np.flatnonzero(counts)}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Executors the parallel functions can run on. Every executor offers the part of the
+multiprocessing.Pool interface those functions use, starmap and apply_async (returning a result
+with get and ready), and is a context manager that shuts it down. A multiprocessing.Pool itself
+can be passed wherever an executor is expected.
+
+The executors started here shut down gracefully when their with block ends without an error,
+waiting for the workers to exit normally so their exit handlers run (like the worker statistics
+of profiling_module). Only the multiprocessing pool terminates its workers on an error.
+
+Backends:
+    'multiprocessing'  ClosingPool, a multiprocessing.Pool, the default everywhere
+    'process'          concurrent.futures.ProcessPoolExecutor
+    'thread'           concurrent.futures.ThreadPoolExecutor, for kernels that release the GIL
+                       (the numba kernels of analysis_module)
+    'dask'             dask.distributed Client, on a LocalCluster or an existing scheduler
+"""
+
+# standard library
+from typing import Callable, Iterable, List, Optional, Union, Any, ContextManager
+from contextlib import nullcontext
+from multiprocessing.pool import Pool
+import concurrent.futures as cf
+
+
+BACKENDS = ('multiprocessing', 'process', 'thread', 'dask')
+
+
+class ClosingPool(Pool):
+    """
+    multiprocessing.Pool that closes and joins its workers at the end of a with block, instead of
+    terminating them, unless the block raised. Takes the arguments of multiprocessing.Pool.
+
+    """
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            self.join()
+        else:
+            self.terminate()
+
+
+class FutureResult:
+    """
+    Wraps a concurrent.futures or dask future in the AsyncResult interface of multiprocessing.
+
+    Parameters
+    ----------
+    future : Any
+        Future with result() and done() methods.
+
+    """
+
+    def __init__(self, future: Any):
+        self.future = future
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+    def ready(self) -> bool:
+        return self.future.done()
+
+
+class FuturesExecutor:
+    """
+    Executor on a concurrent.futures thread or process pool.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker threads or processes.
+        The default is 2
+    kind : str, optional
+        'thread' or 'process'.
+        The default is 'process'
+    initializer : Optional[Callable], optional
+        Called without arguments in every worker thread or process when it starts.
+        The default is None
+
+    """
+
+    def __init__(self, n_workers: int = 2, kind: str = 'process',
+                 initializer: Optional[Callable] = None):
+        if kind == 'thread':
+            self.executor = cf.ThreadPoolExecutor(max_workers=n_workers, initializer=initializer)
+        elif kind == 'process':
+            self.executor = cf.ProcessPoolExecutor(max_workers=n_workers, initializer=initializer)
+        else:
+            raise Exception(f'Unknown concurrent.futures executor kind "{kind}"')
+
+    def apply_async(self, func: Callable, args: Iterable = ()) -> FutureResult:
+        return FutureResult(self.executor.submit(func, *args))
+
+    def starmap(self, func: Callable, iterable: Iterable[Iterable]) -> List[Any]:
+        return [future.result() for future in [self.executor.submit(func, *args)
+                                               for args in iterable]]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self) -> 'FuturesExecutor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class DaskExecutor:
+    """
+    Executor on a dask.distributed cluster. Starts a LocalCluster of [n_workers] single threaded
+    worker processes if no scheduler address is given. Needs the distributed library installed.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker processes of the LocalCluster.
+        The default is 2
+    address : Optional[str], optional
+        Address of a running dask scheduler, like 'tcp://10.0.0.1:8786'.
+        The default is None
+
+    """
+
+    def __init__(self, n_workers: int = 2, address: Optional[str] = None):
+        try:
+            from distributed import Client, LocalCluster
+        except ImportError:
+            raise Exception('The dask backend needs the dask distributed library, install it with '
+                            '"conda install dask distributed"')
+        self.cluster = None
+        if address is None:
+            self.cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1,
+                                        processes=True, dashboard_address=None)
+            address = self.cluster
+        self.client = Client(address)
+
+    def apply_async(self, func: Callable, args: Iterable = ()) -> FutureResult:
+        return FutureResult(self.client.submit(func, *args, pure=False))
+
+    def starmap(self, func: Callable, iterable: Iterable[Iterable]) -> List[Any]:
+        futures = [self.client.submit(func, *args, pure=False) for args in iterable]
+        return self.client.gather(futures)
+
+    def close(self) -> None:
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+    def __enter__(self) -> 'DaskExecutor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+Executor = Union[Pool, FuturesExecutor, DaskExecutor]
+
+
+def get_executor(backend: str = 'multiprocessing', n_workers: int = 2,
+                 address: Optional[str] = None,
+                 initializer: Optional[Callable] = None) -> Executor:
+    """
+    Starts an executor of the given backend.
+
+    Parameters
+    ----------
+    backend : str, optional
+        One of 'multiprocessing', 'process', 'thread' or 'dask'.
+        The default is 'multiprocessing'
+    n_workers : int, optional
+        Number of worker processes (or threads).
+        The default is 2
+    address : Optional[str], optional
+        Dask scheduler address, only used by the dask backend.
+        The default is None (start a LocalCluster)
+    initializer : Optional[Callable], optional
+        Called without arguments in every worker when it starts, like
+        profiling_module.worker_initializer. Not supported by the dask backend.
+        The default is None
+
+    Raises
+    ------
+    Exception
+        Unknown backend.
+
+    Returns
+    -------
+    Executor
+        The executor, use it as a context manager to shut it down.
+
+    """
+
+    if backend == 'multiprocessing':
+        return ClosingPool(n_workers, initializer=initializer)
+    if backend in ('process', 'thread'):
+        return FuturesExecutor(n_workers, kind=backend, initializer=initializer)
+    if backend == 'dask':
+        if initializer is not None:
+            raise Exception('The dask backend doesn\'t support worker initializers')
+        return DaskExecutor(n_workers, address=address)
+    raise Exception(f'Unknown executor backend "{backend}", use one of {BACKENDS}')
+
+
+def executor_context(executor: Optional[Executor], n_workers: int,
+                     initializer: Optional[Callable] = None) -> ContextManager[Executor]:
+    """
+    Context manager over the given executor, leaving it running on exit, or over a new
+    ClosingPool of [n_workers] processes that is shut down on exit.
+
+    Parameters
+    ----------
+    executor : Optional[Executor]
+        Executor owned by the caller.
+    n_workers : int
+        Number of worker processes of the pool started when no executor is given.
+    initializer : Optional[Callable], optional
+        Called without arguments in every worker of the pool started when no executor is given.
+        The default is None
+
+    Returns
+    -------
+    ContextManager[Executor]
+        Context manager giving the executor.
+
+    """
+
+    if executor is None:
+        return ClosingPool(n_workers, initializer=initializer)
+    return nullcontext(executor)
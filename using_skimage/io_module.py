@@ -11,7 +11,7 @@ A collection of fuctions to read and write image data.
 
 
 # standard library
-from typing import Generator, List, Tuple
+from typing import Generator, List, Tuple, Optional
 import os
 from os import path
 import timeit
@@ -22,6 +22,10 @@ import imageio
 from numpy import ndarray
 import numpy as np
 
+# local library
+from using_skimage.timing_module import TimingMetrics, as_metrics
+from using_skimage.profiling_module import StageProfiler, as_profiler
+
 def read_image(fpath: str, as_gray: bool = False) -> ndarray:
     """
     Reads an image from disk into memory and returns it.
@@ -133,7 +137,7 @@ def save_image(image: ndarray, fpath: str, fname: str, overwrite: bool = True) -
 
 
 def read_video(fpath: str, uint16: bool = False,
-               as_gray:bool = False) -> Generator[ndarray, None, None]:
+               as_gray:bool = False, start_index: int = 0) -> Generator[ndarray, None, None]:
     """
     Reads a video file and returns a generator object to load each video frame into memory lazily.
 
@@ -148,6 +152,9 @@ def read_video(fpath: str, uint16: bool = False,
         TODO: implement
         Return image arrays as grayscale
         The default is False
+    start_index : int, optional
+        Seek directly to this frame index instead of decoding every frame before it.
+        The default is 0
 
     Yields
     ------
@@ -157,6 +164,14 @@ def read_video(fpath: str, uint16: bool = False,
     """
 
     reader = imageio.get_reader(fpath, 'ffmpeg', dtype='uint16' if uint16 else 'uint8')
+    if start_index > 0:
+        reader.set_image_index(start_index)
+        while True:
+            try:
+                frame = reader.get_next_data()
+            except IndexError:
+                return
+            yield frame
     for frame in reader:
         yield frame
 
@@ -197,9 +212,37 @@ def test_video_length(fpath: str, accurate: bool = True, debug: bool = True) ->
         return index
 
 
+def estimate_video_length(fpath: str) -> int:
+    """
+    Estimates the video file length in video frames from the container metadata, without
+    decoding anything. Uses the reported frame count if there is one, otherwise the framerate
+    times the duration, which can be off by a few frames.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute path of video file.
+
+    Returns
+    -------
+    int
+        Estimated count of video frames.
+
+    """
+
+    with imageio.get_reader(fpath, 'ffmpeg') as reader:
+        meta = reader.get_meta_data()
+    nframes = meta.get('nframes', float('inf'))
+    if nframes not in (None, float('inf')):
+        return int(nframes)
+    return int(round(meta['fps'] * meta['duration']))
+
+
 def save_video_frames(fpath: str, output_folder_path: str, frame_indexes: List[int],
                       debug_msg: bool = True, overwrite: bool = False,
-                      padding_zeros: bool = True, as_generator: bool = False) -> None:
+                      padding_zeros: bool = True, as_generator: bool = False,
+                      metrics: Optional[TimingMetrics] = None,
+                      profiler: Optional[StageProfiler] = None) -> None:
     """
     Saves select frames of a video file by index onto disk.
 
@@ -223,6 +266,13 @@ def save_video_frames(fpath: str, output_folder_path: str, frame_indexes: List[i
     as_generator : bool, optional
         Return the index of frame written, behaving like a generator.
         The default is False
+    metrics : Optional[TimingMetrics], optional
+        Record the duration of the decode, encode and write stages, and count the frames and
+        bytes written, into this collector.
+        The default is None (no timing)
+    profiler : Optional[StageProfiler], optional
+        Profile the decode, encode and write stages with cProfile and tracemalloc.
+        The default is None (no profiling)
 
     Returns
     -------
@@ -236,19 +286,35 @@ def save_video_frames(fpath: str, output_folder_path: str, frame_indexes: List[i
     if debug_msg:
         print(f'>>>> Saving {len(frame_indexes)} images to disk at "{output_folder_path}"')
         start_time = timeit.default_timer()
+    metrics = as_metrics(metrics)
+    profiler = as_profiler(profiler)
 
     curr_index = 0
     max_index = max(frame_indexes)
-    for frame in read_video(fpath):
+    reader = read_video(fpath)
+    while True:
+        with metrics.time('decode'), profiler.stage('decode'):
+            frame = next(reader, None)
+        if frame is None:
+            break
+        metrics.count('frames decoded')
+
         if curr_index in frame_indexes:
             if debug_msg:
                 temp_start_time = timeit.default_timer()
 
             name = str(curr_index).zfill(len(str(max_index))) if padding_zeros else str(curr_index)
-            try:
-                save_image(frame, output_folder_path, name, overwrite)
-            except FileExistsError:
+            file_path = os.path.join(output_folder_path, name + '.png')
+            if os.path.isfile(file_path) and not overwrite:
                 print(f"!!!! '{name}.png' allready exists, skipping...")
+            else:
+                with metrics.time('encode'), profiler.stage('encode'):
+                    encoded = imageio.imwrite('<bytes>', frame, format='png')
+                with metrics.time('write'), profiler.stage('write'):
+                    with open(file_path, 'wb') as file:
+                        file.write(encoded)
+                metrics.count('frames written')
+                metrics.count('bytes written', len(encoded))
 
             if debug_msg:
                 timed = str(round(timeit.default_timer() - temp_start_time, 3))
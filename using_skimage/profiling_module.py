@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Opt-in CPU and memory profiling of the stages of a run, to find out where a slow or memory
+hungry run spends its time and memory without editing code.
+
+A StageProfiler runs cProfile and tracemalloc around each stage block of the calling process,
+and around every call of the functions it wraps for the pool workers. On close it writes into
+its output folder, for every stage:
+    <stage>.prof              cProfile statistics merged over the process and all workers,
+                              open with pstats or snakeviz
+    <stage>.txt               the 40 most expensive functions by cumulative time
+    <stage>.snapshot          tracemalloc snapshot taken when the stage peaked in memory (calling
+                              process only), open with tracemalloc.Snapshot.load
+    <stage>.memory.txt        the 25 lines allocating the most memory in that snapshot
+and memory.json with the peak traced memory of each stage, per process.
+
+Workers write their own statistics into the workers subfolder once, when their process exits
+normally, so nothing has to be sent back, and it works on any executor (see executor_module)
+whose workers share the disk. Start the pool with worker_initializer as its initializer, then
+close and join it before closing the profiler (the executors of executor_module do when their
+with block ends without an error), terminated workers write nothing. Thread workers are written
+out by close.
+
+Functions taking a profiler default to NULL_PROFILER, which does nothing.
+"""
+
+# standard library
+from typing import Callable, Dict, Optional, Any, ContextManager
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import os
+import glob
+import json
+import pstats
+import cProfile
+import tracemalloc
+from multiprocessing.util import Finalize
+
+
+# profilers of the stages run in this process when it is a pool worker, by output folder and stage
+_worker_profiles: Dict[tuple, cProfile.Profile] = {}
+_worker_peaks: Dict[tuple, int] = {}
+_worker_finalizer: Optional[Finalize] = None
+_worker_started_tracing = False
+
+
+def reset_peak() -> None:
+    """
+    Resets the peak traced memory of tracemalloc to the current size. Python 3.8 and older have
+    no tracemalloc.reset_peak, there the traces are cleared instead, so the peak (and the next
+    snapshot) only counts the memory allocated from now on.
+
+    Returns
+    -------
+    None
+
+    """
+
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.clear_traces()
+
+
+def dump_worker_profiles(output_dir: Optional[str] = None) -> None:
+    """
+    Writes the statistics profiled_call collected in this process into the workers subfolder and
+    forgets them, then stops tracemalloc if profiled_call started it. Runs when a worker process
+    exits normally (see worker_initializer), StageProfiler.close runs it for the thread workers
+    of its own process.
+
+    Parameters
+    ----------
+    output_dir : Optional[str], optional
+        Only write the statistics of this output folder.
+        The default is None (all of them)
+
+    """
+
+    global _worker_started_tracing
+    for key in [key for key in _worker_profiles if output_dir in (None, key[0])]:
+        worker_name = os.path.join(key[0], 'workers', f'{key[1]}.{os.getpid()}')
+        _worker_profiles.pop(key).dump_stats(worker_name + '.prof')
+        if key in _worker_peaks:
+            with open(worker_name + '.peak', 'w') as file:
+                file.write(str(_worker_peaks.pop(key)))
+    if not _worker_profiles and _worker_started_tracing:
+        tracemalloc.stop()
+        _worker_started_tracing = False
+
+
+def worker_initializer() -> None:
+    """
+    Pool initializer registering dump_worker_profiles to run when the worker process exits
+    normally, that is when the pool is closed and joined rather than terminated.
+
+        pool = multiprocessing.Pool(n_workers, initializer=worker_initializer)
+
+    profiled_call registers it on its first call in workers started without it.
+
+    Returns
+    -------
+    None
+
+    """
+
+    global _worker_finalizer
+    if _worker_finalizer is None:
+        _worker_finalizer = Finalize(None, dump_worker_profiles, exitpriority=10)
+
+
+def profiled_call(function: Callable, output_dir: str, stage: str, memory: bool, *args) -> Any:
+    """
+    Calls function with args in a worker under cProfile (and tracemalloc), adding the call to the
+    worker's statistics of the stage, written into the workers subfolder of output_dir when the
+    worker exits (see dump_worker_profiles).
+
+    """
+
+    global _worker_started_tracing
+    worker_initializer()
+
+    key = (output_dir, stage)
+    if key not in _worker_profiles:
+        _worker_profiles[key] = cProfile.Profile()
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _worker_started_tracing = True
+        reset_peak()
+
+    profile = _worker_profiles[key]
+    profile.enable()
+    try:
+        result = function(*args)
+    finally:
+        profile.disable()
+
+    if memory:
+        _worker_peaks[key] = max(_worker_peaks.get(key, 0), tracemalloc.get_traced_memory()[1])
+    return result
+
+
+class StageProfiler:
+    """
+    Profiles stages of a run into an output folder, written on close (or when the with block
+    ends).
+
+        with StageProfiler('profiles/') as profiler:
+            video_selection(fpath, profiler=profiler)
+
+    Parameters
+    ----------
+    output_dir : str
+        Folder to write the profiles into, created if it doesn't exist.
+    memory : bool, optional
+        Also trace memory allocations with tracemalloc, which slows python code down noticeably.
+        The default is True
+
+    """
+
+    enabled = True
+
+    def __init__(self, output_dir: str, memory: bool = True):
+        self.output_dir = os.path.abspath(output_dir)
+        self.memory = memory
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.peaks: Dict[str, int] = {}
+        self.snapshots: Dict[str, tracemalloc.Snapshot] = {}
+        os.makedirs(os.path.join(self.output_dir, 'workers'), exist_ok=True)
+        # statistics left by the workers of an earlier run would be merged in
+        for fpath in glob.glob(os.path.join(self.output_dir, 'workers', '*')):
+            os.remove(fpath)
+        self._started_tracing = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Context manager profiling its block as (part of) a stage. Stages must not be nested.
+
+        """
+
+        if stage not in self.profiles:
+            self.profiles[stage] = cProfile.Profile()
+            self.peaks[stage] = 0
+        if self.memory:
+            reset_peak()
+
+        self.profiles[stage].enable()
+        try:
+            yield
+        finally:
+            self.profiles[stage].disable()
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                if peak > self.peaks[stage]:
+                    self.peaks[stage] = peak
+                    self.snapshots[stage] = tracemalloc.take_snapshot()
+
+    def wrap(self, function: Callable, stage: str) -> Callable:
+        """
+        Picklable wrapper of function profiling each call into a stage, to run on pool workers.
+
+        """
+
+        return partial(profiled_call, function, self.output_dir, stage, self.memory)
+
+    def close(self) -> None:
+        """
+        Merges the statistics of this process and its workers and writes them out. Worker
+        processes write theirs when they exit, so close and join the pool first.
+
+        """
+
+        dump_worker_profiles(self.output_dir) # thread workers in this process
+        worker_dir = os.path.join(self.output_dir, 'workers')
+        worker_stages = {os.path.basename(fpath).split('.')[0]
+                         for fpath in glob.glob(os.path.join(worker_dir, '*.prof'))}
+
+        memory = {}
+        for stage in sorted(set(self.profiles) | worker_stages):
+            stats = None
+            if stage in self.profiles:
+                stats = pstats.Stats(self.profiles[stage])
+            for fpath in sorted(glob.glob(os.path.join(worker_dir, f'{stage}.*.prof'))):
+                if stats is None:
+                    stats = pstats.Stats(fpath)
+                else:
+                    stats.add(fpath)
+            stats.dump_stats(os.path.join(self.output_dir, f'{stage}.prof'))
+            with open(os.path.join(self.output_dir, f'{stage}.txt'), 'w') as file:
+                stats.stream = file
+                stats.sort_stats('cumulative').print_stats(40)
+
+            memory[stage] = {}
+            if stage in self.peaks:
+                memory[stage]['main'] = self.peaks[stage]
+            for fpath in sorted(glob.glob(os.path.join(worker_dir, f'{stage}.*.peak'))):
+                with open(fpath, 'r') as file:
+                    memory[stage][f'worker {os.path.basename(fpath).split(".")[1]}'] = int(
+                        file.read())
+
+            if stage in self.snapshots:
+                snapshot = self.snapshots[stage]
+                snapshot.dump(os.path.join(self.output_dir, f'{stage}.snapshot'))
+                with open(os.path.join(self.output_dir, f'{stage}.memory.txt'), 'w') as file:
+                    for line in snapshot.statistics('lineno')[:25]:
+                        file.write(f'{line}\n')
+
+        if self.memory:
+            with open(os.path.join(self.output_dir, 'memory.json'), 'w') as file:
+                json.dump({'peak bytes': memory}, file, indent=2)
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def __enter__(self) -> 'StageProfiler':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class NullProfiler:
+    """
+    Stand-in profiler that profiles nothing.
+
+    """
+
+    enabled = False
+    _stage = nullcontext()
+
+    def stage(self, stage: str) -> ContextManager[None]:
+        return self._stage
+
+    def wrap(self, function: Callable, stage: str) -> Callable:
+        return function
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def as_profiler(profiler: Optional[StageProfiler]) -> StageProfiler:
+    """
+    The given profiler, or NULL_PROFILER if there is none.
+
+    """
+
+    return NULL_PROFILER if profiler is None else profiler
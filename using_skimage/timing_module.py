@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: AzureDVBB
+
+Per-stage timing metrics of a run. A TimingMetrics collector records the duration of each stage
+(decode, transfer, descriptors, sharpness, matching, selection, encode, write) into a histogram,
+counts frames, bytes and selections, and keeps peaks like the bytes held in buffers. It can be
+read while the run goes and exported as json at the end, to find regressions and to size
+hardware.
+
+Functions taking a collector default to NULL_METRICS, whose methods do nothing, so timing costs
+next to nothing when it is not asked for.
+"""
+
+# standard library
+from typing import Callable, Dict, Iterable, List, Optional, Any, Tuple, ContextManager
+from contextlib import contextmanager, nullcontext
+import json
+import math
+import timeit
+import threading
+
+
+# upper bounds (in seconds) of the histogram buckets, doubling from 10 microseconds to ~3 minutes
+BUCKET_BOUNDS = tuple(1e-5 * 2 ** n for n in range(25))
+
+
+class Histogram:
+    """
+    Histogram of durations over fixed, logarithmic buckets (see BUCKET_BOUNDS), with the exact
+    count, total, minimum and maximum. Not thread-safe by itself, TimingMetrics guards its
+    histograms with its lock.
+
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1) # the last one is everything above
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Adds a value to the histogram.
+
+        Parameters
+        ----------
+        value : float
+            Duration in seconds.
+
+        Returns
+        -------
+        None
+
+        """
+
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        for n, bound in enumerate(BUCKET_BOUNDS):
+            if value <= bound:
+                self.buckets[n] += 1
+                return
+        self.buckets[-1] += 1
+
+    def merge(self, other: 'Histogram') -> None:
+        """
+        Adds the values of another histogram to this one.
+
+        Parameters
+        ----------
+        other : Histogram
+            Histogram to add, left unchanged.
+
+        Returns
+        -------
+        None
+
+        """
+
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimates a percentile as the upper bound of the bucket it falls in, clipped to the
+        largest value observed.
+
+        Parameters
+        ----------
+        percent : float
+            Percentile to estimate, from 0 to 100.
+
+        Returns
+        -------
+        float
+            Estimated percentile in seconds, 0 if the histogram is empty.
+
+        """
+
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for n, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKET_BOUNDS[n], self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        """
+        Summary of the histogram, for json export.
+
+        Returns
+        -------
+        dict
+            Count, total, mean, min, max, the p50, p90 and p99 estimates, and the counts of the
+            non-empty buckets by their upper bound.
+
+        """
+
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'min': self.min if self.count else 0.0, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': {('inf' if n == len(BUCKET_BOUNDS) else f'{BUCKET_BOUNDS[n]:.6g}'): count
+                            for n, count in enumerate(self.buckets) if count}}
+
+
+class TimingMetrics:
+    """
+    Collects stage duration histograms, counters and peaks.
+
+        metrics = TimingMetrics()
+        video_selection(fpath, metrics=metrics)
+        metrics.export_json('timing.json')
+
+    Thread-safe, every method holds a lock while it reads or updates the collector, so the
+    stages of a pipeline can record into the same collector from their own threads. The
+    stages, counters and peaks attributes are not guarded, read them once the run is over or
+    use to_dict.
+
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.peaks: Dict[str, float] = {}
+        self.start_time = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Records one duration of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Stage name, like 'decode' or 'matching'.
+        seconds : float
+            Duration of the stage.
+
+        Returns
+        -------
+        None
+
+        """
+
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """
+        Context manager recording the duration of its block into a stage, also when the block
+        raises.
+
+        Parameters
+        ----------
+        stage : str
+            Stage name, like 'decode' or 'matching'.
+
+        Yields
+        ------
+        None
+
+        """
+
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(stage, timeit.default_timer() - start)
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """
+        Adds n to a counter.
+
+        Parameters
+        ----------
+        counter : str
+            Counter name, like 'frames decoded'.
+        n : int, optional
+            Amount to add.
+            The default is 1
+
+        Returns
+        -------
+        None
+
+        """
+
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def peak(self, name: str, value: float) -> None:
+        """
+        Keeps the highest value of a gauge, like the bytes held in buffers.
+
+        Parameters
+        ----------
+        name : str
+            Gauge name.
+        value : float
+            Current value of the gauge.
+
+        Returns
+        -------
+        None
+
+        """
+
+        with self._lock:
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def merge(self, other: 'TimingMetrics') -> None:
+        """
+        Adds the stages, counters and peaks of another collector, like one of a parallel run.
+
+        Parameters
+        ----------
+        other : TimingMetrics
+            Collector to add, no longer recorded into.
+
+        Returns
+        -------
+        None
+
+        """
+
+        with self._lock:
+            for stage, histogram in other.stages.items():
+                if stage not in self.stages:
+                    self.stages[stage] = Histogram()
+                self.stages[stage].merge(histogram)
+            for counter, n in other.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for name, value in other.peaks.items():
+                self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def to_dict(self) -> dict:
+        """
+        Snapshot of the metrics, for json export.
+
+        Returns
+        -------
+        dict
+            Seconds elapsed since the collector was created, the summary of each stage's
+            histogram (see Histogram.to_dict), the counters and the peaks.
+
+        """
+
+        with self._lock:
+            return {'elapsed': timeit.default_timer() - self.start_time,
+                    'stages': {stage: histogram.to_dict()
+                               for stage, histogram in self.stages.items()},
+                    'counters': dict(self.counters), 'peaks': dict(self.peaks)}
+
+    def export_json(self, fpath: str) -> None:
+        """
+        Writes a snapshot of the metrics (see to_dict) into a json file.
+
+        Parameters
+        ----------
+        fpath : str
+            Path of the json file.
+
+        Returns
+        -------
+        None
+
+        """
+
+        with open(fpath, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+class NullTimingMetrics:
+    """
+    Stand-in collector that records nothing, with the recording methods of TimingMetrics.
+
+    """
+
+    enabled = False
+    _timer = nullcontext()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        pass
+
+    def time(self, stage: str) -> ContextManager[None]:
+        return self._timer
+
+    def count(self, counter: str, n: int = 1) -> None:
+        pass
+
+    def peak(self, name: str, value: float) -> None:
+        pass
+
+
+NULL_METRICS = NullTimingMetrics()
+
+
+def timed_call(function: Callable, *args) -> Tuple[Any, float]:
+    """
+    Calls function with args in a worker, returning its result with its duration.
+
+    """
+
+    start = timeit.default_timer()
+    result = function(*args)
+    return result, timeit.default_timer() - start
+
+
+def timed_starmap(pool: Any, function: Callable, iterable: Iterable[Iterable],
+                  metrics: TimingMetrics, stage: str, n_workers: int) -> List[Any]:
+    """
+    pool.starmap that records the duration of every call in the workers into a stage, and the
+    rest of the batch's wall time, spent moving arguments and results between the processes and
+    waiting on them, into the 'transfer' stage. Plain pool.starmap when metrics are disabled.
+
+    Parameters
+    ----------
+    pool : Any
+        Pool or executor (see executor_module).
+    function : Callable
+        Function run on the workers.
+    iterable : Iterable[Iterable]
+        Arguments of each call.
+    metrics : TimingMetrics
+        Collector to record into.
+    stage : str
+        Stage name of the calls.
+    n_workers : int
+        Number of workers the calls are spread over, to estimate the transfer time.
+
+    Returns
+    -------
+    List[Any]
+        Results of the calls.
+
+    """
+
+    if not metrics.enabled:
+        return pool.starmap(function, iterable)
+
+    start = timeit.default_timer()
+    timed = pool.starmap(timed_call, [[function, *args] for args in iterable])
+    wall = timeit.default_timer() - start
+    for _, seconds in timed:
+        metrics.observe(stage, seconds)
+    if timed:
+        busy = sum(seconds for _, seconds in timed) / min(n_workers, len(timed))
+        metrics.observe('transfer', max(wall - busy, 0.0))
+    return [result for result, _ in timed]
+
+
+def as_metrics(metrics: Optional[TimingMetrics]) -> TimingMetrics:
+    """
+    The given collector, or NULL_METRICS if there is none.
+
+    """
+
+    return NULL_METRICS if metrics is None else metrics